@@ -1,13 +1,13 @@
 import uuid
 
-from django.db import models
+from django.db import models, transaction
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.contrib.auth.models import User
 from django.contrib.postgres.fields import JSONField
 from django.utils.encoding import python_2_unicode_compatible
 
-from registrations.models import Source, get_or_incr_cache
+from registrations.models import Source, get_or_incr_counter, rollup_change
 
 
 @python_2_unicode_compatible
@@ -46,6 +46,16 @@ class Change(models.Model):
                                    null=True)
     user = property(lambda self: self.created_by)
 
+    def save(self, *args, **kwargs):
+        """ A new change is added to the daily rollups in the transaction
+        that creates it, so that a rebuild of the day can't count it twice.
+        """
+        adding = self._state.adding
+        with transaction.atomic():
+            super(Change, self).save(*args, **kwargs)
+            if adding:
+                rollup_change(self)
+
     def __str__(self):
         return str(self.id)
 
@@ -63,75 +73,51 @@ def change_post_save(sender, instance, created, **kwargs):
 
 @receiver(post_save, sender=Change)
 def fire_language_change_metric(sender, instance, created, **kwargs):
-    from registrations.tasks import fire_metric
+    from registrations.tasks import queue_metric
     if created and instance.action == 'change_language':
-        fire_metric.apply_async(kwargs={
-            "metric_name": 'registrations.change.language.sum',
-            "metric_value": 1.0
-        })
+        queue_metric('registrations.change.language.sum', 1.0)
 
         total_key = 'registrations.change.language.total.last'
-        total = get_or_incr_cache(
+        total = get_or_incr_counter(
             total_key,
             Change.objects.filter(action='change_language').count)
-        fire_metric.apply_async(kwargs={
-            'metric_name': total_key,
-            'metric_value': total,
-        })
+        queue_metric(total_key, total)
 
 
 @receiver(post_save, sender=Change)
 def fire_baby_change_metric(sender, instance, created, **kwargs):
-    from registrations.tasks import fire_metric
+    from registrations.tasks import queue_metric
     if created and instance.action == 'change_baby':
-        fire_metric.apply_async(kwargs={
-            "metric_name": 'registrations.change.pregnant_to_baby.sum',
-            "metric_value": 1.0
-        })
+        queue_metric('registrations.change.pregnant_to_baby.sum', 1.0)
 
         total_key = 'registrations.change.pregnant_to_baby.total.last'
-        total = get_or_incr_cache(
+        total = get_or_incr_counter(
             total_key,
             Change.objects.filter(action='change_baby').count)
-        fire_metric.apply_async(kwargs={
-            'metric_name': total_key,
-            'metric_value': total,
-        })
+        queue_metric(total_key, total)
 
 
 @receiver(post_save, sender=Change)
 def fire_loss_change_metric(sender, instance, created, **kwargs):
-    from registrations.tasks import fire_metric
+    from registrations.tasks import queue_metric
     if created and instance.action == 'change_loss':
-        fire_metric.apply_async(kwargs={
-            "metric_name": 'registrations.change.pregnant_to_loss.sum',
-            "metric_value": 1.0
-        })
+        queue_metric('registrations.change.pregnant_to_loss.sum', 1.0)
 
         total_key = 'registrations.change.pregnant_to_loss.total.last'
-        total = get_or_incr_cache(
+        total = get_or_incr_counter(
             total_key,
             Change.objects.filter(action='change_loss').count)
-        fire_metric.apply_async(kwargs={
-            'metric_name': total_key,
-            'metric_value': total,
-        })
+        queue_metric(total_key, total)
 
 
 @receiver(post_save, sender=Change)
 def fire_message_change_metric(sender, instance, created, **kwargs):
-    from registrations.tasks import fire_metric
+    from registrations.tasks import queue_metric
     if created and instance.action == 'change_messaging':
-        fire_metric.apply_async(kwargs={
-            "metric_name": 'registrations.change.messaging.sum',
-            "metric_value": 1.0
-        })
+        queue_metric('registrations.change.messaging.sum', 1.0)
 
         total_key = 'registrations.change.messaging.total.last'
-        total = get_or_incr_cache(
+        total = get_or_incr_counter(
             total_key,
             Change.objects.filter(action='change_messaging').count)
-        fire_metric.apply_async(kwargs={
-            'metric_name': total_key,
-            'metric_value': total,
-        })
+        queue_metric(total_key, total)
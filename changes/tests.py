@@ -14,9 +14,7 @@ from rest_hooks.models import model_saved
 from hellomama_registration import utils
 from registrations.models import (
     Source, Registration, SubscriptionRequest, registration_post_save,
-    fire_created_metric, fire_unique_operator_metric, fire_message_type_metric,
-    fire_receiver_type_metric, fire_source_metric, fire_language_metric,
-    fire_state_metric, fire_role_metric)
+    fire_registration_metrics)
 from .models import (
     Change, change_post_save, fire_language_change_metric,
     fire_baby_change_metric, fire_loss_change_metric,
@@ -88,21 +86,7 @@ class AuthenticatedAPITestCase(APITestCase):
             " helpers cleaned up properly in earlier tests.")
         post_save.disconnect(receiver=registration_post_save,
                              sender=Registration)
-        post_save.disconnect(receiver=fire_created_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_source_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_unique_operator_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_message_type_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_receiver_type_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_language_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_state_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_role_metric,
+        post_save.disconnect(receiver=fire_registration_metrics,
                              sender=Registration)
         post_save.disconnect(receiver=model_saved,
                              dispatch_uid='instance-saved-hook')
@@ -115,17 +99,7 @@ class AuthenticatedAPITestCase(APITestCase):
             return post_save.has_listeners(Registration)
         post_save.connect(receiver=registration_post_save,
                           sender=Registration)
-        post_save.connect(receiver=fire_created_metric,
-                          sender=Registration)
-        post_save.connect(receiver=fire_source_metric,
-                          sender=Registration)
-        post_save.connect(receiver=fire_unique_operator_metric,
-                          sender=Registration)
-        post_save.connect(receiver=fire_language_metric,
-                          sender=Registration)
-        post_save.connect(receiver=fire_state_metric,
-                          sender=Registration)
-        post_save.connect(receiver=fire_role_metric,
+        post_save.connect(receiver=fire_registration_metrics,
                           sender=Registration)
         post_save.connect(receiver=model_saved,
                           dispatch_uid='instance-saved-hook')
@@ -1,7 +1,7 @@
 import django_filters
 import django_filters.rest_framework as filters
 from .models import Source, Change
-from registrations.models import Registration, get_or_incr_cache
+from registrations.models import Registration, get_or_incr_counter
 from rest_framework import viewsets, mixins, generics, status
 from rest_framework.pagination import CursorPagination
 from rest_framework.permissions import IsAuthenticated
@@ -91,7 +91,7 @@ class ReceiveIdentityStoreOptout(mixins.CreateModelMixin,
 
         if not registrations.exists():
             registrations = Registration.objects.filter(
-                data__receiver_id=identity_id).order_by('-created_at')
+                receiver_id=identity_id).order_by('-created_at')
 
         for registration in registrations:
             if registration.data.get('msg_receiver'):
@@ -111,62 +111,47 @@ class ReceiveIdentityStoreOptout(mixins.CreateModelMixin,
 
 
 def fire_optout_reason_metric(reason):
-    from registrations.tasks import fire_metric
+    from registrations.tasks import queue_metric
 
     if reason not in settings.OPTOUT_REASONS:
         reason = 'other'
 
-    fire_metric.apply_async(kwargs={
-        "metric_name": 'optout.reason.%s.sum' % reason,
-        "metric_value": 1.0
-    })
+    queue_metric('optout.reason.%s.sum' % reason, 1.0)
 
     def search_optouts_reason():
         result = utils.search_optouts({"reason": reason})
         return sum(1 for r in result)
 
     total_key = 'optout.reason.%s.total.last' % reason
-    total = get_or_incr_cache(
+    total = get_or_incr_counter(
         total_key,
         search_optouts_reason)
-    fire_metric.apply_async(kwargs={
-        'metric_name': total_key,
-        'metric_value': total,
-    })
+    queue_metric(total_key, total)
 
 
 def fire_optout_source_metric(source):
-    from registrations.tasks import fire_metric
+    from registrations.tasks import queue_metric
 
     # remove the _public part
     source_short = source.split('_')[0]
 
-    fire_metric.apply_async(kwargs={
-        "metric_name": 'optout.source.%s.sum' % source_short,
-        "metric_value": 1.0
-    })
+    queue_metric('optout.source.%s.sum' % source_short, 1.0)
 
     def search_optouts_source():
         result = utils.search_optouts({"request_source": source})
         return sum(1 for r in result)
 
     total_key = 'optout.source.%s.total.last' % source_short
-    total = get_or_incr_cache(
+    total = get_or_incr_counter(
         total_key,
         search_optouts_source)
-    fire_metric.apply_async(kwargs={
-        'metric_name': total_key,
-        'metric_value': total,
-    })
+    queue_metric(total_key, total)
 
 
 def fire_optout_receiver_type_metric(msg_receiver):
-    from registrations.tasks import fire_metric
+    from registrations.tasks import queue_metric
 
-    fire_metric.apply_async(kwargs={
-        "metric_name": 'optout.receiver_type.%s.sum' % msg_receiver,
-        "metric_value": 1.0
-    })
+    queue_metric('optout.receiver_type.%s.sum' % msg_receiver, 1.0)
 
     def search_optouts_receiver_type():
         result = utils.search_optouts()
@@ -176,28 +161,22 @@ def fire_optout_receiver_type_metric(msg_receiver):
         return Registration.objects.filter(
             Q(
                 mother_id__in=identities,
-                data__msg_receiver=msg_receiver) |
+                msg_receiver=msg_receiver) |
             Q(
-                data__receiver_id__in=identities,
-                data__msg_receiver=msg_receiver)).count()
+                receiver_id__in=identities,
+                msg_receiver=msg_receiver)).count()
 
     total_key = 'optout.receiver_type.%s.total.last' % msg_receiver
-    total = get_or_incr_cache(
+    total = get_or_incr_counter(
         total_key,
         search_optouts_receiver_type)
-    fire_metric.apply_async(kwargs={
-        'metric_name': total_key,
-        'metric_value': total,
-    })
+    queue_metric(total_key, total)
 
 
 def fire_optout_message_type_metric(msg_type):
-    from registrations.tasks import fire_metric
+    from registrations.tasks import queue_metric
 
-    fire_metric.apply_async(kwargs={
-        "metric_name": 'optout.msg_type.%s.sum' % msg_type,
-        "metric_value": 1.0
-    })
+    queue_metric('optout.msg_type.%s.sum' % msg_type, 1.0)
 
     def search_optouts_message_type():
         result = utils.search_optouts()
@@ -207,19 +186,16 @@ def fire_optout_message_type_metric(msg_type):
         return Registration.objects.filter(
             Q(
                 mother_id__in=identities,
-                data__msg_type=msg_type) |
+                msg_type=msg_type) |
             Q(
-                data__receiver_id__in=identities,
-                data__msg_type=msg_type)).count()
+                receiver_id__in=identities,
+                msg_type=msg_type)).count()
 
     total_key = 'optout.msg_type.%s.total.last' % msg_type
-    total = get_or_incr_cache(
+    total = get_or_incr_counter(
         total_key,
         search_optouts_message_type)
-    fire_metric.apply_async(kwargs={
-        'metric_name': total_key,
-        'metric_value': total,
-    })
+    queue_metric(total_key, total)
 
 
 def get_or_create_source(request):
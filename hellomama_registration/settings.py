@@ -8,9 +8,11 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/1.9/ref/settings/
 """
 
+from celery.schedules import crontab
 from kombu import Exchange, Queue
 
 import os
+from datetime import timedelta
 import djcelery
 import dj_database_url
 import mimetypes
@@ -204,6 +206,9 @@ CELERY_ROUTES = {
     'registrations.tasks.validate_registration': {
         'queue': 'priority',
     },
+    'registrations.tasks.validate_registrations': {
+        'queue': 'priority',
+    },
     'changes.tasks.implement_action': {
         'queue': 'priority',
     },
@@ -213,12 +218,33 @@ CELERY_ROUTES = {
     'registrations.tasks.fire_metric': {
         'queue': 'metrics',
     },
+    'registrations.tasks.calculate_registration_metrics': {
+        'queue': 'metrics',
+    },
+    'registrations.tasks.fire_metrics': {
+        'queue': 'metrics',
+    },
+    'registrations.tasks.flush_metrics': {
+        'queue': 'metrics',
+    },
     'uniqueids.tasks.add_unique_id_to_identity': {
         'queue': 'priority',
     },
     'registrations.tasks.repopulate_metrics': {
         'queue': 'mediumpriority',
     },
+    'registrations.tasks.repopulate_metrics_shard': {
+        'queue': 'mediumpriority',
+    },
+    'registrations.tasks.refresh_operators': {
+        'queue': 'mediumpriority',
+    },
+    'registrations.tasks.rebuild_daily_rollups': {
+        'queue': 'mediumpriority',
+    },
+    'registrations.tasks.scheduled_metrics': {
+        'queue': 'mediumpriority',
+    },
 }
 
 CACHES = {
@@ -226,8 +252,86 @@ CACHES = {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
         'TIMEOUT': None,
     },
+    # Shared by all processes, so that an identity invalidated by one of
+    # them isn't served by the others. The default table is created by the
+    # registrations migrations.
+    'identities': {
+        'BACKEND': os.environ.get(
+            'IDENTITY_CACHE_BACKEND',
+            'django.core.cache.backends.db.DatabaseCache'),
+        'LOCATION': os.environ.get(
+            'IDENTITY_CACHE_LOCATION', 'identity_cache'),
+        'TIMEOUT': int(os.environ.get('IDENTITY_CACHE_TIMEOUT', 60 * 60)),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(
+                os.environ.get('IDENTITY_CACHE_MAX_ENTRIES', 10000)),
+        },
+    },
+    'http': {
+        'BACKEND': os.environ.get(
+            'HTTP_CACHE_BACKEND',
+            'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('HTTP_CACHE_LOCATION', 'http'),
+        'TIMEOUT': int(os.environ.get('HTTP_CACHE_TIMEOUT', 60 * 60 * 24)),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.environ.get('HTTP_CACHE_MAX_ENTRIES', 1000)),
+        },
+    },
 }
 
+IDENTITY_CACHE = 'identities'
+HTTP_CACHE = 'http'
+
+# The Stage Based Messaging endpoints whose GET responses are cached and
+# revalidated, as endpoint:max_age pairs. A cached response is used without
+# revalidating it for max_age seconds.
+HTTP_CACHE_ENDPOINTS = dict(
+    (endpoint, int(max_age)) for endpoint, max_age in (
+        item.split(':') for item in os.environ.get(
+            'HTTP_CACHE_ENDPOINTS',
+            'messageset:0,messageset_languages:0,schedule:0'
+        ).split(',') if item))
+
+# How long, in seconds, the in-process messageset and schedule catalogue is
+# used before it is reloaded. 0 disables the catalogue.
+MESSAGESET_CATALOGUE_TTL = int(
+    os.environ.get('MESSAGESET_CATALOGUE_TTL', 60 * 5))
+# How long, in seconds, a stale catalogue is used before reloading it is
+# tried again, after a reload failed
+MESSAGESET_CATALOGUE_RETRY_INTERVAL = int(
+    os.environ.get('MESSAGESET_CATALOGUE_RETRY_INTERVAL', 30))
+
+# The most concurrent requests that bulk lookups make to a downstream service,
+# and the amount of connections kept alive per service
+FANOUT_CONCURRENCY = int(os.environ.get('FANOUT_CONCURRENCY', 10))
+
+# Requests to downstream services time out after DOWNSTREAM_TIMEOUT seconds.
+# Connection errors, and 502, 503 and 504 responses to idempotent requests,
+# are retried DOWNSTREAM_RETRIES times, backing off exponentially from
+# DOWNSTREAM_BACKOFF_FACTOR seconds with random jitter.
+DOWNSTREAM_TIMEOUT = int(os.environ.get('DOWNSTREAM_TIMEOUT', 65))
+DOWNSTREAM_RETRIES = int(os.environ.get('DOWNSTREAM_RETRIES', 3))
+DOWNSTREAM_BACKOFF_FACTOR = float(
+    os.environ.get('DOWNSTREAM_BACKOFF_FACTOR', 0.5))
+
+# Identical downstream GET requests are only made once within a request or
+# Celery task, keeping the REQUEST_MEMO_MAX_SIZE most recently used responses
+REQUEST_MEMO = os.environ.get('REQUEST_MEMO', 'true').lower() == 'true'
+REQUEST_MEMO_MAX_SIZE = int(os.environ.get('REQUEST_MEMO_MAX_SIZE', 100))
+
+# After CIRCUIT_BREAKER_FAILURE_THRESHOLD consecutive failed requests to a
+# downstream service, requests to it fail immediately for
+# CIRCUIT_BREAKER_RESET_TIMEOUT seconds. A threshold of 0 disables it.
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = int(
+    os.environ.get('CIRCUIT_BREAKER_FAILURE_THRESHOLD', 5))
+CIRCUIT_BREAKER_RESET_TIMEOUT = int(
+    os.environ.get('CIRCUIT_BREAKER_RESET_TIMEOUT', 30))
+
+# The page size requested from identity store searches. Empty uses the
+# identity store's default.
+IDENTITY_STORE_SEARCH_PAGE_SIZE = int(
+    os.environ.get('IDENTITY_STORE_SEARCH_PAGE_SIZE') or 0) or None
+
 MSG_TYPES = ["text", "audio"]
 RECEIVER_TYPES = [
     "mother_father", "mother_only", "father_only", "mother_family",
@@ -291,8 +395,16 @@ METRICS_REALTIME.extend(
     ['optout.source.%s.total.last' % r for r in OPTOUT_SOURCES])
 METRICS_SCHEDULED = [
 ]
+# The groups of metrics that the scheduled_metrics task calculates, every
+# METRICS_SCHEDULED_INTERVAL seconds. The metric names depend on the
+# messagesets and facilities, so they aren't listed in METRICS_SCHEDULED.
 METRICS_SCHEDULED_TASKS = [
-]
+    group for group in os.environ.get(
+        'METRICS_SCHEDULED_TASKS',
+        'active_subscriptions,registrations_per_facility,optouts_per_reason'
+    ).split(',') if group]
+METRICS_SCHEDULED_INTERVAL = int(
+    os.environ.get('METRICS_SCHEDULED_INTERVAL', 60 * 60))
 
 METRICS_AUTH = (
     os.environ.get("METRICS_AUTH_USER", "REPLACEME"),
@@ -300,11 +412,64 @@ METRICS_AUTH = (
 )
 METRICS_URL = os.environ.get("METRICS_URL", None)
 
+# If true, realtime metrics are summed in a shared buffer and fired together
+# every METRICS_FLUSH_INTERVAL seconds, instead of firing each one in a task
+METRICS_AGGREGATE = os.environ.get(
+    'METRICS_AGGREGATE', 'false').lower() == 'true'
+METRICS_FLUSH_INTERVAL = int(os.environ.get('METRICS_FLUSH_INTERVAL', 10))
+
+CELERYBEAT_SCHEDULE = {}
+if METRICS_AGGREGATE:
+    CELERYBEAT_SCHEDULE['flush-metrics'] = {
+        'task': 'registrations.tasks.flush_metrics',
+        'schedule': timedelta(seconds=METRICS_FLUSH_INTERVAL),
+    }
+
+if METRICS_SCHEDULED_TASKS:
+    CELERYBEAT_SCHEDULE['scheduled-metrics'] = {
+        'task': 'registrations.tasks.scheduled_metrics',
+        'schedule': timedelta(seconds=METRICS_SCHEDULED_INTERVAL),
+    }
+
+# The daily rollups of the last DAILY_ROLLUP_REBUILD_DAYS days are rebuilt
+# every night. If true, the metric totals are summed from the rollups.
+DAILY_ROLLUP_REBUILD_DAYS = int(
+    os.environ.get('DAILY_ROLLUP_REBUILD_DAYS', '2'))
+METRICS_USE_DAILY_ROLLUPS = os.environ.get(
+    'METRICS_USE_DAILY_ROLLUPS', 'false').lower() == 'true'
+CELERYBEAT_SCHEDULE['rebuild-daily-rollups'] = {
+    'task': 'registrations.tasks.rebuild_daily_rollups',
+    'schedule': crontab(hour=0, minute=30),
+}
+
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_IGNORE_RESULT = True
 
+REGISTRATION_BULK_MAX_SIZE = int(
+    os.environ.get('REGISTRATION_BULK_MAX_SIZE', '1000'))
+REGISTRATION_VALIDATION_CHUNK_SIZE = int(
+    os.environ.get('REGISTRATION_VALIDATION_CHUNK_SIZE', '100'))
+REPOPULATE_METRICS_SHARD_SIZE = int(
+    os.environ.get('REPOPULATE_METRICS_SHARD_SIZE', '500'))
+REPOPULATE_METRICS_SHARD_TIMEOUT = int(
+    os.environ.get('REPOPULATE_METRICS_SHARD_TIMEOUT', '3600'))
+METRICS_AMQP_BATCH_SIZE = int(
+    os.environ.get('METRICS_AMQP_BATCH_SIZE', '500'))
+METRICS_AMQP_NAME_IN_BODY = os.environ.get(
+    'METRICS_AMQP_NAME_IN_BODY', 'false').lower() == 'true'
+OPERATOR_REFRESH_MAX_AGE = int(
+    os.environ.get('OPERATOR_REFRESH_MAX_AGE', 60 * 60 * 24))
+OPERATOR_REFRESH_LIMIT = int(
+    os.environ.get('OPERATOR_REFRESH_LIMIT', '1000'))
+OPERATOR_REFRESH_INTERVAL = int(
+    os.environ.get('OPERATOR_REFRESH_INTERVAL', 60 * 60))
+CELERYBEAT_SCHEDULE['refresh-operators'] = {
+    'task': 'registrations.tasks.refresh_operators',
+    'schedule': timedelta(seconds=OPERATOR_REFRESH_INTERVAL),
+}
+
 PREBIRTH_MIN_WEEKS = int(os.environ.get('PREBIRTH_MIN_WEEKS', '10'))
 PREBIRTH_MAX_WEEKS = int(os.environ.get('PREBIRTH_MAX_WEEKS', '42'))
 POSTBIRTH_MIN_WEEKS = int(os.environ.get('POSTBIRTH_MIN_WEEKS', '0'))
@@ -27,3 +27,14 @@ V2N_FTP_PORT = '2222'
 V2N_FTP_USER = 'test'
 V2N_FTP_PASS = 'secret'
 V2N_FTP_ROOT = 'test_directory'
+
+CACHES['identities'] = {
+    'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+}
+CACHES['http'] = {
+    'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+}
+
+MESSAGESET_CATALOGUE_TTL = 0
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = 0
+REQUEST_MEMO = False
@@ -1,42 +1,516 @@
 import datetime
+import hashlib
 import requests
 import json
+import random
 import re
 import six
+import threading
+import time
+from celery.signals import task_postrun, task_prerun
+from collections import OrderedDict
 from django.conf import settings
-from registrations.models import Source
+from django.core.cache import caches
+from django.db import connections
+from django.core.signals import request_finished, request_started
+from django.dispatch import receiver
+from registrations.models import (
+    MetricCounter, Source, get_or_incr_counter)
 from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+from requests.packages.urllib3.util.retry import Retry
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
 from seed_services_client import (
     IdentityStoreApiClient,
     MessageSenderApiClient,
     StageBasedMessagingApiClient,
 )
+from seed_services_client.seed_services import SeedHTTPAdapter
 
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """ Raised instead of making a request to a service whose circuit breaker
+    is open.
+    """
+
+
+def report_downstream_metrics(metrics):
+    from registrations.tasks import queue_metrics
+    defer_to_caller(queue_metrics, metrics)
+
+
+class CircuitBreaker(object):
+    """ Tracks the consecutive failures of the requests to a downstream
+    service, and the retries made for them.
+
+    After `settings.CIRCUIT_BREAKER_FAILURE_THRESHOLD` consecutive failures
+    the breaker opens, and requests fail immediately with CircuitOpenError.
+    Once it has been open for `settings.CIRCUIT_BREAKER_RESET_TIMEOUT`
+    seconds a single trial request is let through, which closes the breaker
+    if it succeeds, and opens it again if it fails. A threshold of 0 disables
+    the breaker.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, service):
+        self.service = service
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.failures = 0
+        self.opened_at = None
+        self.retries = 0
+
+    @property
+    def enabled(self):
+        return settings.CIRCUIT_BREAKER_FAILURE_THRESHOLD > 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if (time.time() - self.opened_at <
+                settings.CIRCUIT_BREAKER_RESET_TIMEOUT):
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def report_state(self):
+        report_downstream_metrics({
+            'downstream.%s.circuit_open.last' % self.service:
+                int(self.opened_at is not None),
+        })
+
+    def before_request(self):
+        if not self.enabled:
+            return
+        with self.lock:
+            state = self.state
+            if state == self.HALF_OPEN:
+                # This request is the trial, the others keep failing until
+                # it has completed
+                self.opened_at = time.time()
+        if state == self.OPEN:
+            raise CircuitOpenError(
+                "The circuit breaker for %s is open" % self.service)
+
+    def record_success(self):
+        with self.lock:
+            was_open = self.opened_at is not None
+            self.failures = 0
+            self.opened_at = None
+        if was_open:
+            self.report_state()
+
+    def record_failure(self):
+        if not self.enabled:
+            return
+        with self.lock:
+            was_open = self.opened_at is not None
+            self.failures += 1
+            if (was_open or self.failures >=
+                    settings.CIRCUIT_BREAKER_FAILURE_THRESHOLD):
+                self.opened_at = time.time()
+        if not was_open and self.opened_at is not None:
+            self.report_state()
+
+    def record_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def report_retries(self):
+        with self.lock:
+            retries, self.retries = self.retries, 0
+        if retries:
+            report_downstream_metrics({
+                'downstream.%s.retries.sum' % self.service: retries,
+            })
+
+
+circuit_breakers = {}
+
+
+def get_circuit_breaker(service):
+    return circuit_breakers.setdefault(service, CircuitBreaker(service))
+
+
+def get_circuit_breaker_states():
+    return dict(
+        (service, breaker.state)
+        for service, breaker in circuit_breakers.items())
+
+
+class JitteredRetry(Retry):
+    """ Retries with exponential backoff, sleeping for a random time of up to
+    the backoff so that clients don't retry in lockstep. Retries are counted
+    on the circuit breaker of the service.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.breaker = kwargs.pop('breaker', None)
+        super(JitteredRetry, self).__init__(*args, **kwargs)
+
+    def new(self, **kwargs):
+        retry = super(JitteredRetry, self).new(**kwargs)
+        retry.breaker = self.breaker
+        return retry
+
+    def get_backoff_time(self):
+        return random.uniform(0, super(JitteredRetry, self).get_backoff_time())
+
+    def increment(self, *args, **kwargs):
+        retry = super(JitteredRetry, self).increment(*args, **kwargs)
+        if self.breaker is not None:
+            self.breaker.record_retry()
+        return retry
+
+
+memo = threading.local()
+memo_stats_lock = threading.Lock()
+memo_stats = {"deduplicated": 0}
+
+
+@receiver(request_started)
+@task_prerun.connect
+def begin_memo(**kwargs):
+    """ Starts a unit of work, a request or a Celery task, in which identical
+    downstream GET requests are only made once. Units of work started within
+    another one, such as eager tasks, share its memo.
+    """
+    memo.depth = getattr(memo, 'depth', 0) + 1
+    if memo.depth == 1:
+        memo.responses = OrderedDict()
+
+
+@receiver(request_finished)
+@task_postrun.connect
+def end_memo(**kwargs):
+    """ Ends a unit of work, discarding its memoised responses.
+    """
+    memo.depth = max(getattr(memo, 'depth', 0) - 1, 0)
+    if memo.depth == 0:
+        memo.responses = None
+
+
+def get_memo():
+    """ Returns the responses memoised in the current unit of work, or None
+    outside of one or if `settings.REQUEST_MEMO` is off.
+    """
+    if not settings.REQUEST_MEMO:
+        return None
+    return getattr(memo, 'responses', None)
+
+
+def incr_memo_deduplicated():
+    with memo_stats_lock:
+        memo_stats["deduplicated"] += 1
+
+
+def get_memo_stats():
+    """ Returns the amount of downstream requests deduplicated by the memo.
+    """
+    with memo_stats_lock:
+        return dict(memo_stats)
+
+
+class ResilientAdapter(SeedHTTPAdapter):
+    """ Makes the requests to a downstream service through its circuit
+    breaker, retrying connection errors and 502, 503 and 504 responses of
+    idempotent requests up to `settings.DOWNSTREAM_RETRIES` times with
+    jittered exponential backoff. Connection errors, timeouts and server
+    errors count as failures.
+
+    Within a unit of work, GET responses are memoised, up to
+    `settings.REQUEST_MEMO_MAX_SIZE` of the most recently used ones, and any
+    other request clears the memo.
+    """
+
+    def __init__(self, service, *args, **kwargs):
+        self.breaker = get_circuit_breaker(service)
+        kwargs.setdefault('timeout', settings.DOWNSTREAM_TIMEOUT)
+        super(ResilientAdapter, self).__init__(*args, **kwargs)
+
+    @property
+    def max_retries(self):
+        return JitteredRetry(
+            total=settings.DOWNSTREAM_RETRIES,
+            backoff_factor=settings.DOWNSTREAM_BACKOFF_FACTOR,
+            status_forcelist=(502, 503, 504),
+            raise_on_status=False,
+            breaker=self.breaker)
+
+    @max_retries.setter
+    def max_retries(self, value):
+        # demands resets the retries of every adapter before each request,
+        # so the retries always come from the settings
+        pass
+
+    def response_from_stored(self, request, stored):
+        """ Builds the response for a memoised or cached entry. Real
+        responses are still built by HTTPAdapter.build_response.
+        """
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = 'OK'
+        response.headers = CaseInsensitiveDict(stored['headers'])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = stored['content']
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response.from_cache = True
+        return response
+
+    def send(self, request, *args, **kwargs):
+        memoised = get_memo()
+        if memoised is None:
+            return self.send_downstream(request, *args, **kwargs)
+        if request.method != 'GET':
+            # The write may change what the memoised requests return
+            memoised.clear()
+            return self.send_downstream(request, *args, **kwargs)
+
+        stored = memoised.pop(request.url, None)
+        if stored is not None:
+            # Most recently used last
+            memoised[request.url] = stored
+            incr_memo_deduplicated()
+            return self.response_from_stored(request, stored)
+
+        response = self.send_downstream(request, *args, **kwargs)
+        if response.status_code == 200:
+            memoised[request.url] = {
+                'headers': dict(response.headers),
+                'content': response.content,
+            }
+            # Long running tasks make many distinct requests, so only the
+            # least recently used responses are discarded
+            while len(memoised) > settings.REQUEST_MEMO_MAX_SIZE:
+                memoised.popitem(last=False)
+        return response
+
+    def send_downstream(self, request, *args, **kwargs):
+        self.breaker.before_request()
+        try:
+            response = super(ResilientAdapter, self).send(
+                request, *args, **kwargs)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout):
+            self.breaker.record_failure()
+            raise
+        finally:
+            self.breaker.report_retries()
+
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+
+def mount_pooled_adapters(session, service, adapter_class=ResilientAdapter,
+                          **kwargs):
+    """ Mounts adapters for the service on the session that keep up to
+    FANOUT_CONCURRENCY connections per host alive, so that concurrent
+    requests reuse their connections instead of opening new ones.
+    """
+    for prefix in ('http://', 'https://'):
+        session.mount(prefix, adapter_class(
+            service, pool_maxsize=settings.FANOUT_CONCURRENCY, **kwargs))
+
+
+HTTP_CACHE_KEY = 'http:%s'
+
+
+def get_http_cache():
+    return caches[settings.HTTP_CACHE]
+
+
+class HTTPCacheAdapter(ResilientAdapter):
+    """ Caches the GET responses of the endpoints of a seed service that are
+    in `settings.HTTP_CACHE_ENDPOINTS`, together with their ETag and
+    Last-Modified validators.
+
+    A cached response is used without a request for the max age of its
+    endpoint, and revalidated with If-None-Match and If-Modified-Since after
+    that. A 304 returns the cached response. If revalidation fails, with a
+    connection error or a server error, the cached response is returned.
+    """
+
+    def __init__(self, service, base_url, *args, **kwargs):
+        self.base_url = base_url.rstrip('/') + '/'
+        super(HTTPCacheAdapter, self).__init__(service, *args, **kwargs)
+
+    def get_endpoint(self, url):
+        if not url.startswith(self.base_url):
+            return None
+        return url[len(self.base_url):].split('?')[0].split('/')[0]
+
+    def send_downstream(self, request, *args, **kwargs):
+        max_age = settings.HTTP_CACHE_ENDPOINTS.get(
+            self.get_endpoint(request.url))
+        if request.method != 'GET' or max_age is None:
+            return super(HTTPCacheAdapter, self).send_downstream(
+                request, *args, **kwargs)
+
+        http_cache = get_http_cache()
+        key = HTTP_CACHE_KEY % hashlib.md5(
+            request.url.encode('utf-8')).hexdigest()
+        cached = http_cache.get(key)
+        if cached is not None:
+            if time.time() - cached['stored_at'] < max_age:
+                return self.response_from_stored(request, cached)
+            if cached['etag']:
+                request.headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                request.headers['If-Modified-Since'] = cached['last_modified']
+
+        try:
+            response = super(HTTPCacheAdapter, self).send_downstream(
+                request, *args, **kwargs)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout):
+            if cached is None:
+                raise
+            return self.response_from_stored(request, cached)
+
+        if cached is not None and response.status_code == 304:
+            cached['stored_at'] = time.time()
+            http_cache.set(key, cached)
+            return self.response_from_stored(request, cached)
+        if cached is not None and response.status_code >= 500:
+            return self.response_from_stored(request, cached)
+        if response.status_code == 200:
+            http_cache.set(key, {
+                'stored_at': time.time(),
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'headers': dict(response.headers),
+                'content': response.content,
+            })
+        return response
+
+
+def build_client(client_class, service, api_url, auth_token, cache=False):
+    """ Returns a seed services client with pooled connections, that makes
+    its requests through the circuit breaker of the service. If `cache` is
+    set, the responses of the endpoints in `settings.HTTP_CACHE_ENDPOINTS`
+    are cached.
+    """
+    client = client_class(api_url=api_url, auth_token=auth_token)
+    if cache:
+        mount_pooled_adapters(
+            client.session, service, HTTPCacheAdapter, base_url=api_url)
+    else:
+        mount_pooled_adapters(client.session, service)
+    return client
+
+
+# Used for the identity store searches
 session = requests.Session()
-http = requests.adapters.HTTPAdapter(max_retries=5)
-https = requests.adapters.HTTPAdapter(max_retries=5)
-session.mount('http://', http)
-session.mount('https://', https)
+mount_pooled_adapters(session, 'identity_store')
 
-identity_store_client = IdentityStoreApiClient(
+identity_store_client = build_client(
+    IdentityStoreApiClient,
+    'identity_store',
     api_url=settings.IDENTITY_STORE_URL,
     auth_token=settings.IDENTITY_STORE_TOKEN,
-    retries=5,
 )
 
-stage_based_messaging_client = StageBasedMessagingApiClient(
+stage_based_messaging_client = build_client(
+    StageBasedMessagingApiClient,
+    'stage_based_messaging',
     api_url=settings.STAGE_BASED_MESSAGING_URL,
     auth_token=settings.STAGE_BASED_MESSAGING_TOKEN,
-    retries=5,
+    cache=True,
 )
 
-message_sender_client = MessageSenderApiClient(
+message_sender_client = build_client(
+    MessageSenderApiClient,
+    'message_sender',
     api_url=settings.MESSAGE_SENDER_URL,
     auth_token=settings.MESSAGE_SENDER_TOKEN,
-    retries=5,
 )
 
 
+pool_thread = threading.local()
+
+
+def defer_to_caller(func, *args):
+    """ Calls `func` with the args, unless this is a pool thread, in which
+    case the call is made on the thread that waits for the pool's result.
+    Metrics and counters are written from the calling thread, so that a
+    pool thread doesn't wait for a lock held by the caller's transaction.
+    """
+    deferred = getattr(pool_thread, 'deferred', None)
+    if deferred is None:
+        return func(*args)
+    deferred.append((func, args))
+
+
+def call_on_pool(func, *args):
+    """ Calls `func` with the args on a pool thread. Returns its result, or
+    the exception it raised, and the calls it deferred to the caller, which
+    `run_deferred` makes. The database connections that the call opened are
+    closed, since nothing else closes them on the pool's threads.
+    """
+    pool_thread.deferred = deferred = []
+    try:
+        return func(*args), deferred
+    except Exception as e:
+        return e, deferred
+    finally:
+        pool_thread.deferred = None
+        connections.close_all()
+
+
+def run_deferred(deferred):
+    for func, args in deferred:
+        func(*args)
+
+
+def fan_out(func, items, concurrency=None):
+    """ Calls `func` for each of the items on a pool of at most
+    `concurrency` threads, FANOUT_CONCURRENCY by default.
+
+    Returns the results in the same order as the items. If a call raises an
+    exception, the exception is returned as its result, so that one failure
+    doesn't lose the other results.
+    """
+    items = list(items)
+    concurrency = min(concurrency or settings.FANOUT_CONCURRENCY, len(items))
+
+    def call(item):
+        try:
+            return func(item)
+        except Exception as e:
+            return e
+
+    if concurrency <= 1:
+        return [call(item) for item in items]
+    pool = ThreadPool(concurrency)
+    try:
+        results = pool.map(lambda item: call_on_pool(call, item), items)
+    finally:
+        pool.close()
+        pool.join()
+    for result, deferred in results:
+        run_deferred(deferred)
+    return [result for result, deferred in results]
+
+
+def fan_out_unique(func, keys, concurrency=None):
+    """ Like `fan_out`, but calls `func` once for each distinct key.
+    """
+    keys = list(keys)
+    unique = list(set(keys))
+    results = dict(zip(unique, fan_out(func, unique, concurrency)))
+    return [results[key] for key in keys]
+
+
 def get_today():
     return datetime.datetime.today()
 
@@ -100,12 +574,93 @@ def normalize_msisdn(raw, country_code):
     return raw
 
 
-def get_identity(identity):
-    return identity_store_client.get_identity(identity)
+IDENTITY_CACHE_KEY = 'identity:%s'
+IDENTITY_ADDRESS_CACHE_KEY = 'identity_address:%s'
+
+
+def get_identity_cache():
+    return caches[settings.IDENTITY_CACHE]
+
+
+def incr_identity_cache_counter(name):
+    """ Increments the `hits` or `misses` counter of the identity cache,
+    atomically in a shared MetricCounter.
+    """
+    defer_to_caller(
+        get_or_incr_counter, 'identity_cache.%s' % name, lambda: 1)
+
+
+def get_identity_cache_stats():
+    """ Returns the hit and miss counts of the identity cache.
+    """
+    counters = dict(MetricCounter.objects.filter(
+        name__in=['identity_cache.hits', 'identity_cache.misses'])
+        .values_list('name', 'value'))
+    return {
+        "hits": counters.get('identity_cache.hits', 0),
+        "misses": counters.get('identity_cache.misses', 0),
+    }
+
+
+def get_cached(key, fetch):
+    """ Returns the value for `key` from the identity cache, calling `fetch`
+    and caching the result if it is not there. Missing identities (None) are
+    not cached.
+    """
+    identity_cache = get_identity_cache()
+    value = identity_cache.get(key)
+    if value is not None:
+        incr_identity_cache_counter('hits')
+        return value
+
+    incr_identity_cache_counter('misses')
+    value = fetch()
+    if value is not None:
+        identity_cache.set(key, value)
+    return value
+
 
+def invalidate_identity(identity):
+    """ Removes the given identity from the identity cache
+    """
+    get_identity_cache().delete_many([
+        IDENTITY_CACHE_KEY % identity,
+        IDENTITY_ADDRESS_CACHE_KEY % identity,
+    ])
+
+
+def get_identity(identity, client=None):
+    client = client or identity_store_client
+    return get_cached(
+        IDENTITY_CACHE_KEY % identity,
+        lambda: client.get_identity(identity))
+
+
+def get_identity_address(identity, client=None):
+    client = client or identity_store_client
+    return get_cached(
+        IDENTITY_ADDRESS_CACHE_KEY % identity,
+        lambda: client.get_identity_address(identity))
 
-def get_identity_address(identity):
-    return identity_store_client.get_identity_address(identity)
+
+def get_identities(identities, client=None, concurrency=None):
+    """ Returns the identities for the list of identity ids, fetched
+    concurrently, in the same order. Missing identities are None, and
+    identities that couldn't be fetched are the exception that was raised.
+    """
+    return fan_out_unique(
+        lambda identity: get_identity(identity, client=client),
+        identities, concurrency)
+
+
+def get_addresses(identities, client=None, concurrency=None):
+    """ Returns the default addresses for the list of identity ids, fetched
+    concurrently, in the same order. Addresses that couldn't be fetched are
+    the exception that was raised.
+    """
+    return fan_out_unique(
+        lambda identity: get_identity_address(identity, client=client),
+        identities, concurrency)
 
 
 def get_address_from_identity(identity):
@@ -120,43 +675,94 @@ def get_address_from_identity(identity):
     return last_address
 
 
-def search_identities(search_key, search_value):
+prefetch_pool = None
+prefetch_pool_lock = threading.Lock()
+
+
+def get_prefetch_pool():
+    """ Returns the thread pool that search pages are prefetched on, shared
+    by all the searches of the process. It is created on first use, so that
+    worker processes don't inherit it when they are forked.
     """
-    Returns the identities matching the given parameters
-    FIXME: This should be handled by identity_store_client when
-    it supports pagination
+    global prefetch_pool
+    with prefetch_pool_lock:
+        if prefetch_pool is None:
+            prefetch_pool = ThreadPool(settings.FANOUT_CONCURRENCY)
+        return prefetch_pool
+
+
+def iter_pages(url, params=None, page_size=None, prefetch=True):
+    """
+    Yields the results of all the pages of an identity store search, using
+    the pooled session. Once the caller has asked for a second page, it is
+    likely to read the whole search, so while it consumes each page after
+    that the next page is fetched in the background, unless `prefetch` is
+    False.
+
+    `page_size` is sent as the `page_size` parameter, for searches whose
+    pages are too small or too large by default.
     """
-    url = "%s/%s/search/" % (settings.IDENTITY_STORE_URL, "identities")
-    params = {search_key: search_value}
     headers = {
         'Authorization': 'Token %s' % settings.IDENTITY_STORE_TOKEN,
         'Content-Type': 'application/json'
     }
-    r = session.get(url, params=params, headers=headers)
-    r.raise_for_status()
-    r = r.json()
+    params = dict(params or {})
+    if page_size:
+        params['page_size'] = page_size
 
+    def fetch(url, params=None):
+        r = session.get(url, params=params, headers=headers)
+        r.raise_for_status()
+        return r.json()
+
+    page = fetch(url, params)
+    next_page = None
     while True:
-        for identity in r.get('results', []):
-            yield identity
-        if r.get('next'):
-            r = session.get(r['next'], headers=headers)
-            r.raise_for_status()
-            r = r.json()
-        else:
+        next_url = page.get('next')
+        for result in page.get('results', []):
+            yield result
+        if not next_url:
             break
+        if next_page:
+            page, deferred = next_page.get()
+            run_deferred(deferred)
+            if isinstance(page, Exception):
+                raise page
+        else:
+            page = fetch(next_url)
+        next_page = None
+        if prefetch and page.get('next'):
+            next_page = get_prefetch_pool().apply_async(
+                call_on_pool, (fetch, page['next']))
+
+
+def search_identities(search_key, search_value):
+    """
+    Returns the identities matching the given parameters
+    FIXME: This should be handled by identity_store_client when
+    it supports pagination
+    """
+    url = "%s/%s/search/" % (settings.IDENTITY_STORE_URL, "identities")
+    return iter_pages(
+        url, {search_key: search_value},
+        page_size=settings.IDENTITY_STORE_SEARCH_PAGE_SIZE)
 
 
 def patch_identity(identity, data):
     """ Patches the given identity with the data provided
     """
-    return identity_store_client.update_identity(identity, data=data)
+    result = identity_store_client.update_identity(identity, data=data)
+    invalidate_identity(identity)
+    return result
 
 
 def create_identity(data):
     """ Creates the identity with the data provided
     """
-    return identity_store_client.create_identity(data)
+    result = identity_store_client.create_identity(data)
+    if result and 'id' in result:
+        invalidate_identity(result['id'])
+    return result
 
 
 def search_optouts(params=None):
@@ -166,28 +772,153 @@ def search_optouts(params=None):
     it supports pagination
     """
     url = "%s/%s/search/" % (settings.IDENTITY_STORE_URL, "optouts")
-    headers = {
-        'Authorization': 'Token %s' % settings.IDENTITY_STORE_TOKEN,
-        'Content-Type': 'application/json'
-    }
-    r = requests.get(url, params=params, headers=headers).json()
-    while True:
-        for optout in r['results']:
-            yield optout
-        if r.get('next'):
-            r = requests.get(r['next'], headers=headers).json()
-        else:
-            break
+    return iter_pages(
+        url, params, page_size=settings.IDENTITY_STORE_SEARCH_PAGE_SIZE)
+
+
+class MessagesetCatalogue(object):
+    """ An in-process catalogue of the Stage Based Messaging messagesets,
+    keyed by id and short_name, and their schedules, keyed by id.
+
+    The whole catalogue is loaded at once, and reloaded by a single thread
+    once it is older than `settings.MESSAGESET_CATALOGUE_TTL` seconds.
+    `version` is incremented every time a reload changes the catalogue.
+    Messagesets and schedules that aren't in the catalogue are fetched and
+    added to it. A TTL of 0 disables the catalogue, and every lookup is
+    fetched.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.version = 0
+        self.loaded_at = None
+        self.failed_at = None
+        self.messagesets = {}
+        self.messagesets_by_short_name = {}
+        self.schedules = {}
+
+    @property
+    def enabled(self):
+        return settings.MESSAGESET_CATALOGUE_TTL > 0
+
+    def is_stale(self):
+        return (self.loaded_at is None or
+                time.time() - self.loaded_at >
+                settings.MESSAGESET_CATALOGUE_TTL)
+
+    def is_backing_off(self):
+        """ Whether the last reload of a loaded catalogue failed within the
+        retry interval, so it shouldn't be tried again yet.
+        """
+        return (self.loaded_at is not None and self.failed_at is not None and
+                time.time() - self.failed_at <
+                settings.MESSAGESET_CATALOGUE_RETRY_INTERVAL)
+
+    def add_messageset(self, messageset):
+        self.messagesets[messageset["id"]] = messageset
+        self.messagesets_by_short_name[messageset["short_name"]] = messageset
+
+    def refresh(self):
+        """ Reloads all the messagesets, and the schedules that they use
+        """
+        messagesets = list(self.client.get_messagesets()["results"])
+        schedules = {}
+        for messageset in messagesets:
+            schedule_id = messageset.get("default_schedule")
+            if schedule_id is not None and schedule_id not in schedules:
+                schedules[schedule_id] = self.client.get_schedule(schedule_id)
+
+        with self.lock:
+            old = (self.messagesets, self.schedules)
+            self.messagesets = {}
+            self.messagesets_by_short_name = {}
+            for messageset in messagesets:
+                self.add_messageset(messageset)
+            self.schedules = schedules
+            if (self.messagesets, self.schedules) != old:
+                self.version += 1
+            self.loaded_at = time.time()
+
+    def ensure_fresh(self):
+        """ Reloads the catalogue if it is stale. Only one thread reloads it
+        at a time, the others keep using the stale catalogue meanwhile, or
+        wait for the reload if the catalogue was never loaded.
+        """
+        if not self.is_stale() or self.is_backing_off():
+            return
+        if not self.refresh_lock.acquire(self.loaded_at is None):
+            return
+        try:
+            if self.is_stale() and not self.is_backing_off():
+                self.refresh()
+                self.failed_at = None
+        except Exception:
+            # Keep serving the previous catalogue until SBM is reachable,
+            # and only try again after the retry interval
+            if self.loaded_at is None:
+                raise
+            self.failed_at = time.time()
+        finally:
+            self.refresh_lock.release()
+
+    def get_messageset_by_short_name(self, short_name):
+        if not self.enabled:
+            return self.fetch_messageset_by_short_name(short_name)
+
+        self.ensure_fresh()
+        messageset = self.messagesets_by_short_name.get(short_name)
+        if messageset is None:
+            messageset = self.fetch_messageset_by_short_name(short_name)
+            with self.lock:
+                self.add_messageset(messageset)
+        return messageset
+
+    def fetch_messageset_by_short_name(self, short_name):
+        params = {'short_name': short_name}
+        r = self.client.get_messagesets(params=params)
+        return next(r["results"])  # messagesets should be unique, return 1st
+
+    def get_messageset(self, messageset_id):
+        if not self.enabled:
+            return self.client.get_messageset(messageset_id)
+
+        self.ensure_fresh()
+        messageset = self.messagesets.get(messageset_id)
+        if messageset is None:
+            messageset = self.client.get_messageset(messageset_id)
+            if messageset is not None:
+                with self.lock:
+                    self.add_messageset(messageset)
+        return messageset
+
+    def get_schedule(self, schedule_id):
+        if not self.enabled:
+            return self.client.get_schedule(schedule_id)
+
+        self.ensure_fresh()
+        schedule = self.schedules.get(schedule_id)
+        if schedule is None:
+            schedule = self.client.get_schedule(schedule_id)
+            if schedule is not None:
+                with self.lock:
+                    self.schedules[schedule_id] = schedule
+        return schedule
+
+
+messageset_catalogue = MessagesetCatalogue(stage_based_messaging_client)
 
 
 def get_messageset_by_shortname(short_name):
-    params = {'short_name': short_name}
-    r = stage_based_messaging_client.get_messagesets(params=params)
-    return next(r["results"])  # messagesets should be unique, return 1st
+    return messageset_catalogue.get_messageset_by_short_name(short_name)
 
 
 def get_messageset(messageset_id):
-    return stage_based_messaging_client.get_messageset(messageset_id)
+    return messageset_catalogue.get_messageset(messageset_id)
 
 
 def search_messagesets(params):
@@ -196,7 +927,11 @@ def search_messagesets(params):
 
 
 def get_schedule(schedule_id):
-    return stage_based_messaging_client.get_schedule(schedule_id)
+    return messageset_catalogue.get_schedule(schedule_id)
+
+
+def get_messageset_languages():
+    return stage_based_messaging_client.get_messageset_languages()
 
 
 def get_subscriptions(identity):
@@ -220,6 +955,15 @@ def patch_subscription(subscription, data):
         subscription["id"], data)
 
 
+def patch_subscriptions(patches, concurrency=None):
+    """ Patches the subscriptions concurrently, given a list of
+    (subscription, data) tuples. Returns the results in the same order, with
+    the exception that was raised for patches that failed.
+    """
+    return fan_out(
+        lambda patch: patch_subscription(*patch), patches, concurrency)
+
+
 def resend_subscription(subscription_id):
     return stage_based_messaging_client.resend_subscription(subscription_id)
 
@@ -7,7 +7,8 @@ from django.template.response import TemplateResponse
 
 from hellomama_registration.utils import get_available_metrics
 from .models import (Source, Registration, SubscriptionRequest,
-                     ThirdPartyRegistrationError)
+                     ThirdPartyRegistrationError, MetricsBackfill)
+from .metrics import UnknownMetricError
 from .tasks import repopulate_metrics
 
 
@@ -31,6 +32,14 @@ class RepopulateMetricsForm(forms.Form):
         self.fields['metric_names'].choices = [(m, m) for m in metrics]
         self.fields['metric_names'].initial = metrics
 
+    def clean_metric_names(self):
+        metric_names = self.cleaned_data['metric_names']
+        try:
+            repopulate_metrics.validate_metric_names(metric_names)
+        except UnknownMetricError as e:
+            raise forms.ValidationError('Unknown metrics: %s' % e)
+        return metric_names
+
 
 class RegistrationAdmin(admin.ModelAdmin):
     list_display = [
@@ -47,8 +56,22 @@ class RegistrationAdmin(admin.ModelAdmin):
                 name='registrations_registration_repopulate_metrics'),
         ] + urls
 
+    def retry_metrics_backfill(self, request, backfill_id):
+        backfill = MetricsBackfill.objects.filter(id=backfill_id).first()
+        if backfill is None:
+            messages.error(request, 'Metrics repopulation not found')
+        else:
+            shards = list(backfill.get_retryable_shards())
+            repopulate_metrics.dispatch_shards(shards)
+            messages.success(
+                request, 'Retrying %s failed or stalled shards' % len(shards))
+        return redirect('admin:registrations_registration_repopulate_metrics')
+
     def repopulate_metrics(self, request):
 
+        if request.method == 'POST' and 'retry_backfill' in request.POST:
+            return self.retry_metrics_backfill(
+                request, request.POST['retry_backfill'])
         if request.method == 'POST':
             form = RepopulateMetricsForm(request.POST)
             if form.is_valid():
@@ -68,6 +91,10 @@ class RegistrationAdmin(admin.ModelAdmin):
             adminform=helpers.AdminForm(
                 form, [(None, {'fields': form.base_fields})],
                 self.get_prepopulated_fields(request)),
+            backfills=[
+                (backfill, backfill.get_progress())
+                for backfill in MetricsBackfill.objects.order_by(
+                    '-created_at')[:5]],
         )
         return TemplateResponse(
             request,
@@ -1,3 +1,4 @@
+import math
 import re
 
 from datetime import datetime, timedelta
@@ -18,6 +19,7 @@ class GraphiteRetention(object):
     }
 
     def __init__(self, retention):
+        self.retention = retention
         precision, duration = retention.split(':')
         self.precision = self._str_to_timedelta(precision)
         self.duration = self._str_to_timedelta(duration)
@@ -49,6 +51,25 @@ class GraphiteRetention(object):
             yield (start, end)
             start = end
 
+    def count_buckets(self, start, finish):
+        """
+        Returns the amount of buckets between start and finish, which is the
+        amount of buckets that get_buckets would return for them.
+        """
+        if start >= finish:
+            return 0
+        return int(math.ceil(
+            (finish - start).total_seconds() /
+            self.precision.total_seconds()))
+
+    def get_bucket(self, start, finish, index):
+        """
+        Returns the tuple (start, end) for the bucket at `index`, for the
+        buckets between start and finish.
+        """
+        bucket_start = start + self.precision * index
+        return (bucket_start, min(bucket_start + self.precision, finish))
+
 
 class RetentionScheme(object):
     """
@@ -79,3 +100,26 @@ class RetentionScheme(object):
                 yield (start, end)
             # The next retention should end where this one started
             finish = beginning
+
+    def get_ranges(self, now=None):
+        """
+        Returns an iterator of tuples (retention, start, finish), the time
+        range that each retention covers. The buckets of each retention over
+        these ranges are the buckets returned by get_buckets.
+
+        kwargs:
+            now: timestamp of current time. Defaults to current time.
+        """
+        if now is None:
+            now = datetime.utcnow()
+        finish = now
+
+        for r in self.retentions:
+            start = now - r.duration
+            if start < finish:
+                yield (r, start, finish)
+                finish = start
+            else:
+                # Matches get_buckets, where a retention without any buckets
+                # doesn't limit the next one
+                finish = now
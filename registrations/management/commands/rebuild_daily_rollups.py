@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from registrations.tasks import rebuild_daily_rollups
+
+
+class Command(BaseCommand):
+    help = ("Rebuilds the daily rollups of registrations and changes for a "
+            "range of days, from the registrations and changes created on "
+            "those days.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--start", dest="start", default=None,
+            help=("The first day to rebuild, as YYYY-MM-DD. Defaults to "
+                  "DAILY_ROLLUP_REBUILD_DAYS days ago."))
+        parser.add_argument(
+            "--end", dest="end", default=None,
+            help="The last day to rebuild, as YYYY-MM-DD. Defaults to today.")
+        parser.add_argument(
+            "--backfill", dest="backfill", action="store_true", default=False,
+            help=("Rebuild from the day of the first registration or change, "
+                  "instead of --start, to fill the rollups for the existing "
+                  "data."))
+
+    def handle(self, *args, **kwargs):
+        result = rebuild_daily_rollups.run(
+            start=kwargs['start'], end=kwargs['end'],
+            backfill=kwargs['backfill'])
+        self.log(self.style.SUCCESS, result)
+
+    def log(self, level, msg):
+        self.stdout.write(level(msg))
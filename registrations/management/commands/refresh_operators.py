@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from registrations.tasks import refresh_operators
+
+
+class Command(BaseCommand):
+    help = ("Refreshes the local table of operators from the identity store. "
+            "Operators that aren't in the table yet are always refreshed.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--max-age", dest="max_age", type=int, default=None,
+            help=("Also refresh operators that were last refreshed more than "
+                  "this many seconds ago. Defaults to the "
+                  "OPERATOR_REFRESH_MAX_AGE setting."))
+        parser.add_argument(
+            "--limit", dest="limit", type=int, default=None,
+            help=("The most operators to refresh, 0 refreshes all of them. "
+                  "Defaults to the OPERATOR_REFRESH_LIMIT setting."))
+
+    def handle(self, *args, **kwargs):
+        result = refresh_operators.run(
+            max_age=kwargs['max_age'], limit=kwargs['limit'])
+        self.log(self.style.SUCCESS, result)
+
+    def log(self, level, msg):
+        self.stdout.write(level(msg))
@@ -0,0 +1,84 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from registrations.models import Registration
+from registrations.tasks import validate_registrations
+from registrations.validation import BatchValidator
+
+
+class Command(BaseCommand):
+    help = ("Validates all the registrations again, in chunks, and saves the "
+            "registrations whose validation result changed. Registrations "
+            "are validated as of the day that they were created.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size", dest="chunk_size", type=int, default=1000,
+            help="The amount of registrations to validate at a time.")
+        parser.add_argument(
+            "--stage", dest="stage", default=None,
+            help="Only validate registrations for this stage.")
+        parser.add_argument(
+            "--dry-run", action="store_true", dest="dry_run", default=False,
+            help="Only report the changes, don't save them.")
+        parser.add_argument(
+            "--create-subscriptions", action="store_true",
+            dest="create_subscriptions", default=False,
+            help=("Queue the creation of subscription requests for "
+                  "registrations that were invalid and are now valid."))
+
+    def handle(self, *args, **kwargs):
+        chunk_size = kwargs['chunk_size']
+        registrations = Registration.objects.order_by('id')
+        if kwargs['stage']:
+            registrations = registrations.filter(stage=kwargs['stage'])
+
+        validator = BatchValidator(as_of_creation=True)
+        total = valid = changed = 0
+        last_id = None
+        while True:
+            chunk = registrations
+            if last_id is not None:
+                chunk = chunk.filter(id__gt=last_id)
+            verdicts = validator.validate(chunk[:chunk_size])
+            if not verdicts:
+                break
+            last_id = verdicts[-1].registration.id
+
+            changed_registrations = []
+            now_valid = []
+            for verdict in verdicts:
+                registration = verdict.registration
+                before = (
+                    registration.validated, dict(registration.data or {}))
+                verdict.apply()
+                if (registration.validated, registration.data) != before:
+                    changed_registrations.append(registration)
+                # Registrations that were already valid have their
+                # subscription requests already
+                if registration.validated and not before[0]:
+                    now_valid.append(str(registration.id))
+                total += 1
+                valid += verdict.valid
+            changed += len(changed_registrations)
+
+            if kwargs['dry_run'] or not changed_registrations:
+                continue
+
+            with transaction.atomic():
+                for registration in changed_registrations:
+                    registration.save(
+                        update_fields=['data', 'validated', 'updated_at'])
+
+            if kwargs['create_subscriptions'] and now_valid:
+                validate_registrations.apply_async(kwargs={
+                    "registration_ids": now_valid,
+                    "as_of_creation": True,
+                })
+
+        self.log(self.style.SUCCESS, (
+            "Validated %s registrations, %s valid, %s changed." % (
+                total, valid, changed)))
+
+    def log(self, level, msg):
+        self.stdout.write(level(msg))
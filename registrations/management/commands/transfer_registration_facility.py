@@ -47,7 +47,7 @@ class Command(BaseCommand):
         updated = 0
         for from_identity in from_identities:
             registrations = Registration.objects.filter(
-                data__operator_id=from_identity).iterator()
+                operator_id=from_identity).iterator()
 
             for registration in registrations:
                 registration.data.update({"operator_id": to_identity})
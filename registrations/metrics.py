@@ -1,111 +1,107 @@
 import pika
+import re
+import time
+from bisect import bisect_right
+from collections import Counter
+from datetime import timedelta
+from django.conf import settings
 from django.db.models import Count
 from django.db.models.expressions import RawSQL
-from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from functools import partial
 
 from hellomama_registration import utils
 
-from .models import Registration, Source, registrations_for_identity_field
+from .models import (
+    DailyRollup, FirstSeenOperator, MetricCounter, Registration, Source,
+    registrations_for_identity_field, registrations_with_operator_field,
+    rollup_day, rollup_day_start, sum_rollups)
 from changes.models import Change
 
 
+class UnknownMetricError(Exception):
+    """
+    Raised for metric names that the MetricGenerator can't generate.
+    """
+
+
 class MetricGenerator(object):
-    def __init__(self):
-        for msg_type in settings.MSG_TYPES:
-            setattr(
-                self, 'registrations_msg_type_{}_sum'.format(msg_type),
-                partial(self.registrations_msg_type_sum, msg_type)
-            )
-            setattr(
-                self, 'registrations_msg_type_{}_total_last'.format(msg_type),
-                partial(self.registrations_msg_type_total_last, msg_type)
-            )
-            setattr(
-                self, 'optout_msg_type_{}_sum'.format(msg_type),
-                partial(self.optout_msg_type_sum, msg_type)
-            )
-            setattr(
-                self, 'optout_msg_type_{}_total_last'.format(msg_type),
-                partial(self.optout_msg_type_total_last, msg_type)
-            )
-        for receiver_type in settings.RECEIVER_TYPES:
-            setattr(
-                self, 'registrations_receiver_type_{}_sum'.format(
-                    receiver_type),
-                partial(self.registrations_receiver_type_sum, receiver_type)
-            )
-            setattr(
-                self, 'registrations_receiver_type_{}_total_last'.format(
-                    receiver_type),
-                partial(
-                    self.registrations_receiver_type_total_last, receiver_type)
-            )
-            setattr(
-                self, 'optout_receiver_type_{}_sum'.format(
-                    receiver_type),
-                partial(
-                    self.optout_receiver_type_sum, receiver_type)
-            )
-            setattr(
-                self, 'optout_receiver_type_{}_total_last'.format(
-                    receiver_type),
-                partial(
-                    self.optout_receiver_type_total_last, receiver_type)
-            )
-        for language in settings.LANGUAGES:
-            setattr(
-                self, 'registrations_language_{}_sum'.format(language),
-                partial(self.registrations_language_sum, language)
-            )
-            setattr(
-                self, 'registrations_language_{}_total_last'.format(language),
-                partial(self.registrations_language_total_last, language)
-            )
-        for state in settings.STATES:
-            setattr(
-                self, 'registrations_state_{}_sum'.format(state),
-                partial(self.registrations_state_sum, state)
-            )
-            setattr(
-                self, 'registrations_state_{}_total_last'.format(state),
-                partial(self.registrations_state_total_last, state)
-            )
-        for role in settings.ROLES:
-            setattr(
-                self, 'registrations_role_{}_sum'.format(role),
-                partial(self.registrations_role_sum, role)
-            )
-            setattr(
-                self, 'registrations_role_{}_total_last'.format(role),
-                partial(self.registrations_role_total_last, role)
-            )
-        for reason in settings.OPTOUT_REASONS:
-            setattr(
-                self, 'optout_reason_{}_sum'.format(reason),
-                partial(self.optout_reason_sum, reason)
-            )
-            setattr(
-                self, 'optout_reason_{}_total_last'.format(reason),
-                partial(self.optout_reason_total_last, reason)
-            )
-        for source in settings.OPTOUT_SOURCES:
-            setattr(
-                self, 'optout_source_{}_sum'.format(source),
-                partial(self.optout_source_sum, source)
-            )
-            setattr(
-                self, 'optout_source_{}_total_last'.format(source),
-                partial(self.optout_source_total_last, source)
-            )
-        sources = Source.objects.all()
-        sources.prefetch_related('user')
-        for source in Source.objects.all():
-            username = source.user.username
-            setattr(
-                self, 'registrations_source_{}_sum'.format(username),
-                partial(self.registrations_source_sum, username)
-            )
+    """
+    Generates metric values for time buckets. A generator should be built
+    once and reused for all the buckets, since building it queries the
+    sources.
+    """
+    # The metrics that are generated by the method of the same name
+    METRICS = (
+        'registrations.created.sum',
+        'registrations.created.total.last',
+        'registrations.unique_operators.sum',
+        'registrations.change.language.sum',
+        'registrations.change.language.total.last',
+        'registrations.change.pregnant_to_baby.sum',
+        'registrations.change.pregnant_to_baby.total.last',
+        'registrations.change.pregnant_to_loss.sum',
+        'registrations.change.pregnant_to_loss.total.last',
+        'registrations.change.messaging.sum',
+        'registrations.change.messaging.total.last',
+    )
+    # The metrics that are generated for every value of a setting, as
+    # (metric name, setting, method)
+    METRIC_FAMILIES = (
+        ('registrations.msg_type.{}.sum', 'MSG_TYPES',
+         'registrations_msg_type_sum'),
+        ('registrations.msg_type.{}.total.last', 'MSG_TYPES',
+         'registrations_msg_type_total_last'),
+        ('optout.msg_type.{}.sum', 'MSG_TYPES', 'optout_msg_type_sum'),
+        ('optout.msg_type.{}.total.last', 'MSG_TYPES',
+         'optout_msg_type_total_last'),
+        ('registrations.receiver_type.{}.sum', 'RECEIVER_TYPES',
+         'registrations_receiver_type_sum'),
+        ('registrations.receiver_type.{}.total.last', 'RECEIVER_TYPES',
+         'registrations_receiver_type_total_last'),
+        ('optout.receiver_type.{}.sum', 'RECEIVER_TYPES',
+         'optout_receiver_type_sum'),
+        ('optout.receiver_type.{}.total.last', 'RECEIVER_TYPES',
+         'optout_receiver_type_total_last'),
+        ('registrations.language.{}.sum', 'LANGUAGES',
+         'registrations_language_sum'),
+        ('registrations.language.{}.total.last', 'LANGUAGES',
+         'registrations_language_total_last'),
+        ('registrations.state.{}.sum', 'STATES', 'registrations_state_sum'),
+        ('registrations.state.{}.total.last', 'STATES',
+         'registrations_state_total_last'),
+        ('registrations.role.{}.sum', 'ROLES', 'registrations_role_sum'),
+        ('registrations.role.{}.total.last', 'ROLES',
+         'registrations_role_total_last'),
+        ('optout.reason.{}.sum', 'OPTOUT_REASONS', 'optout_reason_sum'),
+        ('optout.reason.{}.total.last', 'OPTOUT_REASONS',
+         'optout_reason_total_last'),
+        ('optout.source.{}.sum', 'OPTOUT_SOURCES', 'optout_source_sum'),
+        ('optout.source.{}.total.last', 'OPTOUT_SOURCES',
+         'optout_source_total_last'),
+    )
+
+    def __init__(self, optouts=None):
+        """
+        kwargs:
+            optouts: An OptoutSnapshot to generate the optout metrics from.
+                If not given, the optouts are searched in the identity store
+                for every metric.
+        """
+        self.optouts = optouts
+        # Dispatch table of metric name to function
+        self.functions = dict(
+            (name, getattr(self, name.replace('.', '_')))
+            for name in self.METRICS)
+        for name, values, method in self.METRIC_FAMILIES:
+            for value in getattr(settings, values):
+                self.functions[name.format(value)] = partial(
+                    getattr(self, method), value)
+        for source in Source.objects.select_related('user'):
+            self.functions['registrations.source.{}.sum'.format(
+                source.user.username)] = partial(
+                    self.registrations_source_sum, source.user.username)
 
     def generate_metric(self, name, start, end):
         """
@@ -116,8 +112,31 @@ class MetricGenerator(object):
             start: Datetime for where the metric window starts
             end: Datetime for where the metric window ends
         """
-        metric_func = getattr(self, name.replace('.', '_'))
-        return metric_func(start, end)
+        return self.get_function(name)(start, end)
+
+    def get_function(self, name):
+        """
+        Returns the function that generates the metric, or raises
+        UnknownMetricError.
+        """
+        try:
+            return self.functions[name]
+        except KeyError:
+            raise UnknownMetricError(name)
+
+    def validate_names(self, names):
+        """
+        Checks that all the metrics can be generated, so that unknown names
+        fail before any metrics are generated.
+        """
+        unknown = []
+        for name in names:
+            try:
+                self.get_function(name)
+            except UnknownMetricError:
+                unknown.append(name)
+        if unknown:
+            raise UnknownMetricError(', '.join(unknown))
 
     def registrations_created_sum(self, start, end):
         return Registration.objects\
@@ -131,59 +150,49 @@ class MetricGenerator(object):
             .count()
 
     def registrations_unique_operators_sum(self, start, end):
-        operators_before = Registration.objects\
-            .filter(created_at__lte=start)\
-            .annotate(operator=RawSQL("(data->>%s)", ('operator_id',)))\
-            .values('operator')
-
-        return Registration.objects\
-            .filter(created_at__gt=start)\
-            .filter(created_at__lte=end)\
-            .annotate(operator=RawSQL("(data->>%s)", ('operator_id',)))\
-            .values('operator')\
-            .annotate(count=Count('operator'))\
-            .filter(count=1)\
-            .exclude(operator__in=operators_before)\
+        return FirstSeenOperator.objects\
+            .filter(first_registration_at__gt=start)\
+            .filter(first_registration_at__lte=end)\
             .count()
 
     def registrations_msg_type_sum(self, msg_type, start, end):
         return Registration.objects\
             .filter(created_at__gt=start)\
             .filter(created_at__lte=end)\
-            .filter(data__msg_type=msg_type)\
+            .filter(msg_type=msg_type)\
             .count()
 
     def registrations_msg_type_total_last(self, msg_type, start, end):
         return Registration.objects\
             .filter(created_at__lte=end)\
-            .filter(data__msg_type=msg_type)\
+            .filter(msg_type=msg_type)\
             .count()
 
     def registrations_receiver_type_sum(self, receiver_type, start, end):
         return Registration.objects\
             .filter(created_at__gt=start)\
             .filter(created_at__lte=end)\
-            .filter(data__msg_receiver=receiver_type)\
+            .filter(msg_receiver=receiver_type)\
             .count()
 
     def registrations_receiver_type_total_last(
             self, receiver_type, start, end):
         return Registration.objects\
             .filter(created_at__lte=end)\
-            .filter(data__msg_receiver=receiver_type)\
+            .filter(msg_receiver=receiver_type)\
             .count()
 
     def registrations_language_sum(self, language, start, end):
         return Registration.objects\
             .filter(created_at__gt=start)\
             .filter(created_at__lte=end)\
-            .filter(data__language=language)\
+            .filter(language=language)\
             .count()
 
     def registrations_language_total_last(self, language, start, end):
         return Registration.objects\
             .filter(created_at__lte=end)\
-            .filter(data__language=language)\
+            .filter(language=language)\
             .count()
 
     def registrations_state_sum(self, state, start, end):
@@ -268,6 +277,10 @@ class MetricGenerator(object):
             .count()
 
     def optout_msg_type_sum(self, msg_type, start, end):
+        if self.optouts is not None:
+            return self.optouts.count_registrations(
+                'msg_type', msg_type, start, end)
+
         result = utils.search_optouts({
             "created_at__gt": start,
             "created_at__lte": end,
@@ -277,9 +290,13 @@ class MetricGenerator(object):
 
         return Registration.objects.filter(
                     mother_id__in=identities,
-                    data__msg_type=msg_type).count()
+                    msg_type=msg_type).count()
 
     def optout_msg_type_total_last(self, msg_type, start, end):
+        if self.optouts is not None:
+            return self.optouts.count_registrations(
+                'msg_type', msg_type, None, end)
+
         result = utils.search_optouts({
             "created_at__lte": end,
         })
@@ -288,9 +305,13 @@ class MetricGenerator(object):
 
         return Registration.objects.filter(
                     mother_id__in=identities,
-                    data__msg_type=msg_type).count()
+                    msg_type=msg_type).count()
 
     def optout_receiver_type_sum(self, receiver_type, start, end):
+        if self.optouts is not None:
+            return self.optouts.count_registrations(
+                'msg_receiver', receiver_type, start, end)
+
         result = utils.search_optouts({
             "created_at__gt": start,
             "created_at__lte": end,
@@ -300,9 +321,13 @@ class MetricGenerator(object):
 
         return Registration.objects.filter(
                     mother_id__in=identities,
-                    data__msg_receiver=receiver_type).count()
+                    msg_receiver=receiver_type).count()
 
     def optout_receiver_type_total_last(self, receiver_type, start, end):
+        if self.optouts is not None:
+            return self.optouts.count_registrations(
+                'msg_receiver', receiver_type, None, end)
+
         result = utils.search_optouts({
             "created_at__lte": end,
         })
@@ -311,9 +336,13 @@ class MetricGenerator(object):
 
         return Registration.objects.filter(
                     mother_id__in=identities,
-                    data__msg_receiver=receiver_type).count()
+                    msg_receiver=receiver_type).count()
 
     def optout_reason_sum(self, reason, start, end):
+        if self.optouts is not None:
+            return self.optouts.count_optouts(
+                start, end, reason=reason)
+
         result = utils.search_optouts({
             "reason": reason,
             "created_at__gt": start,
@@ -322,6 +351,10 @@ class MetricGenerator(object):
         return sum(1 for r in result)
 
     def optout_reason_total_last(self, reason, start, end):
+        if self.optouts is not None:
+            return self.optouts.count_optouts(
+                None, end, reason=reason)
+
         result = utils.search_optouts({
             "reason": reason,
             "created_at__lte": end,
@@ -329,6 +362,10 @@ class MetricGenerator(object):
         return sum(1 for r in result)
 
     def optout_source_sum(self, source, start, end):
+        if self.optouts is not None:
+            return self.optouts.count_optouts(
+                start, end, source=source)
+
         result = utils.search_optouts({
             "request_source": source,
             "created_at__gt": start,
@@ -337,6 +374,10 @@ class MetricGenerator(object):
         return sum(1 for r in result)
 
     def optout_source_total_last(self, source, start, end):
+        if self.optouts is not None:
+            return self.optouts.count_optouts(
+                None, end, source=source)
+
         result = utils.search_optouts({
             "request_source": source,
             "created_at__lte": end,
@@ -344,12 +385,527 @@ class MetricGenerator(object):
         return sum(1 for r in result)
 
 
+def to_naive_utc(timestamp):
+    if timezone.is_aware(timestamp):
+        return timezone.make_naive(timestamp, timezone.utc)
+    return timestamp
+
+
+class OptoutSnapshot(object):
+    """
+    A local copy of the optouts in the identity store, so that the optout
+    metrics for many buckets can be generated without searching the optouts
+    for every bucket.
+
+    The optouts are kept in arrays sorted by when they were created, so that
+    the optouts for a time range are found with a binary search. The
+    registrations of the opted out identities are loaded once, in batches.
+    """
+    REGISTRATION_FIELDS = ('msg_type', 'msg_receiver')
+
+    OPTOUT_FIELDS = ('created_at', 'identity', 'reason', 'request_source')
+
+    def __init__(self, optouts):
+        self.optouts = [
+            dict((field, o.get(field)) for field in self.OPTOUT_FIELDS)
+            for o in optouts]
+        optouts = sorted(
+            (to_naive_utc(parse_datetime(o['created_at'])), o['identity'],
+             o['reason'], o['request_source'])
+            for o in self.optouts)
+        self.created_at = [o[0] for o in optouts]
+        self.identities = [o[1] for o in optouts]
+
+        # {('reason' or 'source', value): sorted created_at}
+        self.created_at_by = {}
+        for created_at, _, reason, source in optouts:
+            self.created_at_by.setdefault(
+                ('reason', reason), []).append(created_at)
+            self.created_at_by.setdefault(
+                ('source', source), []).append(created_at)
+
+        # {field: {identity: Counter of registration values}}
+        self.registrations = dict(
+            (field, {}) for field in self.REGISTRATION_FIELDS)
+        # [identity, *REGISTRATION_FIELDS]
+        self.registration_rows = []
+
+    @classmethod
+    def load(cls, batch_size=1000):
+        """
+        Fetches all the optouts from the identity store, and the
+        registrations for the opted out identities.
+        """
+        snapshot = cls(utils.search_optouts())
+        snapshot.load_registrations(batch_size)
+        return snapshot
+
+    def to_data(self):
+        """
+        Returns the snapshot as JSON serialisable data, so that it can be
+        stored and restored with `from_data` without fetching it again.
+        """
+        return {
+            "optouts": self.optouts,
+            "registrations": self.registration_rows,
+        }
+
+    @classmethod
+    def from_data(cls, data):
+        snapshot = cls(data["optouts"])
+        snapshot.add_registrations(data["registrations"])
+        return snapshot
+
+    def load_registrations(self, batch_size=1000):
+        identities = sorted(set(self.identities))
+        for i in range(0, len(identities), batch_size):
+            registrations = Registration.objects\
+                .filter(mother_id__in=identities[i:i + batch_size])\
+                .values_list('mother_id', *self.REGISTRATION_FIELDS)
+            self.add_registrations(registrations)
+
+    def add_registrations(self, rows):
+        for row in rows:
+            row = list(row)
+            self.registration_rows.append(row)
+            for field, value in zip(self.REGISTRATION_FIELDS, row[1:]):
+                self.registrations[field].setdefault(
+                    row[0], Counter())[value] += 1
+
+    def get_range(self, created_at, start, end):
+        """
+        Returns the slice (lo, hi) of the sorted created_at array for the
+        timeframe (start, end]. A start of None includes all the optouts
+        before end.
+        """
+        lo = 0
+        if start is not None:
+            lo = bisect_right(created_at, to_naive_utc(start))
+        hi = bisect_right(created_at, to_naive_utc(end))
+        return (lo, max(lo, hi))
+
+    def count_optouts(self, start, end, reason=None, source=None):
+        """
+        Returns the amount of optouts in the timeframe, optionally only for
+        the given reason or source.
+        """
+        if reason is not None:
+            created_at = self.created_at_by.get(('reason', reason), [])
+        elif source is not None:
+            created_at = self.created_at_by.get(('source', source), [])
+        else:
+            created_at = self.created_at
+        lo, hi = self.get_range(created_at, start, end)
+        return hi - lo
+
+    def count_registrations(self, field, value, start, end):
+        """
+        Returns the amount of registrations, with the given value for the
+        field, of the identities that opted out in the timeframe.
+        """
+        lo, hi = self.get_range(self.created_at, start, end)
+        registrations = self.registrations[field]
+        return sum(
+            registrations[identity][value]
+            for identity in set(self.identities[lo:hi])
+            if identity in registrations)
+
+
+class MetricSeriesGenerator(object):
+    """
+    Generates the values of all the buckets of a retention for whole families
+    of metrics at once. Each family is calculated with a single query that
+    groups the rows into the buckets, instead of a query per metric per
+    bucket. The `total.last` metrics are the running totals of the bucket
+    counts, seeded with a single count of the rows before the first bucket.
+    With METRICS_USE_DAILY_ROLLUPS, that count is summed from the daily
+    rollups instead, and only the rows of the first bucket's day are
+    counted.
+
+    Only the metrics that the MetricGenerator can generate are generated as
+    part of a family. The others, see `fallback_names`, should be generated
+    per bucket with the MetricGenerator, which rejects the unknown ones.
+    """
+    CHANGE_ACTIONS = {
+        'language': 'change_language',
+        'pregnant_to_baby': 'change_baby',
+        'pregnant_to_loss': 'change_loss',
+        'messaging': 'change_messaging',
+    }
+    # family: daily rollup dimension
+    ROLLUP_DIMENSIONS = {
+        'created': DailyRollup.CREATED,
+        'msg_type': DailyRollup.MSG_TYPE,
+        'receiver_type': DailyRollup.MSG_RECEIVER,
+        'language': DailyRollup.LANGUAGE,
+        'source': DailyRollup.SOURCE,
+        'change': DailyRollup.CHANGE_ACTION,
+        'state': DailyRollup.STATE,
+        'role': DailyRollup.ROLE,
+    }
+    METRIC_RE = re.compile(
+        r'^registrations\.(?:(created|unique_operators)|'
+        r'(msg_type|receiver_type|language|source|change|state|role)\.'
+        r'(\w+))\.'
+        r'(sum|total\.last)$')
+
+    def __init__(self, metric_names, generator=None):
+        """
+        kwargs:
+            generator: The MetricGenerator whose metrics are known. One is
+                built if not given.
+        """
+        if generator is None:
+            generator = MetricGenerator()
+        # family: (queryset, time field, group field)
+        self.families = {
+            'created': (Registration.objects.all(), 'created_at', None),
+            'unique_operators': (
+                FirstSeenOperator.objects.all(), 'first_registration_at',
+                None),
+            'msg_type': (Registration.objects.all(), 'created_at', 'msg_type'),
+            'receiver_type': (
+                Registration.objects.all(), 'created_at', 'msg_receiver'),
+            'language': (Registration.objects.all(), 'created_at', 'language'),
+            'source': (Registration.objects.all(), 'created_at', 'source_id'),
+            'change': (Change.objects.all(), 'created_at', 'action'),
+            'state': (
+                registrations_with_operator_field('state'), 'created_at',
+                'operator_state'),
+            'role': (
+                registrations_with_operator_field('role'), 'created_at',
+                'operator_role'),
+        }
+        self.group_values = {
+            'msg_type': dict((v, v) for v in settings.MSG_TYPES),
+            'receiver_type': dict((v, v) for v in settings.RECEIVER_TYPES),
+            'language': dict((v, v) for v in settings.LANGUAGES),
+            'source': dict(
+                (s.user.username, s.id)
+                for s in Source.objects.select_related('user')),
+            'change': self.CHANGE_ACTIONS,
+            'state': dict((v, v) for v in settings.STATES),
+            'role': dict((v, v) for v in settings.ROLES),
+        }
+
+        # family: [(metric name, group value, whether it is a total)]
+        self.metrics = {}
+        self.fallback_names = []
+        for name in metric_names:
+            family, value, total = (None, None, None)
+            if name in generator.functions:
+                family, value, total = self.parse_name(name)
+            if family is None:
+                self.fallback_names.append(name)
+            else:
+                self.metrics.setdefault(family, []).append(
+                    (name, value, total))
+
+    def parse_name(self, name):
+        """
+        Returns the tuple (family, group value, whether it is a total) for
+        the metric name, or (None, None, None) if the metric doesn't belong
+        to a family.
+        """
+        match = self.METRIC_RE.match(name)
+        if match is None:
+            return (None, None, None)
+        single, family, value, kind = match.groups()
+        total = kind == 'total.last'
+        if single is not None:
+            return (single, None, total)
+        value = self.group_values[family].get(value)
+        if value is None:
+            return (None, None, None)
+        return (family, value, total)
+
+    def get_queryset(self, family):
+        """
+        Returns the tuple (queryset, time field, group field) for the
+        family, with the queryset limited to the family's group values.
+        """
+        queryset, time_field, group_field = self.families[family]
+        if group_field is not None:
+            queryset = queryset.filter(**{
+                '%s__in' % group_field: list(set(
+                    value for _, value, _ in self.metrics[family]))})
+        return queryset, time_field, group_field
+
+    def get_base_counts(self, family, start):
+        """
+        Returns a dictionary {group value: count} for the rows of the family
+        up to and including start.
+        """
+        queryset, time_field, group_field = self.get_queryset(family)
+        queryset = queryset.filter(**{'%s__lte' % time_field: start})
+        counts = Counter()
+
+        dimension = self.ROLLUP_DIMENSIONS.get(family)
+        if settings.METRICS_USE_DAILY_ROLLUPS and dimension is not None:
+            day = rollup_day(start)
+            rollups = sum_rollups(dimension, end_day=day - timedelta(days=1))
+            for value, count in rollups.items():
+                if group_field is None:
+                    value = None
+                elif family == 'source':
+                    value = int(value)
+                counts[value] += count
+            queryset = queryset.filter(**{
+                '%s__gte' % time_field: rollup_day_start(day)})
+
+        if group_field is None:
+            counts[None] += queryset.count()
+            return dict(counts)
+        rows = queryset.values(group_field)\
+            .annotate(count=Count('pk'))\
+            .order_by()
+        for row in rows:
+            counts[row[group_field]] += row['count']
+        return dict(counts)
+
+    def get_bucket_counts(self, family, retention, start, finish):
+        """
+        Returns a dictionary {(bucket index, group value): count} for the
+        rows of the family between start and finish.
+        """
+        queryset, time_field, group_field = self.get_queryset(family)
+        queryset = queryset.filter(**{
+            '%s__gt' % time_field: start,
+            '%s__lte' % time_field: finish,
+        })
+
+        # Bucket k covers (start + k * precision, start + (k+1) * precision]
+        column = '"%s"."%s"' % (
+            queryset.model._meta.db_table,
+            queryset.model._meta.get_field(time_field).column)
+        bucket = RawSQL(
+            'CEIL((EXTRACT(EPOCH FROM %s) - %%s) / %%s)::integer - 1' % column,
+            (utils.timestamp_to_epoch(start.replace(tzinfo=None)),
+             retention.precision.total_seconds()))
+        fields = ['bucket'] + ([group_field] if group_field else [])
+        rows = queryset.annotate(bucket=bucket)\
+            .values(*fields)\
+            .annotate(count=Count('pk'))\
+            .order_by()
+
+        return dict(
+            ((row['bucket'], row.get(group_field)), row['count'])
+            for row in rows)
+
+    def generate_series(self, retention, start, finish):
+        """
+        Returns an iterator of tuples (name, value, timestamp) for every
+        family metric and every bucket of the retention between start and
+        finish. The timestamp is the middle of the bucket.
+        """
+        if timezone.is_naive(start):
+            start = timezone.make_aware(start, timezone.utc)
+            finish = timezone.make_aware(finish, timezone.utc)
+        num_buckets = retention.count_buckets(start, finish)
+
+        for family, metrics in sorted(self.metrics.items()):
+            metrics = sorted(metrics)
+            counts = self.get_bucket_counts(family, retention, start, finish)
+            totals = {}
+            if any(total for _, _, total in metrics):
+                totals = self.get_base_counts(family, start)
+
+            for index in range(num_buckets):
+                bucket_start, bucket_end = retention.get_bucket(
+                    start, finish, index)
+                timestamp = timezone.make_naive(
+                    bucket_start + (bucket_end - bucket_start) / 2,
+                    timezone.utc)
+                for value in set(totals) | set(v for _, v, _ in metrics):
+                    totals[value] = (
+                        totals.get(value, 0) + counts.get((index, value), 0))
+                for name, value, total in metrics:
+                    if total:
+                        yield (name, totals[value], timestamp)
+                    else:
+                        yield (name, counts.get((index, value), 0), timestamp)
+
+
+class ScheduledMetricGenerator(object):
+    """
+    Generates the scheduled metrics, which are too expensive to calculate
+    for every registration. Each group of metrics is calculated with a
+    single aggregation query, from the totals that are already counted, or
+    with searches on the downstream service that are made concurrently and
+    counted without keeping the results.
+    """
+    GROUPS = (
+        'active_subscriptions', 'registrations_per_facility',
+        'optouts_per_reason')
+
+    def generate_group(self, group):
+        """
+        Returns a dict of metric name to value for all the metrics of the
+        group, or raises UnknownMetricError.
+        """
+        if group not in self.GROUPS:
+            raise UnknownMetricError(group)
+        return getattr(self, group)()
+
+    def active_subscriptions(self):
+        messagesets = list(utils.search_messagesets({}))
+        counts = utils.fan_out(
+            lambda messageset: sum(1 for _ in utils.search_subscriptions(
+                {'active': True, 'messageset': messageset['id']})),
+            messagesets)
+        for count in counts:
+            if isinstance(count, Exception):
+                raise count
+        return dict(
+            ('subscriptions.messageset.%s.active.last' % (
+                utils.normalise_string(messageset['short_name'])), count)
+            for messageset, count in zip(messagesets, counts))
+
+    def registrations_per_facility(self):
+        rows = registrations_with_operator_field('facility_name')\
+            .values('operator_facility_name')\
+            .annotate(count=Count('pk'))\
+            .order_by()
+        metrics = Counter()
+        for row in rows:
+            if row['operator_facility_name']:
+                metrics['registrations.facility.%s.total.last' % (
+                    utils.normalise_string(row['operator_facility_name']),
+                )] += row['count']
+        return dict(metrics)
+
+    def optouts_per_reason(self):
+        """
+        The totals are counted by the optout receivers, so the optouts are
+        only searched for if some of the reasons haven't been counted yet.
+        """
+        names = dict(
+            ('optout.reason.%s.total.last' % reason, reason)
+            for reason in settings.OPTOUT_REASONS)
+        metrics = dict(
+            MetricCounter.objects.filter(name__in=names)
+            .values_list('name', 'value'))
+        if len(metrics) == len(names):
+            return metrics
+
+        counts = Counter(
+            optout.get('reason') if optout.get('reason') in
+            settings.OPTOUT_REASONS else 'other'
+            for optout in utils.search_optouts())
+        for name, reason in names.items():
+            metrics.setdefault(name, counts[reason])
+        return metrics
+
+
+class PublishError(Exception):
+    """
+    Raised when the broker doesn't commit a batch of metrics.
+    """
+
+
+class GraphitePublisher(object):
+    """
+    Publishes metrics to the graphite exchange inside an AMQP transaction,
+    which is committed for every `batch_size` points, and whenever the
+    publisher is flushed. The broker confirms the whole batch when it is
+    committed, instead of every point being persisted or confirmed on its
+    own.
+
+    Each point is published with the metric name as the routing key, as
+    `send_metric` does. With `name_in_body`, the points of a batch are
+    published as one message with a "name value timestamp" line per point,
+    which requires carbon's AMQP_METRIC_NAME_IN_BODY setting.
+    """
+    def __init__(self, amqp_channel, batch_size=500, name_in_body=False):
+        self.channel = amqp_channel
+        self.batch_size = max(1, batch_size)
+        self.name_in_body = name_in_body
+        self.buffer = []
+        self.points = 0
+        self.messages = 0
+        self.started = None
+        self.channel.tx_select()
+
+    def publish(self, name, value, timestamp):
+        """
+        Adds the point to the buffer, and sends the buffer if it is full.
+
+        args:
+            name: The full name of the metric, including the prefix
+            value: The value of the metric
+            timestamp: Unix epoch time of the metric
+        """
+        if self.started is None:
+            self.started = time.time()
+        self.buffer.append((name, float(value), int(timestamp)))
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def get_messages(self):
+        """
+        Returns the (routing key, body) of the messages for the buffered
+        points.
+        """
+        if self.name_in_body:
+            return [('', ''.join(
+                '{} {} {}\n'.format(*point) for point in self.buffer))]
+        return [
+            (name, '{} {}'.format(value, timestamp))
+            for name, value, timestamp in self.buffer]
+
+    def flush(self):
+        """
+        Sends all the buffered points, and commits them, which waits for the
+        broker to confirm them.
+        """
+        if not self.buffer:
+            return
+        messages = self.get_messages()
+        try:
+            for routing_key, body in messages:
+                self.channel.basic_publish(
+                    'graphite', routing_key, body,
+                    pika.BasicProperties(content_type='text/plain'))
+            self.channel.tx_commit()
+        except pika.exceptions.AMQPError as exc:
+            raise PublishError(
+                "Broker did not commit %s metrics: %r" % (
+                    len(self.buffer), exc))
+
+        self.points += len(self.buffer)
+        self.messages += len(messages)
+        self.buffer = []
+
+    def get_throughput(self):
+        """
+        Returns the amount of points and messages sent, and the points sent
+        per second since the first point was published.
+        """
+        seconds = 0.0
+        if self.started is not None:
+            seconds = time.time() - self.started
+        return {
+            "points": self.points,
+            "messages": self.messages,
+            "seconds": seconds,
+            "points_per_second": self.points / seconds if seconds else 0.0,
+        }
+
+
 def send_metric(amqp_channel, prefix, name, value, timestamp):
+    """
+    Sends the metric to graphite. `amqp_channel` can be a channel, or a
+    GraphitePublisher to batch the metric with others.
+    """
     timestamp = utils.timestamp_to_epoch(timestamp)
 
     if prefix:
         name = '{}.{}'.format(prefix, name)
 
+    if isinstance(amqp_channel, GraphitePublisher):
+        amqp_channel.publish(name, value, timestamp)
+        return
+
     amqp_channel.basic_publish(
         'graphite', name, '{} {}'.format(float(value), int(timestamp)),
         pika.BasicProperties(content_type='text/plain', delivery_mode=2))
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-17 10:03
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+# The columns are indexed concurrently by 0020_registration_data_field_indexes,
+# so that the table isn't locked for writes while they are built
+def data_field(name):
+    return migrations.AddField(
+        model_name='registration',
+        name=name,
+        field=models.CharField(editable=False, max_length=255, null=True),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registrations', '0010_metriccounter'),
+    ]
+
+    operations = [
+        data_field('operator_id'),
+        data_field('receiver_id'),
+        data_field('msg_type'),
+        data_field('msg_receiver'),
+        data_field('language'),
+    ]
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-17 10:05
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+BATCH_SIZE = 5000
+
+# Registrations are updated in batches of ids, each batch in its own
+# transaction, so that the table is never locked for long.
+sql = """
+    UPDATE registrations_registration SET
+        operator_id = left(data->>'operator_id', 255),
+        receiver_id = left(data->>'receiver_id', 255),
+        msg_type = left(data->>'msg_type', 255),
+        msg_receiver = left(data->>'msg_receiver', 255),
+        language = left(data->>'language', 255)
+    WHERE id = ANY(%s::uuid[])
+"""
+
+
+def backfill_data_fields(apps, schema_editor):
+    Registration = apps.get_model('registrations', 'Registration')
+    db_alias = schema_editor.connection.alias
+    registrations = Registration.objects.using(db_alias).order_by('id')
+
+    last_id = None
+    while True:
+        batch = registrations
+        if last_id is not None:
+            batch = batch.filter(id__gt=last_id)
+        ids = list(batch.values_list('id', flat=True)[:BATCH_SIZE])
+        if not ids:
+            break
+
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(sql, [[str(id) for id in ids]])
+        last_id = ids[-1]
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('registrations', '0011_registration_data_fields'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            backfill_data_fields, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-17 11:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+backfill_sql = """
+    INSERT INTO registrations_firstseenoperator
+        (operator_id, registration_id, first_registration_at)
+    SELECT DISTINCT ON (operator_id) operator_id, id, created_at
+    FROM registrations_registration
+    WHERE operator_id IS NOT NULL
+    ORDER BY operator_id, created_at
+    ON CONFLICT (operator_id) DO NOTHING
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registrations', '0012_backfill_registration_data_fields'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FirstSeenOperator',
+            fields=[
+                ('operator_id', models.CharField(
+                    max_length=255, primary_key=True, serialize=False)),
+                ('registration_id', models.UUIDField()),
+                ('first_registration_at', models.DateTimeField(
+                    db_index=True)),
+            ],
+        ),
+        migrations.RunSQL(backfill_sql, migrations.RunSQL.noop),
+    ]
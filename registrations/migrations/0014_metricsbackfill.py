@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-17 13:05
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registrations', '0013_firstseenoperator'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MetricsBackfill',
+            fields=[
+                ('id', models.AutoField(
+                    auto_created=True, primary_key=True, serialize=False,
+                    verbose_name='ID')),
+                ('amqp_url', models.CharField(max_length=255)),
+                ('prefix', models.CharField(blank=True, max_length=255)),
+                ('metric_names',
+                 django.contrib.postgres.fields.jsonb.JSONField()),
+                ('graphite_retentions', models.CharField(max_length=255)),
+                ('now', models.DateTimeField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MetricsBackfillShard',
+            fields=[
+                ('id', models.AutoField(
+                    auto_created=True, primary_key=True, serialize=False,
+                    verbose_name='ID')),
+                ('retention', models.CharField(max_length=255)),
+                ('start', models.DateTimeField()),
+                ('finish', models.DateTimeField()),
+                ('status', models.CharField(
+                    choices=[('pending', 'Pending'), ('running', 'Running'),
+                             ('complete', 'Complete'), ('failed', 'Failed')],
+                    db_index=True, default='pending', max_length=10)),
+                ('buckets_total', models.IntegerField()),
+                ('buckets_done', models.IntegerField(default=0)),
+                ('attempts', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('started_at', models.DateTimeField(null=True)),
+                ('completed_at', models.DateTimeField(null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('backfill', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE,
+                    related_name='shards',
+                    to='registrations.MetricsBackfill')),
+            ],
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-17 14:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registrations', '0014_metricsbackfill'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Operator',
+            fields=[
+                ('operator_id', models.CharField(
+                    max_length=255, primary_key=True, serialize=False)),
+                ('state', models.CharField(
+                    db_index=True, max_length=255, null=True)),
+                ('role', models.CharField(
+                    db_index=True, max_length=255, null=True)),
+                ('facility_name', models.CharField(
+                    db_index=True, max_length=255, null=True)),
+                ('personnel_code', models.CharField(
+                    db_index=True, max_length=255, null=True)),
+                ('refreshed_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
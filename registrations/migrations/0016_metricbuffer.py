@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-17 15:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registrations', '0015_operator'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MetricBuffer',
+            fields=[
+                ('name', models.CharField(
+                    max_length=255, primary_key=True, serialize=False)),
+                ('value', models.FloatField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-17 16:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registrations', '0016_metricbuffer'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyRollup',
+            fields=[
+                ('id', models.AutoField(
+                    auto_created=True, primary_key=True, serialize=False,
+                    verbose_name='ID')),
+                ('day', models.DateField()),
+                ('dimension', models.CharField(
+                    choices=[
+                        ('created', 'Registrations created'),
+                        ('source', 'Registrations per source'),
+                        ('msg_type', 'Registrations per message type'),
+                        ('msg_receiver', 'Registrations per message receiver'),
+                        ('language', 'Registrations per language'),
+                        ('state', 'Registrations per operator state'),
+                        ('role', 'Registrations per operator role'),
+                        ('change_action', 'Changes per action'),
+                    ],
+                    max_length=20)),
+                ('value', models.CharField(blank=True, max_length=255)),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailyrollup',
+            unique_together=set([('dimension', 'day', 'value')]),
+        ),
+    ]
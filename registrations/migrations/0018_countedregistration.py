@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-17 18:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+# The metrics of the existing registrations have already been counted
+backfill_sql = """
+    INSERT INTO registrations_countedregistration
+        (registration_id, counted_at)
+    SELECT id, now() FROM registrations_registration
+    ON CONFLICT (registration_id) DO NOTHING
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registrations', '0017_dailyrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CountedRegistration',
+            fields=[
+                ('registration_id', models.UUIDField(
+                    primary_key=True, serialize=False)),
+                ('counted_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.RunSQL(backfill_sql, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-17 19:10
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db import migrations
+
+
+def get_identity_cache_table():
+    cache = settings.CACHES.get('identities', {})
+    if cache.get('BACKEND') == 'django.core.cache.backends.db.DatabaseCache':
+        return cache['LOCATION']
+
+
+def create_identity_cache_table(apps, schema_editor):
+    table = get_identity_cache_table()
+    if table:
+        call_command(
+            'createcachetable', table,
+            database=schema_editor.connection.alias, verbosity=0)
+
+
+def drop_identity_cache_table(apps, schema_editor):
+    table = get_identity_cache_table()
+    if table:
+        schema_editor.execute(
+            "DROP TABLE IF EXISTS %s" % schema_editor.quote_name(table))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registrations', '0018_countedregistration'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            create_identity_cache_table, drop_identity_cache_table),
+    ]
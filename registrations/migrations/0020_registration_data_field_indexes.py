@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-17 19:30
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+FIELDS = (
+    'operator_id', 'receiver_id', 'msg_type', 'msg_receiver', 'language')
+
+
+def data_field_index(name):
+    """ Indexes the column without locking the table for writes. CREATE
+    INDEX CONCURRENTLY can't run in a transaction, so neither can this
+    migration.
+    """
+    index = 'registrations_registration_%s_idx' % name
+    return migrations.SeparateDatabaseAndState(
+        database_operations=[
+            migrations.RunSQL(
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS {0} "
+                "ON registrations_registration ({1})".format(index, name),
+                "DROP INDEX CONCURRENTLY IF EXISTS {0}".format(index)),
+        ],
+        state_operations=[
+            migrations.AlterField(
+                model_name='registration',
+                name=name,
+                field=models.CharField(
+                    db_index=True, editable=False, max_length=255,
+                    null=True),
+            ),
+        ],
+    )
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('registrations', '0019_identity_cache_table'),
+    ]
+
+    operations = [data_field_index(name) for name in FIELDS]
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-17 14:12
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registrations', '0020_registration_data_field_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='metricsbackfill',
+            name='optout_snapshot',
+            field=django.contrib.postgres.fields.jsonb.JSONField(null=True),
+        ),
+    ]
@@ -1,12 +1,17 @@
+import six
 import uuid
-from datetime import datetime
+from collections import Counter
+from datetime import datetime, time, timedelta
 
 from django.contrib.postgres.fields import JSONField
 from django.contrib.auth.models import User
-from django.core.cache import cache
-from django.db import models
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connection, models, transaction
+from django.db.models import Count, Sum
+from django.db.models.expressions import OuterRef, Subquery
 from django.db.models.signals import post_save
 from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 
 
@@ -74,11 +79,73 @@ class Registration(models.Model):
                                    null=True)
     updated_by = models.ForeignKey(User, related_name='registrations_updated',
                                    null=True)
+    # Copies of the most queried keys of `data`, kept in sync on save
+    operator_id = models.CharField(
+        max_length=255, null=True, editable=False, db_index=True)
+    receiver_id = models.CharField(
+        max_length=255, null=True, editable=False, db_index=True)
+    msg_type = models.CharField(
+        max_length=255, null=True, editable=False, db_index=True)
+    msg_receiver = models.CharField(
+        max_length=255, null=True, editable=False, db_index=True)
+    language = models.CharField(
+        max_length=255, null=True, editable=False, db_index=True)
     user = property(lambda self: self.created_by)
 
+    DATA_FIELDS = (
+        'operator_id', 'receiver_id', 'msg_type', 'msg_receiver', 'language')
+
     def __str__(self):
         return str(self.id)
 
+    def sync_data_fields(self):
+        """
+        Copies the values of the keys in DATA_FIELDS from `data` to their
+        columns.
+        """
+        data = self.data or {}
+        for field in self.DATA_FIELDS:
+            value = data.get(field)
+            if value is not None:
+                value = six.text_type(value)[:255]
+            setattr(self, field, value)
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        previous_operator_id = self.operator_id
+        self.sync_data_fields()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'data' in update_fields:
+            kwargs['update_fields'] = set(update_fields).union(
+                self.DATA_FIELDS)
+        # In one transaction, so that the callbacks that post_save queues
+        # with on_commit run once the first seen operator is recorded
+        with transaction.atomic():
+            super(Registration, self).save(*args, **kwargs)
+            if adding or self.operator_id != previous_operator_id:
+                self.record_first_seen_operator()
+
+    def record_first_seen_operator(self):
+        """
+        Records this registration as the operator's first registration, if
+        the operator doesn't have an earlier registration.
+        """
+        if not self.operator_id:
+            return
+
+        table = FirstSeenOperator._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO {0} "
+                "(operator_id, registration_id, first_registration_at) "
+                "VALUES (%s, %s, %s) "
+                "ON CONFLICT (operator_id) DO UPDATE SET "
+                "registration_id = EXCLUDED.registration_id, "
+                "first_registration_at = EXCLUDED.first_registration_at "
+                "WHERE EXCLUDED.first_registration_at < "
+                "{0}.first_registration_at".format(table),
+                [self.operator_id, self.id, self.created_at])
+
     def get_voice_days_and_times(self):
         return self.data.get('voice_days'), self.data.get('voice_times')
 
@@ -122,215 +189,493 @@ class Registration(models.Model):
 @receiver(post_save, sender=Registration)
 def registration_post_save(sender, instance, created, **kwargs):
     """ Post save hook to fire Registration validation task
+
+    Registrations created through `create_registrations` are validated in
+    chunks by that function instead, so they are skipped here.
+
+    The task is only queued once the registration has been committed, so
+    that the worker can always find it.
     """
-    if created:
+    if created and not kwargs.get('bulk'):
         from .tasks import validate_registration
-        validate_registration.apply_async(
-            kwargs={"registration_id": str(instance.id)})
+        registration_id = str(instance.id)
+        transaction.on_commit(lambda: validate_registration.apply_async(
+            kwargs={"registration_id": registration_id}))
 
 
-@receiver(post_save, sender=Registration)
-def fire_created_metric(sender, instance, created, **kwargs):
-    from .tasks import fire_metric
-    if created:
-        fire_metric.apply_async(kwargs={
-            "metric_name": 'registrations.created.sum',
-            "metric_value": 1.0
-        })
+def create_registrations(registrations):
+    """
+    Saves the given unsaved Registration instances in a single transaction.
 
-        total_key = 'registrations.created.total.last'
-        total = get_or_incr_cache(
-            total_key,
-            Registration.objects.count)
-        fire_metric.apply_async(kwargs={
-            'metric_name': total_key,
-            'metric_value': total,
-        })
+    The post_save receivers are fired for every registration, so the end
+    state is the same as saving them one at a time, but validation is
+    enqueued in chunks of `REGISTRATION_VALIDATION_CHUNK_SIZE` once the
+    transaction has been committed.
 
+    :returns: the list of created registrations
+    """
+    from .tasks import validate_registrations
+
+    with transaction.atomic():
+        for registration in registrations:
+            registration.sync_data_fields()
+        registrations = Registration.objects.bulk_create(registrations)
+        for registration in registrations:
+            registration.record_first_seen_operator()
+            post_save.send(
+                sender=Registration, instance=registration, created=True,
+                update_fields=None, raw=False, using=DEFAULT_DB_ALIAS,
+                bulk=True)
+
+        ids = [str(registration.id) for registration in registrations]
+        chunk_size = settings.REGISTRATION_VALIDATION_CHUNK_SIZE
+        for i in range(0, len(ids), chunk_size):
+            chunk = ids[i:i + chunk_size]
+            transaction.on_commit(
+                lambda chunk=chunk: validate_registrations.apply_async(
+                    kwargs={"registration_ids": chunk}))
+
+    return registrations
 
-@receiver(post_save, sender=Registration)
-def fire_source_metric(sender, instance, created, **kwargs):
-    from .tasks import fire_metric
-    if created:
-        fire_metric.apply_async(kwargs={
-            "metric_name": 'registrations.source.%s.sum' % (
-                instance.source.user.username),
-            "metric_value": 1.0
-        })
 
+@python_2_unicode_compatible
+class MetricCounter(models.Model):
+    """ A counter for a `total.last` metric, shared between all processes.
 
-@receiver(post_save, sender=Registration)
-def fire_unique_operator_metric(sender, instance, created, **kwargs):
-    # if registration is made by a new unique user (operator), fire a metric
-    from .tasks import fire_metric
-    if (created and instance.data and instance.data['operator_id'] and
-        Registration.objects.filter(
-            data__operator_id=instance.data['operator_id']).count() == 1):
-        fire_metric.apply_async(kwargs={
-            "metric_name": 'registrations.unique_operators.sum',
-            "metric_value": 1.0
-        })
+    Counters are seeded once from the database, and then incremented
+    atomically, see `get_or_incr_counter`.
+    """
+    name = models.CharField(max_length=255, primary_key=True)
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return "%s: %s" % (self.name, self.value)
 
 
-def get_or_incr_cache(key, func):
+def get_or_incr_counter(name, func):
     """
-    Used to either get a value from the cache, or if the value doesn't exist
-    in the cache, run the function to get a value to use to populate the cache
+    Atomically increments the shared counter called `name`, and returns the
+    new value. If the counter doesn't exist yet, it is created with the value
+    returned by `func`.
     """
-    value = cache.get(key)
-    if value is None:
-        value = func()
-        cache.set(key, value)
-    else:
-        cache.incr(key)
-        value += 1
-    return value
+    table = MetricCounter._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "UPDATE {0} SET value = value + 1 WHERE name = %s "
+            "RETURNING value".format(table), [name])
+        row = cursor.fetchone()
+        if row is None:
+            cursor.execute(
+                "INSERT INTO {0} (name, value) VALUES (%s, %s) "
+                "ON CONFLICT (name) DO UPDATE SET value = {0}.value + 1 "
+                "RETURNING value".format(table), [name, func()])
+            row = cursor.fetchone()
+    return row[0]
 
 
-@receiver(post_save, sender=Registration)
-def fire_message_type_metric(sender, instance, created, **kwargs):
+@python_2_unicode_compatible
+class CountedRegistration(models.Model):
+    """ A registration whose metrics have been added to the shared counters
+    and the daily rollups, so that a rerun of its metrics task doesn't count
+    it again. See `mark_registration_counted`.
     """
-    Fires a metric for each message type of each registration.
+    registration_id = models.UUIDField(primary_key=True)
+    counted_at = models.DateTimeField(auto_now_add=True)
 
-    Fires both a `sum` metric with 1.0 for each registration, as well as a
-    `last` metric with the total amount of registrations for that type.
+    def __str__(self):
+        return "%s: %s" % (self.registration_id, self.counted_at)
+
+
+def mark_registration_counted(registration_id):
+    """
+    Marks the registration as counted, in the current transaction, and
+    returns whether it wasn't counted before.
     """
-    from .tasks import fire_metric, is_valid_msg_type
-    if (created and instance.data and instance.data.get('msg_type') and
-            is_valid_msg_type(instance.data['msg_type'])):
-        msg_type = instance.data['msg_type']
-        fire_metric.apply_async(kwargs={
-            "metric_name": 'registrations.msg_type.%s.sum' % msg_type,
-            "metric_value": 1.0,
-        })
+    table = CountedRegistration._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO {0} (registration_id, counted_at) VALUES (%s, %s) "
+            "ON CONFLICT (registration_id) DO NOTHING "
+            "RETURNING registration_id".format(table),
+            [registration_id, timezone.now()])
+        return cursor.fetchone() is not None
 
-        total_key = 'registrations.msg_type.%s.total.last' % msg_type
-        total = get_or_incr_cache(
-            total_key,
-            Registration.objects.filter(data__msg_type=msg_type).count)
-        fire_metric.apply_async(kwargs={
-            'metric_name': total_key,
-            'metric_value': total,
-        })
 
+@python_2_unicode_compatible
+class Operator(models.Model):
+    """ The details of an operator's identity, kept locally so that the
+    registrations for a state or role can be found with a join instead of
+    searching the identity store. Refreshed by the `refresh_operators` task.
 
-@receiver(post_save, sender=Registration)
-def fire_receiver_type_metric(sender, instance, created, **kwargs):
-    """Fires a metric for each receiver message type of each subscription."""
-    from .tasks import fire_metric, is_valid_msg_receiver
-    if (created and instance.data and instance.data['msg_receiver'] and
-            is_valid_msg_receiver(instance.data['msg_receiver'])):
-        msg_receiver = instance.data['msg_receiver']
-        fire_metric.apply_async(kwargs={
-            "metric_name": 'registrations.receiver_type.%s.sum' % msg_receiver,
-            "metric_value": 1.0,
-        })
-
-        total_key = 'registrations.receiver_type.%s.total.last' % msg_receiver
-        total = get_or_incr_cache(
-            total_key,
-            Registration.objects.filter(data__msg_receiver=msg_receiver).count)
-        fire_metric.apply_async(kwargs={
-            'metric_name': total_key,
-            'metric_value': total,
-        })
+    State and role are normalised, as they are in the metric names.
+    """
+    # identity field: (model field, whether the value is normalised)
+    IDENTITY_FIELDS = {
+        "details__state": ("state", True),
+        "details__role": ("role", True),
+        "details__facility_name": ("facility_name", False),
+        "details__personnel_code": ("personnel_code", False),
+    }
+
+    operator_id = models.CharField(max_length=255, primary_key=True)
+    state = models.CharField(max_length=255, null=True, db_index=True)
+    role = models.CharField(max_length=255, null=True, db_index=True)
+    facility_name = models.CharField(
+        max_length=255, null=True, db_index=True)
+    personnel_code = models.CharField(
+        max_length=255, null=True, db_index=True)
+    refreshed_at = models.DateTimeField(db_index=True)
+
+    @classmethod
+    def update_from_identity(cls, identity):
+        """ Creates or updates the operator from its identity.
+        """
+        from hellomama_registration.utils import normalise_string
+        details = identity.get('details') or {}
+        values = {'refreshed_at': timezone.now()}
+        for key, (field, normalised) in cls.IDENTITY_FIELDS.items():
+            value = details.get(key[len("details__"):])
+            if value and normalised:
+                value = normalise_string(six.text_type(value))
+            values[field] = six.text_type(value)[:255] if value else None
+        operator, _ = cls.objects.update_or_create(
+            operator_id=identity['id'], defaults=values)
+        return operator
 
+    def __str__(self):
+        return self.operator_id
 
-@receiver(post_save, sender=Registration)
-def fire_language_metric(sender, instance, created, **kwargs):
-    """
-    Fires metrics for each language for each subscription, a sum metric for
-    the registrations over time, and a last metric for the total count.
-    """
-    from .tasks import fire_metric, is_valid_lang
-    if (created and instance.data and instance.data.get('language') and
-            is_valid_lang(instance.data['language'])):
-        lang = instance.data['language']
-        fire_metric.apply_async(kwargs={
-            'metric_name': "registrations.language.%s.sum" % lang,
-            'metric_value': 1.0,
-        })
-
-        total_key = "registrations.language.%s.total.last" % lang
-        total = get_or_incr_cache(
-            total_key,
-            Registration.objects.filter(data__language=lang).count)
-        fire_metric.apply_async(kwargs={
-            'metric_name': total_key,
-            'metric_value': total,
-        })
 
+@python_2_unicode_compatible
+class MetricBuffer(models.Model):
+    """ Metric values waiting to be fired, shared between all processes.
 
-def registrations_for_identity_field(search_key, search_value):
-    from hellomama_registration.utils import search_identities
-    identities = search_identities(search_key, search_value)
-    ids = tuple(data['id'] for data in identities)
+    `sum` metrics are added together, and for `last` metrics only the latest
+    value is kept. See `buffer_metrics` and `pop_buffered_metrics`.
+    """
+    name = models.CharField(max_length=255, primary_key=True)
+    value = models.FloatField()
+
+    def __str__(self):
+        return "%s: %s" % (self.name, self.value)
+
+
+def buffer_metrics(metrics, replace_last=True):
+    """
+    Adds the metrics, a dict of metric name to value, to the buffer in a
+    single statement. If `replace_last` is False, buffered `last` values
+    are kept instead of being replaced.
+    """
+    if not metrics:
+        return
+    table = MetricBuffer._meta.db_table
+    names = sorted(metrics)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO {table} (name, value) VALUES {values} "
+            "ON CONFLICT (name) DO UPDATE SET value = CASE "
+            "WHEN EXCLUDED.name LIKE '%%.last' THEN {last} "
+            "ELSE {table}.value + EXCLUDED.value END".format(
+                table=table,
+                values=", ".join(["(%s, %s)"] * len(names)),
+                last="EXCLUDED.value" if replace_last else table + ".value"),
+            [v for name in names for v in (name, float(metrics[name]))])
+
+
+def pop_buffered_metrics():
+    """
+    Removes all the metrics from the buffer, and returns them as a dict of
+    metric name to value.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "DELETE FROM {0} RETURNING name, value".format(
+                MetricBuffer._meta.db_table))
+        return dict(cursor.fetchall())
 
+
+def registrations_for_identity_field(search_key, search_value):
+    """
+    Returns the registrations made by the operators whose identity has the
+    value for the field, eg. "details__state", from the Operator table.
+    """
+    from hellomama_registration.utils import normalise_string
+    field, normalised = Operator.IDENTITY_FIELDS[search_key]
+    if normalised:
+        search_value = normalise_string(search_value)
+    operators = Operator.objects.filter(**{field: search_value})
     return Registration.objects.filter(
-        data__operator_id__in=ids)
+        operator_id__in=operators.values('operator_id'))
 
 
-@receiver(post_save, sender=Registration)
-def fire_state_metric(sender, instance, created, **kwargs):
-    """
-    Fires metrics for each state for each subscription, a sum metric for
-    the registrations over time, and a last metric for the total count.
-    """
-    from .tasks import fire_metric, is_valid_state
-    from hellomama_registration.utils import get_identity, normalise_string
-    if (created and instance.data and instance.data['operator_id']):
-        identity = get_identity(instance.data['operator_id'])
-        if (identity.get('details') and identity['details'].get('state') and
-                is_valid_state(normalise_string(
-                    identity['details']['state']))):
-            state = identity['details']['state']
-            normalised_state = normalise_string(state)
-            fire_metric.apply_async(kwargs={
-                'metric_name': "registrations.state.%s.sum" % normalised_state,
-                'metric_value': 1.0,
-            })
-
-            total_key = "registrations.state.%s.total.last" % normalised_state
-
-            total = get_or_incr_cache(
-                total_key,
-                registrations_for_identity_field(
-                    "details__state", state).count)
-            fire_metric.apply_async(kwargs={
-                'metric_name': total_key,
-                'metric_value': total,
-            })
+def registrations_with_operator_field(field):
+    """
+    Returns the registrations annotated with the field of their operator,
+    eg. "state", from the Operator table, as `operator_<field>`.
+    """
+    operator = Operator.objects.filter(operator_id=OuterRef('operator_id'))
+    return Registration.objects.annotate(**{
+        'operator_%s' % field: Subquery(operator.values(field)[:1])})
+
+
+@python_2_unicode_compatible
+class DailyRollup(models.Model):
+    """ The amount of registrations and changes created on a day (UTC) for
+    one value of a dimension, so that counts over long time ranges can be
+    summed from a few rows instead of counting every registration.
+
+    Rollups are incremented by `rollup_registration` and `rollup_change` as
+    rows are created, and can be rebuilt for any range of days with
+    `rebuild_rollups`. The `created` dimension has a single, empty, value.
+    """
+    CREATED = 'created'
+    SOURCE = 'source'
+    MSG_TYPE = 'msg_type'
+    MSG_RECEIVER = 'msg_receiver'
+    LANGUAGE = 'language'
+    STATE = 'state'
+    ROLE = 'role'
+    CHANGE_ACTION = 'change_action'
+    DIMENSION_CHOICES = (
+        (CREATED, "Registrations created"),
+        (SOURCE, "Registrations per source"),
+        (MSG_TYPE, "Registrations per message type"),
+        (MSG_RECEIVER, "Registrations per message receiver"),
+        (LANGUAGE, "Registrations per language"),
+        (STATE, "Registrations per operator state"),
+        (ROLE, "Registrations per operator role"),
+        (CHANGE_ACTION, "Changes per action"),
+    )
+
+    day = models.DateField()
+    dimension = models.CharField(max_length=20, choices=DIMENSION_CHOICES)
+    value = models.CharField(max_length=255, blank=True)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = (('dimension', 'day', 'value'),)
+
+    def __str__(self):
+        return "%s %s %s: %s" % (
+            self.day, self.dimension, self.value, self.count)
+
+
+def rollup_day(timestamp):
+    """
+    Returns the day, in UTC, that the timestamp is rolled up into.
+    """
+    return timezone.localtime(timestamp, timezone.utc).date()
+
+
+def rollup_day_start(day):
+    """
+    Returns the timestamp of the start of the day, in UTC.
+    """
+    return timezone.make_aware(datetime.combine(day, time.min), timezone.utc)
+
+
+# The class id of the advisory locks of the days being rolled up
+ROLLUP_LOCK_ID = 7265
+
+
+def lock_rollup_day(cursor, day, shared=False):
+    """
+    Locks the day's rollups until the end of the transaction. Increments
+    take a shared lock, so that they only wait for a rebuild of the same
+    day, which takes an exclusive lock.
+    """
+    cursor.execute(
+        "SELECT pg_advisory_xact_lock{0}(%s, %s)".format(
+            "_shared" if shared else ""),
+        [ROLLUP_LOCK_ID, day.toordinal()])
+
+
+def increment_rollups(day, dimensions):
+    """
+    Adds one to the rollup of the day for each (dimension, value) in
+    `dimensions`, in a single statement. Must be called in the transaction
+    that creates the rows being rolled up, so that a rebuild of the day
+    either counts them or waits for them to be incremented.
+    """
+    counts = Counter(dimensions)
+    if not counts:
+        return
+    keys = sorted(counts)
+    table = DailyRollup._meta.db_table
+    with connection.cursor() as cursor:
+        lock_rollup_day(cursor, day, shared=True)
+        cursor.execute(
+            "INSERT INTO {table} (day, dimension, value, count) "
+            "VALUES {values} "
+            "ON CONFLICT (dimension, day, value) DO UPDATE SET "
+            "count = {table}.count + EXCLUDED.count".format(
+                table=table,
+                values=", ".join(["(%s, %s, %s, %s)"] * len(keys))),
+            [v for key in keys for v in (day, key[0], key[1], counts[key])])
+
+
+def get_registration_dimensions(registration):
+    """
+    Returns the list of (dimension, value) that the registration is rolled
+    up into, with the state and role of its operator from the Operator
+    table.
+    """
+    dimensions = [
+        (DailyRollup.CREATED, ''),
+        (DailyRollup.SOURCE, six.text_type(registration.source_id)),
+    ]
+    for field in (DailyRollup.MSG_TYPE, DailyRollup.MSG_RECEIVER,
+                  DailyRollup.LANGUAGE):
+        value = getattr(registration, field)
+        if value:
+            dimensions.append((field, value))
+    if registration.operator_id:
+        operator = Operator.objects\
+            .filter(operator_id=registration.operator_id)\
+            .values(DailyRollup.STATE, DailyRollup.ROLE)\
+            .first() or {}
+        for field in (DailyRollup.STATE, DailyRollup.ROLE):
+            if operator.get(field):
+                dimensions.append((field, operator[field]))
+    return dimensions
+
+
+def rollup_registration(registration):
+    """
+    Adds a newly created registration to the daily rollups.
+    """
+    increment_rollups(
+        rollup_day(registration.created_at),
+        get_registration_dimensions(registration))
+
+
+def rollup_change(change):
+    """
+    Adds a newly created change to the daily rollups.
+    """
+    increment_rollups(
+        rollup_day(change.created_at),
+        [(DailyRollup.CHANGE_ACTION, change.action)])
+
+
+def rebuild_rollups(start_day, end_day, dimensions=None):
+    """
+    Replaces the rollups of the days from start_day to end_day, inclusive,
+    with the counts of the registrations and changes created on those days,
+    using a grouped query per dimension. Only the given dimensions are
+    rebuilt, if any are given.
+
+    Only registrations that have been counted, see `CountedRegistration`,
+    are included, as the others are still to be added by their metrics
+    task. Each day is rebuilt in its own transaction, with the day locked,
+    so that rollups incremented in the meantime wait for the rebuild of
+    their day instead of being replaced by it.
+
+    :returns: the amount of rollups created
+    """
+    from changes.models import Change
+    counted = Registration.objects.filter(
+        id__in=CountedRegistration.objects.values('registration_id'))
+    # (dimension, queryset, group field)
+    groups = (
+        (DailyRollup.CREATED, counted, None),
+        (DailyRollup.SOURCE, counted, 'source_id'),
+        (DailyRollup.MSG_TYPE, counted, 'msg_type'),
+        (DailyRollup.MSG_RECEIVER, counted, 'msg_receiver'),
+        (DailyRollup.LANGUAGE, counted, 'language'),
+        (DailyRollup.STATE,
+         registrations_with_operator_field('state').filter(
+             id__in=counted.values('id')),
+         'operator_state'),
+        (DailyRollup.ROLE,
+         registrations_with_operator_field('role').filter(
+             id__in=counted.values('id')),
+         'operator_role'),
+        (DailyRollup.CHANGE_ACTION, Change.objects.all(), 'action'),
+    )
+    if dimensions is not None:
+        groups = [group for group in groups if group[0] in dimensions]
+
+    total = 0
+    day = start_day
+    while day <= end_day:
+        created = {
+            'created_at__gte': rollup_day_start(day),
+            'created_at__lt': rollup_day_start(day + timedelta(days=1)),
+        }
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                lock_rollup_day(cursor, day)
+            DailyRollup.objects\
+                .filter(day=day, dimension__in=[g[0] for g in groups])\
+                .delete()
+
+            rollups = []
+            for dimension, queryset, field in groups:
+                queryset = queryset.filter(**created)
+                if field is None:
+                    rows = [{'count': queryset.count()}]
+                else:
+                    rows = queryset.values(field)\
+                        .annotate(count=Count('pk'))\
+                        .order_by()
+                for row in rows:
+                    if field and not row[field] or not row['count']:
+                        continue
+                    rollups.append(DailyRollup(
+                        day=day, dimension=dimension,
+                        value=six.text_type(row[field]) if field else '',
+                        count=row['count']))
+            DailyRollup.objects.bulk_create(rollups)
+        total += len(rollups)
+        day += timedelta(days=1)
+    return total
+
+
+def sum_rollups(dimension, start_day=None, end_day=None):
+    """
+    Returns a dict {value: count} for the dimension, summed over the
+    rollups from start_day to end_day, inclusive. Without a start_day or
+    end_day the range is open on that side.
+    """
+    rollups = DailyRollup.objects.filter(dimension=dimension)
+    if start_day is not None:
+        rollups = rollups.filter(day__gte=start_day)
+    if end_day is not None:
+        rollups = rollups.filter(day__lte=end_day)
+    rows = rollups.values('value').annotate(count=Sum('count')).order_by()
+    return dict((row['value'], row['count']) for row in rows)
+
+
+@python_2_unicode_compatible
+class FirstSeenOperator(models.Model):
+    """ The first registration made by each operator, used to count the new
+    unique operators. Maintained by `Registration.record_first_seen_operator`.
+    """
+    operator_id = models.CharField(max_length=255, primary_key=True)
+    registration_id = models.UUIDField()
+    first_registration_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return "%s: %s" % (self.operator_id, self.first_registration_at)
 
 
 @receiver(post_save, sender=Registration)
-def fire_role_metric(sender, instance, created, **kwargs):
-    """
-    Fires metrics for each role for each subscription, a sum metric for
-    the registrations over time, and a last metric for the total count.
-    """
-    from .tasks import fire_metric, is_valid_role
-    from hellomama_registration.utils import get_identity, normalise_string
-    if (created and instance.data and instance.data['operator_id']):
-        identity = get_identity(instance.data['operator_id'])
-        if (identity.get('details') and identity['details'].get('role') and
-                is_valid_role(normalise_string(
-                    identity['details']['role']))):
-            role = identity['details']['role']
-            normalised_role = normalise_string(role)
-            fire_metric.apply_async(kwargs={
-                'metric_name': "registrations.role.%s.sum" % normalised_role,
-                'metric_value': 1.0,
-            })
-
-            total_key = "registrations.role.%s.total.last" % normalised_role
-
-            total = get_or_incr_cache(
-                total_key,
-                registrations_for_identity_field("details__role", role).count)
-            fire_metric.apply_async(kwargs={
-                'metric_name': total_key,
-                'metric_value': total,
-            })
+def fire_registration_metrics(sender, instance, created, **kwargs):
+    """
+    Queues the calculation of the metrics for a newly created registration.
+
+    The metrics depend on the operator's identity, so they are calculated in
+    a task rather than here, to keep identity store requests out of the
+    registration request.
+    """
+    if created:
+        from .tasks import calculate_registration_metrics
+        registration_id = str(instance.id)
+        transaction.on_commit(
+            lambda: calculate_registration_metrics.apply_async(kwargs={
+                "registration_id": registration_id,
+            }))
 
 
 @python_2_unicode_compatible
@@ -386,3 +731,137 @@ class ThirdPartyRegistrationError(models.Model):
 
     def __str__(self):
         return str(self.id)
+
+
+@python_2_unicode_compatible
+class MetricsBackfill(models.Model):
+    """ A repopulation of historical metrics. The time range of every
+    retention is split into shards, which are run in parallel and can be
+    retried on their own. The optouts are fetched once, and stored for the
+    shards to generate the optout metrics from.
+    """
+    amqp_url = models.CharField(max_length=255)
+    prefix = models.CharField(max_length=255, blank=True)
+    metric_names = JSONField()
+    graphite_retentions = models.CharField(max_length=255)
+    now = models.DateTimeField()
+    # OptoutSnapshot.to_data, fetched once for all the shards
+    optout_snapshot = JSONField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def create_shards(self, shard_size):
+        """
+        Creates shards of at most `shard_size` buckets, covering the buckets
+        of all the retentions.
+        """
+        from .graphite import RetentionScheme
+        now = timezone.make_naive(self.now, timezone.utc)
+        shards = []
+        ret = RetentionScheme(self.graphite_retentions)
+        for retention, start, finish in ret.get_ranges(now=now):
+            num_buckets = retention.count_buckets(start, finish)
+            for i in range(0, num_buckets, shard_size):
+                shard_start = retention.get_bucket(start, finish, i)[0]
+                shard_end = retention.get_bucket(
+                    start, finish, min(i + shard_size, num_buckets) - 1)[1]
+                shards.append(MetricsBackfillShard(
+                    backfill=self,
+                    retention=retention.retention,
+                    start=timezone.make_aware(shard_start, timezone.utc),
+                    finish=timezone.make_aware(shard_end, timezone.utc),
+                    buckets_total=min(shard_size, num_buckets - i)))
+        return MetricsBackfillShard.objects.bulk_create(shards)
+
+    def get_stalled_before(self, now=None):
+        """
+        Returns the time before which a running shard that hasn't been
+        updated is stalled, eg. because its worker was lost.
+        """
+        return (now or timezone.now()) - timedelta(
+            seconds=settings.REPOPULATE_METRICS_SHARD_TIMEOUT)
+
+    def get_retryable_shards(self, now=None):
+        """
+        Returns the shards that can be retried, which are the failed shards,
+        and the running shards that have stalled.
+        """
+        return self.shards.filter(
+            models.Q(status=MetricsBackfillShard.FAILED) |
+            models.Q(status=MetricsBackfillShard.RUNNING,
+                     updated_at__lt=self.get_stalled_before(now)))
+
+    def get_progress(self, now=None):
+        """
+        Returns the progress of the backfill, with an estimate of the time
+        remaining, based on the rate that buckets have been completed at.
+        """
+        shards = list(self.shards.all())
+        statuses = [s.status for s in shards]
+        stalled_before = self.get_stalled_before(now)
+        total = sum(s.buckets_total for s in shards)
+        done = sum(s.buckets_done for s in shards)
+        started = [s.started_at for s in shards if s.started_at is not None]
+
+        eta = None
+        if started and 0 < done < total:
+            elapsed = (now or timezone.now()) - min(started)
+            eta = timedelta(
+                seconds=int(elapsed.total_seconds() * (total - done) / done))
+        return {
+            "shards": len(shards),
+            "complete": statuses.count(MetricsBackfillShard.COMPLETE),
+            "failed": statuses.count(MetricsBackfillShard.FAILED),
+            "stalled": len([
+                s for s in shards if s.status == MetricsBackfillShard.RUNNING
+                and s.updated_at < stalled_before]),
+            "buckets_total": total,
+            "buckets_done": done,
+            "percentage": int(100 * done / total) if total else 100,
+            "eta": eta,
+        }
+
+    def __str__(self):
+        return "%s (%s)" % (self.graphite_retentions, self.created_at)
+
+
+@python_2_unicode_compatible
+class MetricsBackfillShard(models.Model):
+    """ The metrics for the buckets of one retention between start and
+    finish. `buckets_done` is the checkpoint that a retried shard resumes
+    from.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    COMPLETE = 'complete'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (COMPLETE, "Complete"),
+        (FAILED, "Failed"),
+    )
+
+    backfill = models.ForeignKey(
+        MetricsBackfill, related_name='shards', on_delete=models.CASCADE)
+    retention = models.CharField(max_length=255)
+    start = models.DateTimeField()
+    finish = models.DateTimeField()
+    status = models.CharField(
+        max_length=10, choices=STATUS_CHOICES, default=PENDING,
+        db_index=True)
+    buckets_total = models.IntegerField()
+    buckets_done = models.IntegerField(default=0)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    started_at = models.DateTimeField(null=True)
+    completed_at = models.DateTimeField(null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def set_status(self, status, **fields):
+        fields['status'] = status
+        for name, value in fields.items():
+            setattr(self, name, value)
+        self.save(update_fields=list(fields) + ['updated_at'])
+
+    def __str__(self):
+        return "%s %s - %s" % (self.retention, self.start, self.finish)
@@ -1,63 +1,49 @@
 import json
 import requests
 import uuid
-from datetime import datetime
+
+from datetime import timedelta
 
 import pika
+from celery import group as celery_group
 from celery.task import Task
 from celery.utils.log import get_task_logger
 from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Min
+from django.db.models.signals import post_save
+from django.utils import timezone
+from django.utils.dateparse import parse_date
 from seed_services_client.metrics import MetricsApiClient
 from openpyxl import load_workbook
 from io import BytesIO
 from collections import defaultdict
 
+from changes.models import Change
 from hellomama_registration import utils
-from .graphite import RetentionScheme
+from .graphite import GraphiteRetention
 from .models import (Registration, SubscriptionRequest, Source,
-                     ThirdPartyRegistrationError)
-from .metrics import MetricGenerator, send_metric
+                     ThirdPartyRegistrationError, DailyRollup,
+                     FirstSeenOperator,
+                     MetricCounter, MetricsBackfill, MetricsBackfillShard,
+                     Operator,
+                     buffer_metrics, get_or_incr_counter,
+                     mark_registration_counted,
+                     pop_buffered_metrics, rebuild_rollups,
+                     registrations_for_identity_field, rollup_day,
+                     rollup_registration)
+from .metrics import (
+    GraphitePublisher, MetricGenerator, MetricSeriesGenerator, OptoutSnapshot,
+    ScheduledMetricGenerator, send_metric)
 from .serializers import RegistrationSerializer
+from .validation import (  # noqa
+    BatchValidator, is_valid_date, is_valid_uuid, is_valid_lang,
+    is_valid_msg_type, is_valid_msg_receiver, is_valid_loss_reason,
+    is_valid_state, is_valid_role)
 
 logger = get_task_logger(__name__)
 
 
-def is_valid_date(date):
-    try:
-        datetime.strptime(date, "%Y%m%d")
-        return True
-    except:
-        return False
-
-
-def is_valid_uuid(id):
-    return len(id) == 36 and id[14] == '4' and id[19] in ['a', 'b', '8', '9']
-
-
-def is_valid_lang(lang):
-    return lang in settings.LANGUAGES
-
-
-def is_valid_msg_type(msg_type):
-    return msg_type in settings.MSG_TYPES
-
-
-def is_valid_msg_receiver(msg_receiver):
-    return msg_receiver in settings.RECEIVER_TYPES
-
-
-def is_valid_loss_reason(loss_reason):
-    return loss_reason in ['miscarriage', 'stillborn', 'baby_died']
-
-
-def is_valid_state(state):
-    return state in settings.STATES
-
-
-def is_valid_role(role):
-    return role in settings.ROLES
-
-
 class ValidateRegistration(Task):
     """ Task to validate a registration model entry's registration
     data.
@@ -65,150 +51,16 @@ class ValidateRegistration(Task):
     name = "hellomama_registration.registrations.tasks.validate_registration"
 
     def check_field_values(self, fields, registration_data):
-        failures = []
-        for field in fields:
-            if field in ["receiver_id", "operator_id"]:
-                if not is_valid_uuid(registration_data[field]):
-                    failures.append(field)
-            if field == "language":
-                if not is_valid_lang(registration_data[field]):
-                    failures.append(field)
-            if field == "msg_type":
-                if not is_valid_msg_type(registration_data[field]):
-                    failures.append(field)
-            if field in ["last_period_date", "baby_dob"]:
-                if not is_valid_date(registration_data[field]):
-                    failures.append(field)
-                elif field == "last_period_date":
-                    # Check last_period_date is in valid week range
-                    preg_weeks = utils.calc_pregnancy_week_lmp(
-                        utils.get_today(), registration_data[field])
-                    if not (settings.PREBIRTH_MIN_WEEKS <= preg_weeks <=
-                            settings.PREBIRTH_MAX_WEEKS):
-                        failures.append("last_period_date out of range")
-                elif field == "baby_dob":
-                    # Check baby_dob is in valid week range
-                    preg_weeks = utils.calc_baby_age(
-                        utils.get_today(), registration_data[field])
-                    if not (settings.POSTBIRTH_MIN_WEEKS <= preg_weeks <=
-                            settings.POSTBIRTH_MAX_WEEKS):
-                        failures.append("baby_dob out of range")
-            if field == "msg_receiver":
-                if not is_valid_msg_receiver(registration_data[field]):
-                    failures.append(field)
-            if field == "loss_reason":
-                if not is_valid_loss_reason(registration_data[field]):
-                    failures.append(field)
-        return failures
+        return BatchValidator().check_fields(fields, registration_data)
 
     def validate(self, registration):
         """ Validates that all the required info is provided for a
-        registration.
+        registration. The result is only set on the registration, it is not
+        saved.
         """
-        data_fields = registration.data.keys()
-        fields_general = ["receiver_id", "operator_id",
-                          "language", "msg_type"]
-        fields_prebirth = ["last_period_date", "msg_receiver"]
-        fields_postbirth = ["baby_dob", "msg_receiver"]
-        fields_loss = ["loss_reason"]
-
-        hw_pre = list(set(fields_general) | set(fields_prebirth))
-        hw_post = list(set(fields_general) | set(fields_postbirth))
-        pbl_loss = list(set(fields_general) | set(fields_loss))
-
-        # Check if mother_id is a valid UUID
-        if not is_valid_uuid(registration.mother_id):
-            registration.data["invalid_fields"] = "Invalid UUID mother_id"
-            registration.save()
-            return False
-
-        if "msg_receiver" in registration.data.keys():
-            # Reject registrations on behalf of mother that does not have a
-            # unique id for the mother
-            if (registration.data["msg_receiver"] in [
-                "father_only", "friend_only", "family_only"] and
-               registration.mother_id == registration.data["receiver_id"]):
-                registration.data["invalid_fields"] = "mother requires own id"
-                registration.save()
-                return False
-            # Reject registrations where the mother is the receiver but the
-            # mother_id and receiver_id differs
-            elif (registration.data["msg_receiver"] == "mother_only" and
-                  registration.mother_id != registration.data["receiver_id"]):
-                registration.data["invalid_fields"] = "mother_id should be " \
-                    "the same as receiver_id"
-                registration.save()
-                return False
-
-        # HW registration, prebirth
-        if (registration.stage == "prebirth" and
-                registration.source.authority in ["hw_limited", "hw_full"] and
-                set(hw_pre).issubset(data_fields)):  # ignore extra data
-
-            invalid_fields = self.check_field_values(
-                hw_pre, registration.data)
-            if invalid_fields == []:
-                registration.data["reg_type"] = "hw_pre"
-                registration.data["preg_week"] = utils.calc_pregnancy_week_lmp(
-                    utils.get_today(), registration.data["last_period_date"])
-                registration.validated = True
-                registration.save()
-                return True
-            else:
-                registration.data["invalid_fields"] = invalid_fields
-                registration.save()
-                return False
-        # HW registration, postbirth
-        elif (registration.stage == "postbirth" and
-              registration.source.authority in ["hw_limited", "hw_full"] and
-              set(hw_post).issubset(data_fields)):
-            invalid_fields = self.check_field_values(
-                hw_post, registration.data)
-            if invalid_fields == []:
-                registration.data["reg_type"] = "hw_post"
-                registration.data["baby_age"] = utils.calc_baby_age(
-                    utils.get_today(), registration.data["baby_dob"])
-                registration.validated = True
-                registration.save()
-                return True
-            else:
-                registration.data["invalid_fields"] = invalid_fields
-                registration.save()
-                return False
-        # Loss registration
-        elif (registration.stage == "loss" and
-              registration.source.authority in ["patient", "advisor"] and
-              set(pbl_loss).issubset(data_fields)):
-            invalid_fields = self.check_field_values(
-                pbl_loss, registration.data)
-            if invalid_fields == []:
-                registration.data["reg_type"] = "pbl_loss"
-                registration.validated = True
-                registration.save()
-                return True
-            else:
-                registration.data["invalid_fields"] = invalid_fields
-                registration.save()
-                return False
-        # Public Registration
-        elif (registration.stage == "public" and
-                set(fields_general).issubset(data_fields)):
-            invalid_fields = self.check_field_values(
-                fields_general, registration.data)
-            if invalid_fields == []:
-                registration.data["reg_type"] = "public"
-                registration.validated = True
-                registration.save()
-                return True
-            else:
-                registration.data["invalid_fields"] = invalid_fields
-                registration.save()
-                return False
-        else:
-            registration.data[
-                "invalid_fields"] = "Invalid combination of fields"
-            registration.save()
-            return False
+        [verdict] = BatchValidator().validate([registration])
+        verdict.apply()
+        return verdict.valid
 
     def stop_public_subscriptions(self, registration):
         if registration.stage != 'public':
@@ -216,14 +68,19 @@ class ValidateRegistration(Task):
                 {"identity": registration.mother_id, "completed": False,
                  "active": True, "messageset_contains": "public.mother"})
 
-            def deactivate_subscription(sub):
-                metadata = sub['metadata']
-                metadata['converted_full'] = 'true'
-                utils.patch_subscription(
-                    sub, {"metadata": metadata, "active": False})
+            def deactivate_subscriptions(subscriptions):
+                patches = []
+                for sub in subscriptions:
+                    metadata = sub['metadata']
+                    metadata['converted_full'] = 'true'
+                    patches.append(
+                        (sub, {"metadata": metadata, "active": False}))
+
+                for result in utils.patch_subscriptions(patches):
+                    if isinstance(result, Exception):
+                        raise result
 
-            for subscription in subscriptions:
-                deactivate_subscription(subscription)
+            deactivate_subscriptions(subscriptions)
 
             registrations = Registration.objects.filter(
                 mother_id=registration.mother_id, stage='public',
@@ -238,13 +95,45 @@ class ValidateRegistration(Task):
                          "messageset_contains": "public.household",
                          "active": True})
 
-                    for subscription in subscriptions:
-                        deactivate_subscription(subscription)
+                    deactivate_subscriptions(subscriptions)
 
     def create_subscriptionrequests(self, registration):
         """ Create SubscriptionRequest(s) based on the
         validated registration.
         """
+        subscription_requests, welcome_messages = \
+            self.plan_subscriptionrequests(registration)
+        with transaction.atomic():
+            self.save_subscriptionrequests(subscription_requests)
+            transaction.on_commit(
+                lambda: self.send_welcome_messages(welcome_messages))
+
+        if len(subscription_requests) == 2:
+            return "2 SubscriptionRequests created"
+        return "1 SubscriptionRequest created"
+
+    def save_subscriptionrequests(self, subscription_requests):
+        """ Saves the SubscriptionRequests in a single query. post_save is
+        sent for each of them, so that the webhooks still fire.
+        """
+        subscription_requests = SubscriptionRequest.objects.bulk_create(
+            subscription_requests)
+        for subscription_request in subscription_requests:
+            post_save.send(
+                sender=SubscriptionRequest, instance=subscription_request,
+                created=True, update_fields=None, raw=False,
+                using=DEFAULT_DB_ALIAS)
+
+    def send_welcome_messages(self, welcome_messages):
+        for payload in welcome_messages:
+            utils.post_message(payload)
+
+    def plan_subscriptionrequests(self, registration):
+        """ Returns the unsaved SubscriptionRequest(s) for the validated
+        registration, and the payloads of the welcome messages to send once
+        they have been saved.
+        """
+        welcome_messages = []
 
         voice_days, voice_times = registration.get_voice_days_and_times()
 
@@ -278,7 +167,7 @@ class ValidateRegistration(Task):
                     "content": settings.MOTHER_WELCOME_TEXT_NG_ENG,
                     "metadata": {}
                 }
-                utils.post_message(payload)
+                welcome_messages.append(payload)
 
             if registration.data["msg_receiver"] != 'mother_only':
                 payload = {
@@ -286,7 +175,7 @@ class ValidateRegistration(Task):
                     "content": settings.MOTHER_WELCOME_TEXT_NG_ENG,
                     "metadata": {}
                 }
-                utils.post_message(payload)
+                welcome_messages.append(payload)
 
         elif 'voice_days' in registration.data and \
                 registration.data["voice_days"] != "":
@@ -308,9 +197,9 @@ class ValidateRegistration(Task):
                 "content": settings.MOTHER_WELCOME_TEXT_NG_ENG,
                 "metadata": {}
             }
-            utils.post_message(payload)
+            welcome_messages.append(payload)
 
-        SubscriptionRequest.objects.create(**mother_sub)
+        subscription_requests = [SubscriptionRequest(**mother_sub)]
 
         if registration.data["msg_receiver"] != 'mother_only':
             weeks = None
@@ -346,10 +235,28 @@ class ValidateRegistration(Task):
                 "%s/static/audio/registration/%s_welcome_household.mp3" % (
                 settings.PUBLIC_HOST,
                 registration.data["language"])
-            SubscriptionRequest.objects.create(**household_sub)
-            return "2 SubscriptionRequests created"
+            subscription_requests.append(SubscriptionRequest(**household_sub))
 
-        return "1 SubscriptionRequest created"
+        return subscription_requests, welcome_messages
+
+    def complete(self, registration, reg_validates):
+        """ Creates the SubscriptionRequests for a validated registration,
+        and saves the registration and the requests in a single transaction.
+        The welcome messages are only sent once the transaction has been
+        committed, so that a failed save doesn't send them twice.
+        """
+        subscription_requests = welcome_messages = []
+        if reg_validates:
+            self.stop_public_subscriptions(registration)
+            subscription_requests, welcome_messages = \
+                self.plan_subscriptionrequests(registration)
+
+        with transaction.atomic():
+            registration.save(
+                update_fields=['data', 'validated', 'updated_at'])
+            self.save_subscriptionrequests(subscription_requests)
+            transaction.on_commit(
+                lambda: self.send_welcome_messages(welcome_messages))
 
     def run(self, registration_id, **kwargs):
         """ Sets the registration's validated field to True if
@@ -357,13 +264,13 @@ class ValidateRegistration(Task):
         """
         l = self.get_logger(**kwargs)
         l.info("Looking up the registration")
-        registration = Registration.objects.get(id=registration_id)
+        registration = Registration.objects.select_related('source').get(
+            id=registration_id)
         reg_validates = self.validate(registration)
+        self.complete(registration, reg_validates)
 
         validation_string = "Validation completed - "
         if reg_validates:
-            self.stop_public_subscriptions(registration)
-            self.create_subscriptionrequests(registration)
             validation_string += "Success"
         else:
             validation_string += "Failure"
@@ -373,6 +280,48 @@ class ValidateRegistration(Task):
 validate_registration = ValidateRegistration()
 
 
+class ValidateRegistrations(Task):
+    """ Task to validate a chunk of registrations, used for registrations
+    that were created in bulk, and for revalidated registrations. With
+    `as_of_creation` the registrations are validated as of the day that they
+    were created, instead of today.
+    """
+    name = "registrations.tasks.validate_registrations"
+    default_retry_delay = 60
+    max_retries = 5
+
+    def run(self, registration_ids, as_of_creation=False, **kwargs):
+        registrations = Registration.objects.filter(id__in=registration_ids)
+        validator = BatchValidator(as_of_creation=as_of_creation)
+        succeeded = 0
+        failed = []
+        error = None
+        for verdict in validator.validate(registrations):
+            try:
+                verdict.apply()
+                validate_registration.complete(
+                    verdict.registration, verdict.valid)
+                succeeded += 1
+            except Exception as exc:
+                # One bad registration shouldn't stop the rest of the chunk
+                logger.exception(
+                    "Validation of registration %s failed",
+                    verdict.registration.id)
+                failed.append(str(verdict.registration.id))
+                error = exc
+
+        if failed:
+            # Nothing is saved for a failed registration, so it is retried,
+            # eg. after a downstream outage, instead of staying unvalidated
+            raise self.retry(kwargs={
+                "registration_ids": failed,
+                "as_of_creation": as_of_creation,
+            }, exc=error)
+        return "Validated %s registrations" % (succeeded,)
+
+validate_registrations = ValidateRegistrations()
+
+
 class DeliverHook(Task):
     def run(self, target, payload, instance_id=None, hook_id=None, **kwargs):
         """
@@ -427,6 +376,339 @@ class FireMetric(Task):
 fire_metric = FireMetric()
 
 
+class FireMetrics(Task):
+
+    """ Fires many metrics in a single call using the MetricsApiClient
+    """
+    name = "registrations.tasks.fire_metrics"
+
+    def run(self, metrics, session=None, **kwargs):
+        metrics = dict(
+            (name, float(value)) for name, value in metrics.items())
+        metric_client = get_metric_client(session=session)
+        metric_client.fire_metrics(**metrics)
+        return "Fired %s metrics" % (len(metrics),)
+
+fire_metrics = FireMetrics()
+
+
+def queue_metrics(metrics):
+    """
+    Fires the metrics, a dict of metric name to value. With
+    METRICS_AGGREGATE they are added to the shared buffer, to be fired by
+    the next flush_metrics, otherwise they are all fired by a single task.
+    """
+    if settings.METRICS_AGGREGATE:
+        buffer_metrics(metrics)
+    elif metrics:
+        fire_metrics.apply_async(kwargs={"metrics": metrics})
+
+
+def queue_metric(metric_name, metric_value):
+    queue_metrics({metric_name: metric_value})
+
+
+class ScheduledMetrics(Task):
+
+    """ Calculates the groups of scheduled metrics in
+    METRICS_SCHEDULED_TASKS, and fires them in a single call using the
+    MetricsApiClient. A group that can't be calculated is logged and
+    skipped, so that the other groups are still fired.
+    """
+    name = "registrations.tasks.scheduled_metrics"
+
+    def run(self, session=None, **kwargs):
+        generator = ScheduledMetricGenerator()
+        metrics = {}
+        errors = 0
+        for group in settings.METRICS_SCHEDULED_TASKS:
+            try:
+                metrics.update(generator.generate_group(group))
+            except Exception:
+                logger.exception(
+                    "Unable to calculate the scheduled metrics %s" % group)
+                errors += 1
+
+        if metrics:
+            fire_metrics.run(metrics, session=session)
+        return "Fired %s scheduled metrics, %s errors" % (
+            len(metrics), errors)
+
+scheduled_metrics = ScheduledMetrics()
+
+
+class FlushMetrics(Task):
+
+    """ Fires all the buffered metrics in a single call using the
+    MetricsApiClient. Scheduled to run every METRICS_FLUSH_INTERVAL seconds.
+    """
+    name = "registrations.tasks.flush_metrics"
+
+    def run(self, session=None, **kwargs):
+        metrics = pop_buffered_metrics()
+        if not metrics:
+            return "Fired 0 metrics"
+        try:
+            return fire_metrics.run(metrics, session=session)
+        except Exception:
+            # Put the metrics back for the next flush, without replacing any
+            # newer totals
+            buffer_metrics(metrics, replace_last=False)
+            raise
+
+flush_metrics = FlushMetrics()
+
+
+class CalculateRegistrationMetrics(Task):
+
+    """ Calculates all the metrics for a newly created registration, and
+    fires them in a single call using the MetricsApiClient. The operator's
+    identity is fetched at most once.
+
+    The registration is marked as counted in the same transaction that
+    increments its counters and rollups, so a rerun of the task doesn't
+    count it twice.
+    """
+    name = "registrations.tasks.calculate_registration_metrics"
+
+    def get_operator_identity(self, instance):
+        """
+        Returns the identity of the registration's operator, or None if it
+        doesn't have one, and updates the Operator table with it.
+        """
+        operator_id = (instance.data or {}).get('operator_id')
+        if not operator_id:
+            return None
+        identity = utils.get_identity(operator_id) or {}
+        if identity.get('id'):
+            Operator.update_from_identity(identity)
+        return identity
+
+    def get_metrics(self, instance, operator_identity=None):
+        """
+        Builds the metrics for a newly created registration, with the state
+        and role of the operator from `operator_identity`.
+
+        For each dimension of the registration (message type, receiver type,
+        language, and the state and role of the operator) there is a `sum`
+        metric with a value of 1.0, and a `last` metric with the total amount
+        of registrations for that dimension.
+
+        :returns: dict of metric name to metric value
+        """
+        data = instance.data or {}
+        metrics = {}
+
+        metrics['registrations.created.sum'] = 1.0
+        total_key = 'registrations.created.total.last'
+        metrics[total_key] = get_or_incr_counter(
+            total_key,
+            Registration.objects.count)
+
+        metrics['registrations.source.%s.sum' % (
+            instance.source.user.username)] = 1.0
+
+        operator_id = data.get('operator_id')
+        # The upsert only replaces a later registration, so recording it
+        # again is safe, and covers callbacks run before the save committed
+        instance.record_first_seen_operator()
+        # if registration is made by a new unique user (operator)
+        if (operator_id and FirstSeenOperator.objects.filter(
+                operator_id=operator_id,
+                registration_id=instance.id).exists()):
+            metrics['registrations.unique_operators.sum'] = 1.0
+
+        dimensions = (
+            ('msg_type', 'msg_type', is_valid_msg_type),
+            ('msg_receiver', 'receiver_type', is_valid_msg_receiver),
+            ('language', 'language', is_valid_lang),
+        )
+        for field, metric, is_valid in dimensions:
+            value = data.get(field)
+            if not value or not is_valid(value):
+                continue
+            metrics['registrations.%s.%s.sum' % (metric, value)] = 1.0
+            total_key = 'registrations.%s.%s.total.last' % (metric, value)
+            metrics[total_key] = get_or_incr_counter(
+                total_key,
+                Registration.objects.filter(
+                    **{field: value}).count)
+
+        if operator_identity:
+            details = operator_identity.get('details') or {}
+            dimensions = (
+                ('state', is_valid_state),
+                ('role', is_valid_role),
+            )
+            for field, is_valid in dimensions:
+                value = details.get(field)
+                if not value:
+                    continue
+                normalised = utils.normalise_string(value)
+                if not is_valid(normalised):
+                    continue
+                metrics['registrations.%s.%s.sum' % (field, normalised)] = 1.0
+                total_key = 'registrations.%s.%s.total.last' % (
+                    field, normalised)
+                metrics[total_key] = get_or_incr_counter(
+                    total_key,
+                    registrations_for_identity_field(
+                        "details__%s" % field, value).count)
+
+        return metrics
+
+    def run(self, registration_id, session=None, **kwargs):
+        registration = Registration.objects.select_related(
+            'source__user').get(id=registration_id)
+        # Before the counters are locked, and so that the operator's state
+        # and role are known for the rollups
+        operator_identity = self.get_operator_identity(registration)
+        with transaction.atomic():
+            if not mark_registration_counted(registration.id):
+                return "Metrics for registration %s were already counted" % (
+                    registration_id,)
+            metrics = self.get_metrics(registration, operator_identity)
+            rollup_registration(registration)
+        if settings.METRICS_AGGREGATE:
+            buffer_metrics(metrics)
+            return "Buffered %s metrics" % (len(metrics),)
+        return fire_metrics.run(metrics, session=session)
+
+calculate_registration_metrics = CalculateRegistrationMetrics()
+
+
+class RefreshOperators(Task):
+    """
+    Refreshes the Operator table from the identity store, for operators that
+    aren't in the table yet, and for operators that were last refreshed more
+    than `max_age` seconds ago. At most `limit` operators are refreshed per
+    run, the new ones first and then the least recently refreshed, or all of
+    them if `limit` is 0.
+
+    If the state or role of any operators changed, the shared counters and
+    the daily rollups of the states and roles involved are recalculated, as
+    they were counted without those operators.
+    """
+    name = "registrations.tasks.refresh_operators"
+
+    def get_operator_ids(self, max_age, limit=0):
+        new = FirstSeenOperator.objects.exclude(
+            operator_id__in=Operator.objects.values('operator_id'))\
+            .order_by('first_registration_at')
+        if limit:
+            new = new[:limit]
+        operator_ids = list(new.values_list('operator_id', flat=True))
+        if max_age is not None and not (limit and len(operator_ids) >= limit):
+            stale = Operator.objects.filter(
+                refreshed_at__lt=timezone.now() - timedelta(seconds=max_age))\
+                .order_by('refreshed_at')
+            if limit:
+                stale = stale[:limit - len(operator_ids)]
+            operator_ids.extend(stale.values_list('operator_id', flat=True))
+        return operator_ids
+
+    def reseed_counters(self, dimensions):
+        """
+        Resets the shared `total.last` counters of the (field, value)
+        dimensions, eg. ("state", "ebonyi"), to the current counts.
+        """
+        for field, value in dimensions:
+            name = 'registrations.%s.%s.total.last' % (field, value)
+            MetricCounter.objects.filter(name=name).update(
+                value=registrations_for_identity_field(
+                    "details__%s" % field, value).count())
+
+    def rebuild_operator_rollups(self, operator_ids):
+        """
+        Rebuilds the state and role rollups of only the days that the
+        operators made registrations on.
+        """
+        days = Registration.objects\
+            .filter(operator_id__in=operator_ids)\
+            .datetimes('created_at', 'day', tzinfo=timezone.utc)
+        for day in days:
+            rebuild_rollups(
+                rollup_day(day), rollup_day(day),
+                dimensions=(DailyRollup.STATE, DailyRollup.ROLE))
+
+    def run(self, max_age=None, limit=None, **kwargs):
+        if max_age is None:
+            max_age = settings.OPERATOR_REFRESH_MAX_AGE
+        if limit is None:
+            limit = settings.OPERATOR_REFRESH_LIMIT
+        refreshed = errors = 0
+        operator_ids = self.get_operator_ids(max_age, limit)
+        previous = dict(
+            (o['operator_id'], o) for o in Operator.objects
+            .filter(operator_id__in=operator_ids)
+            .values('operator_id', 'state', 'role'))
+        changed = set()
+        dimensions = set()
+        for operator_id in operator_ids:
+            utils.invalidate_identity(operator_id)
+        identities = utils.get_identities(operator_ids)
+        for operator_id, identity in zip(operator_ids, identities):
+            if isinstance(identity, Exception):
+                # eg. demands' HTTPServiceError for a 5xx, which shouldn't
+                # stop the other operators from being refreshed
+                logger.error("Unable to refresh operator %s: %r" % (
+                    operator_id, identity))
+                errors += 1
+                continue
+            if identity is None:
+                errors += 1
+                continue
+            operator = Operator.update_from_identity(identity)
+            refreshed += 1
+            old = previous.get(operator_id, {})
+            for field in ('state', 'role'):
+                values = (old.get(field), getattr(operator, field))
+                if values[0] != values[1]:
+                    changed.add(operator_id)
+                    dimensions.update(
+                        (field, value) for value in values if value)
+
+        if changed:
+            self.reseed_counters(dimensions)
+            self.rebuild_operator_rollups(changed)
+        return "Refreshed %s operators, %s errors" % (refreshed, errors)
+
+refresh_operators = RefreshOperators()
+
+
+class RebuildDailyRollups(Task):
+    """
+    Rebuilds the daily rollups from start to end, inclusive, given as ISO
+    dates. By default, the last `DAILY_ROLLUP_REBUILD_DAYS` days are
+    rebuilt, to correct rollups that drifted from the counted registrations
+    and the changes. With `backfill`, the rollups are rebuilt from the day of
+    the first registration or change, to fill them for the existing data.
+    """
+    name = "registrations.tasks.rebuild_daily_rollups"
+
+    def get_first_day(self):
+        firsts = [
+            model.objects.aggregate(first=Min('created_at'))['first']
+            for model in (Registration, Change)]
+        firsts = [first for first in firsts if first is not None]
+        return rollup_day(min(firsts)) if firsts else None
+
+    def run(self, start=None, end=None, backfill=False, **kwargs):
+        today = rollup_day(timezone.now())
+        end = parse_date(end) if end else today
+        if backfill:
+            start = self.get_first_day()
+            if start is None:
+                return "No registrations or changes to rebuild rollups for"
+        else:
+            start = parse_date(start) if start else (
+                today - timedelta(days=settings.DAILY_ROLLUP_REBUILD_DAYS - 1))
+        created = rebuild_rollups(start, end)
+        return "Rebuilt %s rollups from %s to %s" % (created, start, end)
+
+rebuild_daily_rollups = RebuildDailyRollups()
+
+
 class RepopulateMetrics(Task):
     """
     Repopulates historical metrics.
@@ -434,12 +716,14 @@ class RepopulateMetrics(Task):
     name = 'registrations.tasks.repopulate_metrics'
 
     def generate_and_send(
-            self, amqp_url, prefix, metric_name, start, end):
+            self, amqp_url, prefix, metric_name, start, end, generator=None):
         """
         Generates the value for the specified metric, and sends it.
         """
+        if generator is None:
+            generator = MetricGenerator()
         try:
-            value = MetricGenerator().generate_metric(metric_name, start, end)
+            value = generator.generate_metric(metric_name, start, end)
         except requests.exceptions.RequestException:
             # If we have an issue contacting an external service for this
             # metric, just skip it.
@@ -452,22 +736,143 @@ class RepopulateMetrics(Task):
         timestamp = start + (end - start) / 2
         send_metric(amqp_url, prefix, metric_name, value, timestamp)
 
+    def get_optout_snapshot(self, metric_names):
+        """
+        Fetches the optouts once for all the optout metrics. Returns None if
+        there are no optout metrics, or if the optouts can't be fetched, in
+        which case they are searched for every bucket instead.
+        """
+        if not any(name.startswith('optout.') for name in metric_names):
+            return None
+        try:
+            return OptoutSnapshot.load()
+        except (requests.exceptions.RequestException, ValueError):
+            logger.exception("Unable to fetch the optouts snapshot")
+            return None
+
+    def dispatch_shards(self, shards):
+        """
+        Runs the shards in parallel on the workers.
+        """
+        return celery_group(
+            repopulate_metrics_shard.s(shard_id=shard.id)
+            for shard in shards).apply_async()
+
+    def validate_metric_names(self, metric_names):
+        """
+        Raises UnknownMetricError if any of the metrics can't be generated,
+        otherwise returns the MetricSeriesGenerator for the metrics.
+        """
+        generator = MetricGenerator()
+        series = MetricSeriesGenerator(metric_names, generator=generator)
+        generator.validate_names(series.fallback_names)
+        return series
+
     def run(
             self, amqp_url, prefix, metric_names, graphite_retentions,
             **kwargs):
-        parameters = pika.URLParameters(amqp_url)
-        connection = pika.BlockingConnection(parameters)
-        amqp_channel = connection.channel()
+        series = self.validate_metric_names(metric_names)
+        optouts = self.get_optout_snapshot(series.fallback_names)
+        if optouts is not None:
+            optouts = optouts.to_data()
+        backfill = MetricsBackfill.objects.create(
+            amqp_url=amqp_url, prefix=prefix, metric_names=metric_names,
+            graphite_retentions=graphite_retentions,
+            now=timezone.now().replace(microsecond=0),
+            optout_snapshot=optouts)
+        shards = backfill.create_shards(
+            settings.REPOPULATE_METRICS_SHARD_SIZE)
+        self.dispatch_shards(shards)
+        return backfill.id
+
+repopulate_metrics = RepopulateMetrics()
 
-        ret = RetentionScheme(graphite_retentions)
-        for start, end in ret.get_buckets():
-            for metric in metric_names:
-                self.generate_and_send(
-                    amqp_channel, prefix, metric, start, end)
 
-        connection.close()
+class RepopulateMetricsShard(Task):
+    """
+    Repopulates the historical metrics for one shard of a backfill.
 
-repopulate_metrics = RepopulateMetrics()
+    Metric families are generated with a single query for the shard, the
+    rest are generated one bucket at a time, checkpointing after every
+    bucket so that a retried shard resumes where it failed. The optout
+    metrics are generated from the backfill's optout snapshot.
+    """
+    name = 'registrations.tasks.repopulate_metrics_shard'
+    default_retry_delay = 60
+    max_retries = 3
+
+    def send_metrics(self, publisher, shard):
+        backfill = shard.backfill
+        retention = GraphiteRetention(shard.retention)
+        start = timezone.make_naive(shard.start, timezone.utc)
+        finish = timezone.make_naive(shard.finish, timezone.utc)
+        optouts = None
+        if backfill.optout_snapshot is not None:
+            optouts = OptoutSnapshot.from_data(backfill.optout_snapshot)
+        generator = MetricGenerator(optouts=optouts)
+        series = MetricSeriesGenerator(
+            backfill.metric_names, generator=generator)
+
+        if shard.buckets_done == 0:
+            for name, value, timestamp in series.generate_series(
+                    retention, start, finish):
+                send_metric(publisher, backfill.prefix, name, value, timestamp)
+            publisher.flush()
+        if not series.fallback_names:
+            return
+
+        for index in range(shard.buckets_done, shard.buckets_total):
+            bucket_start, bucket_end = retention.get_bucket(
+                start, finish, index)
+            for metric in series.fallback_names:
+                repopulate_metrics.generate_and_send(
+                    publisher, backfill.prefix, metric, bucket_start,
+                    bucket_end, generator=generator)
+            # The bucket is only checkpointed once it has been confirmed
+            publisher.flush()
+            MetricsBackfillShard.objects.filter(id=shard.id).update(
+                buckets_done=index + 1, updated_at=timezone.now())
+
+    def run(self, shard_id, **kwargs):
+        shard = MetricsBackfillShard.objects.select_related('backfill')\
+            .get(id=shard_id)
+        if shard.status == MetricsBackfillShard.COMPLETE:
+            return
+        shard.set_status(
+            MetricsBackfillShard.RUNNING, attempts=shard.attempts + 1,
+            started_at=shard.started_at or timezone.now())
+
+        try:
+            parameters = pika.URLParameters(shard.backfill.amqp_url)
+            connection = pika.BlockingConnection(parameters)
+            try:
+                publisher = GraphitePublisher(
+                    connection.channel(),
+                    batch_size=settings.METRICS_AMQP_BATCH_SIZE,
+                    name_in_body=settings.METRICS_AMQP_NAME_IN_BODY)
+                self.send_metrics(publisher, shard)
+            finally:
+                connection.close()
+        except Exception as exc:
+            if self.request.retries < self.max_retries:
+                # Only failed once celery stops retrying it, so that it
+                # can't be retried from the admin at the same time
+                shard.set_status(MetricsBackfillShard.PENDING, error=repr(exc))
+                raise self.retry(exc=exc)
+            shard.set_status(MetricsBackfillShard.FAILED, error=repr(exc))
+            raise
+
+        shard.set_status(
+            MetricsBackfillShard.COMPLETE, buckets_done=shard.buckets_total,
+            error='', completed_at=timezone.now())
+        throughput = publisher.get_throughput()
+        logger.info(
+            "Sent %s metrics in %s messages for shard %s (%.1f/s)" % (
+                throughput['points'], throughput['messages'], shard_id,
+                throughput['points_per_second']))
+        return throughput
+
+repopulate_metrics_shard = RepopulateMetricsShard()
 
 
 class AlreadySubscribedError(Exception):
@@ -9,7 +9,10 @@ try:
 except ImportError:
     from io import StringIO
 
+from datetime import datetime
+
 from django.core import management
+from django.utils.timezone import utc
 
 from .models import Registration, SubscriptionRequest
 from .tests import AuthenticatedAPITestCase, REG_DATA
@@ -284,3 +287,99 @@ class UpdateInitialSequenceCommand(AuthenticatedAPITestCase):
         self.assertEqual(stdout.getvalue().strip(),
                          'Subscription not found: mother00-9d89-4aa6-99ff-'
                          '13c225365b5d\nUpdated 0 subscriptions.')
+
+
+class RevalidateRegistrationsCommand(AuthenticatedAPITestCase):
+    def make_registration(self, data, validated):
+        registration = Registration.objects.create(
+            stage="prebirth",
+            mother_id="mother00-9d89-4aa6-99ff-13c225365b5d",
+            data=data, validated=validated,
+            source=self.make_source_adminuser())
+        # Validate the registration as of when the dates were valid
+        Registration.objects.filter(id=registration.id).update(
+            created_at=datetime(2015, 8, 17, tzinfo=utc))
+        return registration
+
+    @mock.patch("registrations.tasks.validate_registrations.apply_async")
+    def test_revalidate_registrations(self, mock_validation):
+        stdout = StringIO()
+        # Valid, but marked as invalid
+        registration1 = self.make_registration(
+            dict(REG_DATA["hw_pre_mother"], invalid_fields=["language"]),
+            validated=False)
+        # Invalid, but marked as valid
+        registration2 = self.make_registration(
+            REG_DATA["missing_field"].copy(), validated=True)
+        # Valid, with data that changes when it is revalidated
+        registration3 = self.make_registration(
+            dict(REG_DATA["hw_pre_mother"], preg_week=10), validated=True)
+
+        management.call_command(
+            "revalidate_registrations", chunk_size=1,
+            create_subscriptions=True, stdout=stdout)
+
+        registration1.refresh_from_db()
+        self.assertEqual(registration1.validated, True)
+        self.assertEqual(registration1.data["preg_week"], 28)
+        self.assertNotIn("invalid_fields", registration1.data)
+        registration2.refresh_from_db()
+        self.assertEqual(registration2.validated, False)
+        self.assertEqual(registration2.data["invalid_fields"],
+                         "Invalid combination of fields")
+        registration3.refresh_from_db()
+        self.assertEqual(registration3.data["preg_week"], 28)
+
+        mock_validation.assert_called_once_with(kwargs={
+            "registration_ids": [str(registration1.id)],
+            "as_of_creation": True,
+        })
+        self.assertEqual(
+            stdout.getvalue().strip(),
+            "Validated 3 registrations, 2 valid, 3 changed.")
+
+    @mock.patch("registrations.tasks.validate_registrations.apply_async")
+    def test_revalidate_registrations_dry_run(self, mock_validation):
+        stdout = StringIO()
+        registration = self.make_registration(
+            REG_DATA["missing_field"].copy(), validated=True)
+
+        management.call_command(
+            "revalidate_registrations", dry_run=True, stdout=stdout)
+
+        registration.refresh_from_db()
+        self.assertEqual(registration.validated, True)
+        mock_validation.assert_not_called()
+        self.assertEqual(
+            stdout.getvalue().strip(),
+            "Validated 1 registrations, 0 valid, 1 changed.")
+
+
+class RefreshOperatorsCommand(AuthenticatedAPITestCase):
+    @mock.patch("registrations.tasks.refresh_operators.run")
+    def test_refresh_operators(self, mock_refresh):
+        mock_refresh.return_value = "Refreshed 2 operators, 0 errors"
+        stdout = StringIO()
+        management.call_command(
+            "refresh_operators", max_age=3600, stdout=stdout)
+
+        mock_refresh.assert_called_once_with(max_age=3600, limit=None)
+        self.assertEqual(
+            stdout.getvalue().strip(), "Refreshed 2 operators, 0 errors")
+
+
+class RebuildDailyRollupsCommand(AuthenticatedAPITestCase):
+    @mock.patch("registrations.tasks.rebuild_daily_rollups.run")
+    def test_rebuild_daily_rollups(self, mock_rebuild):
+        mock_rebuild.return_value = (
+            "Rebuilt 5 rollups from 2016-01-01 to 2016-01-31")
+        stdout = StringIO()
+        management.call_command(
+            "rebuild_daily_rollups", start="2016-01-01", end="2016-01-31",
+            stdout=stdout)
+
+        mock_rebuild.assert_called_once_with(
+            start="2016-01-01", end="2016-01-31", backfill=False)
+        self.assertEqual(
+            stdout.getvalue().strip(),
+            "Rebuilt 5 rollups from 2016-01-01 to 2016-01-31")
@@ -172,3 +172,35 @@ class TestGraphiteRetentions(TestCase):
         expected.sort(key=lambda d: d[0])
 
         self.assertEqual(buckets, expected)
+
+    def test_get_ranges(self):
+        """
+        The get_ranges function should return the range that each retention
+        covers, matching the buckets that get_buckets returns.
+        """
+        ret = RetentionScheme('45s:90s,1m:3m')
+        now = datetime(2016, 10, 26, 12, 00, 00)
+        ranges = [
+            (r.precision, start, finish)
+            for r, start, finish in ret.get_ranges(now=now)]
+
+        self.assertEqual(ranges, [
+            (
+                timedelta(seconds=45),
+                datetime(2016, 10, 26, 11, 58, 30),
+                datetime(2016, 10, 26, 12, 00, 00)
+            ),
+            (
+                timedelta(minutes=1),
+                datetime(2016, 10, 26, 11, 57, 00),
+                datetime(2016, 10, 26, 11, 58, 30)
+            ),
+        ])
+
+        buckets = []
+        for r, start, finish in ret.get_ranges(now=now):
+            buckets.extend(
+                r.get_bucket(start, finish, i)
+                for i in range(r.count_buckets(start, finish)))
+        self.assertEqual(
+            sorted(buckets), sorted(ret.get_buckets(now=now)))
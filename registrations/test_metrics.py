@@ -3,19 +3,25 @@ try:
 except ImportError:
     from unittest import mock
 
-import json
+import pika
 import responses
 
-from datetime import datetime
+from datetime import date, datetime
 from django.contrib.auth.models import User
 from django.test import TestCase
+from django.utils import timezone
 from django.db.models.signals import post_save
 
 from rest_hooks.models import model_saved
 
-from .metrics import MetricGenerator, send_metric
+from .graphite import GraphiteRetention
+from .metrics import (
+    GraphitePublisher, MetricGenerator, MetricSeriesGenerator, OptoutSnapshot,
+    PublishError, UnknownMetricError, send_metric)
 from .tests import AuthenticatedAPITestCase
-from .models import Source, Registration
+from .models import (
+    DailyRollup, Operator, Source, Registration, mark_registration_counted,
+    rebuild_rollups)
 from hellomama_registration import utils
 from changes.models import (
     Change, change_post_save, fire_language_change_metric,
@@ -75,12 +81,34 @@ class MetricsGeneratorTests(AuthenticatedAPITestCase):
         correct start and end datetimes.
         """
         generator = MetricGenerator()
-        generator.foo_bar = mock.MagicMock()
+        generator.functions['foo.bar'] = mock.MagicMock()
         start = datetime(2016, 10, 26)
         end = datetime(2016, 10, 26)
         generator.generate_metric('foo.bar', start, end)
 
-        generator.foo_bar.assert_called_once_with(start, end)
+        generator.functions['foo.bar'].assert_called_once_with(start, end)
+
+    def test_validate_names(self):
+        """
+        Unknown metric names should be reported before any metrics are
+        generated, and the sources should only be queried once.
+        """
+        user = User.objects.create(username='user1')
+        Source.objects.create(
+            name='TestSource', authority='hw_full', user=user)
+
+        with self.assertNumQueries(1):
+            generator = MetricGenerator()
+        generator.validate_names(
+            ['registrations.created.sum', 'registrations.source.user1.sum'])
+
+        with self.assertRaises(UnknownMetricError) as e:
+            generator.validate_names([
+                'registrations.created.sum', 'registrations.foo.sum',
+                'optout.reason.unknown.sum'])
+        self.assertEqual(
+            str(e.exception),
+            'registrations.foo.sum, optout.reason.unknown.sum')
 
     def create_registration_on(self, timestamp, source, **kwargs):
         r = Registration.objects.create(
@@ -172,7 +200,7 @@ class MetricsGeneratorTests(AuthenticatedAPITestCase):
             datetime(2016, 10, 14), source, operator_id='1')
         self.create_registration_on(
             datetime(2016, 10, 20), source, operator_id='1')
-        # Two registrations during should exclude 2
+        # Two registrations during should only count 2 once
         self.create_registration_on(
             datetime(2016, 10, 20), source, operator_id='2')
         self.create_registration_on(
@@ -185,7 +213,7 @@ class MetricsGeneratorTests(AuthenticatedAPITestCase):
 
         reg_count = MetricGenerator().registrations_unique_operators_sum(
             start, end)
-        self.assertEqual(reg_count, 1)
+        self.assertEqual(reg_count, 2)
 
     def test_registrations_msg_type_sum(self):
         """
@@ -364,19 +392,10 @@ class MetricsGeneratorTests(AuthenticatedAPITestCase):
             'eng', start, end)
         self.assertEqual(reg_count, 3)
 
-    def identity_search_callback(self, request):
-        headers = {'Content-Type': "application/json"}
-        resp = {
-            "results": [
-                {
-                    "id": "id1",
-                    "details": {"state": "state2"},
-                },
-            ]
-        }
-        return (200, headers, json.dumps(resp))
+    def create_operator(self, operator_id, **kwargs):
+        return Operator.objects.create(
+            operator_id=operator_id, refreshed_at=timezone.now(), **kwargs)
 
-    @responses.activate
     def test_registrations_state_sum(self):
         """
         Should return the amount of registrations in the given timeframe for
@@ -389,11 +408,8 @@ class MetricsGeneratorTests(AuthenticatedAPITestCase):
         source = Source.objects.create(
             name='TestSource', authority='hw_full', user=user)
 
-        url = 'http://localhost:8001/api/v1/identities/search/?' \
-              'details__state=state1'
-        responses.add_callback(
-            responses.GET, url, callback=self.identity_search_callback,
-            content_type="application/json", match_querystring=True)
+        self.create_operator('id1', state='state1')
+        self.create_operator('id2', state='state2')
 
         start = datetime(2016, 10, 15)
         end = datetime(2016, 10, 25)
@@ -415,7 +431,6 @@ class MetricsGeneratorTests(AuthenticatedAPITestCase):
             'state1', start, end)
         self.assertEqual(reg_count, 2)
 
-    @responses.activate
     def test_registrations_state_total_last(self):
         """
         Should return the amount of registrations until the end of the
@@ -425,11 +440,8 @@ class MetricsGeneratorTests(AuthenticatedAPITestCase):
         source = Source.objects.create(
             name='TestSource', authority='hw_full', user=user)
 
-        url = 'http://localhost:8001/api/v1/identities/search/?' \
-              'details__state=state1'
-        responses.add_callback(
-            responses.GET, url, callback=self.identity_search_callback,
-            content_type="application/json", match_querystring=True)
+        self.create_operator('id1', state='state1')
+        self.create_operator('id2', state='state2')
 
         start = datetime(2016, 10, 15)
         end = datetime(2016, 10, 25)
@@ -449,7 +461,6 @@ class MetricsGeneratorTests(AuthenticatedAPITestCase):
             'state1', start, end)
         self.assertEqual(reg_count, 3)
 
-    @responses.activate
     def test_registrations_role_sum(self):
         """
         Should return the amount of registrations in the given timeframe for
@@ -462,11 +473,8 @@ class MetricsGeneratorTests(AuthenticatedAPITestCase):
         source = Source.objects.create(
             name='TestSource', authority='hw_full', user=user)
 
-        url = 'http://localhost:8001/api/v1/identities/search/?' \
-              'details__role=role1'
-        responses.add_callback(
-            responses.GET, url, callback=self.identity_search_callback,
-            content_type="application/json", match_querystring=True)
+        self.create_operator('id1', role='role1')
+        self.create_operator('id2', role='role2')
 
         start = datetime(2016, 10, 15)
         end = datetime(2016, 10, 25)
@@ -488,7 +496,6 @@ class MetricsGeneratorTests(AuthenticatedAPITestCase):
             'role1', start, end)
         self.assertEqual(reg_count, 2)
 
-    @responses.activate
     def test_registrations_role_total_last(self):
         """
         Should return the amount of registrations up to the end of the
@@ -498,11 +505,8 @@ class MetricsGeneratorTests(AuthenticatedAPITestCase):
         source = Source.objects.create(
             name='TestSource', authority='hw_full', user=user)
 
-        url = 'http://localhost:8001/api/v1/identities/search/?' \
-              'details__role=role1'
-        responses.add_callback(
-            responses.GET, url, callback=self.identity_search_callback,
-            content_type="application/json", match_querystring=True)
+        self.create_operator('id1', role='role1')
+        self.create_operator('id2', role='role2')
 
         start = datetime(2016, 10, 15)
         end = datetime(2016, 10, 25)
@@ -771,9 +775,330 @@ class MetricsGeneratorTests(AuthenticatedAPITestCase):
         user = User.objects.create(username='user1')
         Source.objects.create(
             name='TestSource', authority='hw_full', user=user)
+        generator = MetricGenerator()
         for metric in utils.get_available_metrics():
-            self.assertTrue(callable(getattr(
-                MetricGenerator(), metric.replace('.', '_'))))
+            self.assertTrue(callable(generator.get_function(metric)))
+
+    def test_series_fallback_names(self):
+        """
+        Metrics that don't belong to a family should be left for the
+        MetricGenerator.
+        """
+        series = MetricSeriesGenerator([
+            'registrations.created.sum', 'registrations.created.total.last',
+            'registrations.msg_type.unknown.sum', 'optout.reason.other.sum',
+            'registrations.language.eng_NG.sum'])
+        self.assertEqual(series.fallback_names, [
+            'registrations.msg_type.unknown.sum', 'optout.reason.other.sum'])
+
+    def test_series_unknown_names(self):
+        """
+        Names that look like they belong to a family, but that the
+        MetricGenerator can't generate, should be left for it to reject.
+        """
+        names = [
+            'registrations.unique_operators.total.last',
+            'registrations.created.sum']
+        series = MetricSeriesGenerator(names)
+        self.assertEqual(series.fallback_names, [
+            'registrations.unique_operators.total.last'])
+        with self.assertRaises(UnknownMetricError):
+            MetricGenerator().validate_names(series.fallback_names)
+
+    def test_series_matches_generator(self):
+        """
+        The series should contain a value for every metric in every bucket,
+        matching the values that the MetricGenerator returns for the bucket.
+        """
+        user = User.objects.create(username='user1')
+        source = Source.objects.create(
+            name='TestSource', authority='hw_full', user=user)
+
+        self.create_registration_on(
+            datetime(2016, 10, 14), source, language='eng_NG')  # Before
+        self.create_registration_on(
+            datetime(2016, 10, 15), source, language='eng_NG')  # On start
+        self.create_registration_on(
+            datetime(2016, 10, 16, 12), source, language='eng_NG')
+        self.create_registration_on(
+            datetime(2016, 10, 17), source, language='ibo_NG')  # On border
+        self.create_registration_on(
+            datetime(2016, 10, 18), source, msg_type='text')  # On finish
+        self.create_registration_on(
+            datetime(2016, 10, 19), source, language='eng_NG')  # After
+        self.create_lang_change_on(datetime(2016, 10, 16), source)
+        self.create_baby_change_on(datetime(2016, 10, 17, 6), source)
+
+        names = [
+            'registrations.created.sum',
+            'registrations.unique_operators.sum',
+            'registrations.language.eng_NG.sum',
+            'registrations.language.ibo_NG.sum',
+            'registrations.msg_type.text.sum',
+            'registrations.source.user1.sum',
+            'registrations.change.language.sum',
+            'registrations.change.pregnant_to_baby.sum',
+        ]
+        retention = GraphiteRetention('2d:1y')
+        start, finish = datetime(2016, 10, 15), datetime(2016, 10, 18)
+        series = MetricSeriesGenerator(names)
+        self.assertEqual(series.fallback_names, [])
+
+        values = list(series.generate_series(retention, start, finish))
+        self.assertEqual(len(values), len(names) * 2)
+
+        generator = MetricGenerator()
+        for bucket_start, bucket_end in retention.get_buckets(
+                now=start + retention.duration, finish=finish):
+            timestamp = bucket_start + (bucket_end - bucket_start) / 2
+            for name in names:
+                self.assertIn((
+                    name,
+                    generator.generate_metric(name, bucket_start, bucket_end),
+                    timestamp), values)
+
+        self.assertIn(
+            ('registrations.created.sum', 2, datetime(2016, 10, 16)), values)
+        self.assertIn(
+            ('registrations.created.sum', 1, datetime(2016, 10, 17, 12)),
+            values)
+
+    def test_series_totals_match_generator(self):
+        """
+        The total.last series should be the running totals of the bucket
+        counts, matching the totals that the MetricGenerator returns.
+        """
+        user = User.objects.create(username='user1')
+        source = Source.objects.create(
+            name='TestSource', authority='hw_full', user=user)
+
+        self.create_registration_on(
+            datetime(2016, 10, 14), source, language='eng_NG')  # Before
+        self.create_registration_on(
+            datetime(2016, 10, 15), source, language='eng_NG')  # On start
+        self.create_registration_on(
+            datetime(2016, 10, 16), source, language='ibo_NG')
+        self.create_registration_on(
+            datetime(2016, 10, 18), source, language='eng_NG')  # On finish
+        self.create_registration_on(
+            datetime(2016, 10, 19), source, language='eng_NG')  # After
+        self.create_lang_change_on(datetime(2016, 10, 13), source)
+        self.create_lang_change_on(datetime(2016, 10, 17), source)
+
+        names = [
+            'registrations.created.total.last',
+            'registrations.language.eng_NG.total.last',
+            'registrations.language.ibo_NG.total.last',
+            'registrations.language.eng_NG.sum',
+            'registrations.change.language.total.last',
+            'registrations.change.pregnant_to_baby.total.last',
+        ]
+        retention = GraphiteRetention('1d:1y')
+        start, finish = datetime(2016, 10, 15), datetime(2016, 10, 18)
+        series = MetricSeriesGenerator(names)
+        self.assertEqual(series.fallback_names, [])
+
+        values = list(series.generate_series(retention, start, finish))
+        self.assertEqual(len(values), len(names) * 3)
+
+        generator = MetricGenerator()
+        for bucket_start, bucket_end in retention.get_buckets(
+                now=start + retention.duration, finish=finish):
+            timestamp = bucket_start + (bucket_end - bucket_start) / 2
+            for name in names:
+                self.assertIn((
+                    name,
+                    generator.generate_metric(name, bucket_start, bucket_end),
+                    timestamp), values)
+
+        self.assertIn((
+            'registrations.created.total.last', 4,
+            datetime(2016, 10, 17, 12)), values)
+
+    def test_series_operator_fields(self):
+        """
+        The state and role series should be calculated from the Operator
+        table.
+        """
+        user = User.objects.create(username='user1')
+        source = Source.objects.create(
+            name='TestSource', authority='hw_full', user=user)
+        self.create_operator('id1', state='abuja', role='midwife')
+        self.create_operator('id2', state='ebonyi', role='midwife')
+
+        self.create_registration_on(
+            datetime(2016, 10, 14), source, operator_id='id1')  # Before
+        self.create_registration_on(
+            datetime(2016, 10, 16), source, operator_id='id1')
+        self.create_registration_on(
+            datetime(2016, 10, 16), source, operator_id='id2')
+        self.create_registration_on(
+            datetime(2016, 10, 16), source, operator_id='id3')  # Unknown
+
+        names = [
+            'registrations.state.abuja.sum',
+            'registrations.state.abuja.total.last',
+            'registrations.state.ebonyi.sum',
+            'registrations.role.midwife.sum',
+            'registrations.role.midwife.total.last',
+        ]
+        retention = GraphiteRetention('2d:1y')
+        series = MetricSeriesGenerator(names)
+        self.assertEqual(series.fallback_names, [])
+
+        values = list(series.generate_series(
+            retention, datetime(2016, 10, 15), datetime(2016, 10, 17)))
+        self.assertEqual(
+            sorted((name, value) for name, value, _ in values), [
+                ('registrations.role.midwife.sum', 2),
+                ('registrations.role.midwife.total.last', 3),
+                ('registrations.state.abuja.sum', 1),
+                ('registrations.state.abuja.total.last', 2),
+                ('registrations.state.ebonyi.sum', 1),
+            ])
+
+    def test_series_totals_from_rollups(self):
+        """
+        With METRICS_USE_DAILY_ROLLUPS, the totals should be seeded from the
+        rollups of the days before the start, and the rows of the start's
+        day.
+        """
+        user = User.objects.create(username='user1')
+        source = Source.objects.create(
+            name='TestSource', authority='hw_full', user=user)
+
+        self.create_registration_on(
+            datetime(2016, 10, 13), source, language='eng_NG')
+        self.create_registration_on(
+            datetime(2016, 10, 14, 12), source, language='eng_NG')
+        self.create_registration_on(
+            datetime(2016, 10, 15), source, language='ibo_NG')  # On start
+        self.create_registration_on(
+            datetime(2016, 10, 15, 12), source, language='ibo_NG')  # After
+        self.create_lang_change_on(datetime(2016, 10, 13), source)
+        for registration in Registration.objects.all():
+            mark_registration_counted(registration.id)
+        rebuild_rollups(date(2016, 10, 1), date(2016, 10, 31))
+
+        names = [
+            'registrations.created.total.last',
+            'registrations.language.eng_NG.total.last',
+            'registrations.language.ibo_NG.total.last',
+            'registrations.source.user1.total.last',
+            'registrations.change.language.total.last',
+        ]
+        retention = GraphiteRetention('1d:1y')
+        start, finish = datetime(2016, 10, 15), datetime(2016, 10, 16)
+
+        values = list(MetricSeriesGenerator(names).generate_series(
+            retention, start, finish))
+        with self.settings(METRICS_USE_DAILY_ROLLUPS=True):
+            self.assertEqual(list(MetricSeriesGenerator(names).generate_series(
+                retention, start, finish)), values)
+
+            # Only the rollups before the start's day are read
+            DailyRollup.objects.filter(
+                dimension='created', day=date(2016, 10, 13)).update(count=11)
+            totals = dict(
+                (name, value) for name, value, _ in
+                MetricSeriesGenerator(names).generate_series(
+                    retention, start, finish))
+        self.assertEqual(totals['registrations.created.total.last'], 14)
+        self.assertEqual(
+            totals['registrations.language.ibo_NG.total.last'], 2)
+        self.assertEqual(
+            totals['registrations.source.user1.total.last'], 4)
+        self.assertEqual(
+            totals['registrations.change.language.total.last'], 1)
+
+
+class OptoutSnapshotTests(TestCase):
+    def setUp(self):
+        user = User.objects.create(username='user1')
+        source = Source.objects.create(
+            name='TestSource', authority='hw_full', user=user)
+        for mother_id, msg_type, msg_receiver in [
+                ('mother1', 'text', 'mother_only'),
+                ('mother1', 'audio', 'mother_only'),
+                ('mother2', 'text', 'father_only'),
+                ('mother3', 'text', 'mother_only')]:
+            Registration.objects.create(
+                mother_id=mother_id, source=source,
+                data={'msg_type': msg_type, 'msg_receiver': msg_receiver})
+
+        self.snapshot = OptoutSnapshot([
+            {'identity': 'mother2', 'reason': 'other',
+             'request_source': 'sms', 'created_at': '2016-10-20T00:00:00Z'},
+            {'identity': 'mother1', 'reason': 'miscarriage',
+             'request_source': 'ussd', 'created_at': '2016-10-14T00:00:00Z'},
+            {'identity': 'mother1', 'reason': 'other',
+             'request_source': 'sms', 'created_at': '2016-10-15T00:00:00Z'},
+            {'identity': 'mother3', 'reason': 'other',
+             'request_source': 'sms', 'created_at': '2016-10-25T00:00:00Z'},
+            {'identity': 'mother4', 'reason': 'other',
+             'request_source': 'sms', 'created_at': '2016-10-26T00:00:00Z'},
+        ])
+        self.snapshot.load_registrations(batch_size=2)
+
+    def test_count_optouts(self):
+        """
+        Only the optouts in the timeframe, excluding the start, should be
+        counted. Without a start, all the optouts up to the end should be
+        counted.
+        """
+        start = datetime(2016, 10, 15)
+        end = datetime(2016, 10, 25)
+        generator = MetricGenerator(optouts=self.snapshot)
+
+        self.assertEqual(self.snapshot.count_optouts(start, end), 2)
+        self.assertEqual(
+            generator.optout_reason_sum('other', start, end), 2)
+        self.assertEqual(
+            generator.optout_reason_total_last('other', start, end), 3)
+        self.assertEqual(
+            generator.optout_reason_total_last('miscarriage', start, end), 1)
+        self.assertEqual(generator.optout_source_sum('ussd', start, end), 0)
+        self.assertEqual(
+            generator.optout_source_total_last('sms', start, end), 3)
+
+    def test_count_registrations(self):
+        """
+        The registrations of the identities that opted out in the timeframe
+        should be counted, once per registration.
+        """
+        start = datetime(2016, 10, 15)
+        end = datetime(2016, 10, 25)
+        generator = MetricGenerator(optouts=self.snapshot)
+
+        self.assertEqual(
+            generator.optout_msg_type_sum('text', start, end), 2)
+        self.assertEqual(
+            generator.optout_msg_type_total_last('audio', start, end), 1)
+        self.assertEqual(
+            generator.optout_receiver_type_sum('mother_only', start, end), 1)
+        self.assertEqual(
+            generator.optout_receiver_type_total_last(
+                'mother_only', start, end), 3)
+
+    @responses.activate
+    def test_load(self):
+        """
+        The optouts should be fetched from the identity store once.
+        """
+        responses.add(
+            responses.GET, 'http://localhost:8001/api/v1/optouts/search/',
+            json={'next': None, 'results': [
+                {'identity': 'mother1', 'reason': 'other',
+                 'request_source': 'sms',
+                 'created_at': '2016-10-15T00:00:00Z'}]},
+            status=200, content_type='application/json')
+
+        snapshot = OptoutSnapshot.load()
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(snapshot.identities, ['mother1'])
+        self.assertEqual(
+            snapshot.count_registrations(
+                'msg_type', 'audio', None, datetime(2016, 10, 16)), 1)
 
 
 class SendMetricTests(TestCase):
@@ -811,3 +1136,108 @@ class SendMetricTests(TestCase):
         self.assertEqual(message, '17.0 1317')
         self.assertEquals(properties.delivery_mode, 2)
         self.assertEquals(properties.content_type, 'text/plain')
+
+
+class FakeChannel(object):
+    """
+    An in-memory stand in for a pika channel in transaction mode.
+    """
+    def __init__(self, commit=True):
+        self.commit = commit
+        self.transactional = False
+        self.published = []
+        self.commits = []
+
+    def tx_select(self):
+        self.transactional = True
+
+    def tx_commit(self):
+        if not self.commit:
+            raise pika.exceptions.ChannelClosed(406, 'PRECONDITION_FAILED')
+        self.commits.append(len(self.published))
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        self.published.append((exchange, routing_key, body, properties))
+        return True
+
+
+class GraphitePublisherTests(TestCase):
+    def test_publish_batches(self):
+        """
+        Points should be published as they are sent, and committed in
+        batches of batch_size, and when the publisher is flushed.
+        """
+        channel = FakeChannel()
+        publisher = GraphitePublisher(channel, batch_size=2)
+        self.assertTrue(channel.transactional)
+
+        for i in range(3):
+            send_metric(
+                publisher, 'prefix', 'foo.bar', i,
+                datetime.utcfromtimestamp(1317 + i))
+        self.assertEqual(channel.commits, [2])
+        publisher.flush()
+        self.assertEqual(channel.commits, [2, 3])
+
+        self.assertEqual(
+            [(e, r, b) for e, r, b, _ in channel.published], [
+                ('graphite', 'prefix.foo.bar', '0.0 1317'),
+                ('graphite', 'prefix.foo.bar', '1.0 1318'),
+                ('graphite', 'prefix.foo.bar', '2.0 1319'),
+            ])
+        properties = channel.published[0][3]
+        self.assertEqual(properties.content_type, 'text/plain')
+        self.assertEqual(properties.delivery_mode, None)
+
+        throughput = publisher.get_throughput()
+        self.assertEqual(throughput['points'], 3)
+        self.assertEqual(throughput['messages'], 3)
+
+    def test_publish_name_in_body(self):
+        """
+        With name_in_body, each batch should be sent as one message with a
+        line per point.
+        """
+        channel = FakeChannel()
+        publisher = GraphitePublisher(
+            channel, batch_size=2, name_in_body=True)
+        for i in range(3):
+            publisher.publish('foo.bar', i, 1317 + i)
+        publisher.flush()
+
+        self.assertEqual(
+            [(e, r, b) for e, r, b, _ in channel.published], [
+                ('graphite', '', 'foo.bar 0.0 1317\nfoo.bar 1.0 1318\n'),
+                ('graphite', '', 'foo.bar 2.0 1319\n'),
+            ])
+        self.assertEqual(channel.commits, [1, 2])
+        self.assertEqual(publisher.get_throughput()['messages'], 2)
+
+    def test_publish_default_batch(self):
+        """
+        By default, points should only be committed once the publisher is
+        flushed, instead of for every point.
+        """
+        channel = FakeChannel()
+        publisher = GraphitePublisher(channel)
+        for i in range(10):
+            send_metric(
+                publisher, '', 'foo.bar', 17, datetime.utcfromtimestamp(1317))
+        self.assertEqual(channel.commits, [])
+        self.assertEqual(channel.published, [])
+
+        publisher.flush()
+        self.assertEqual(channel.commits, [10])
+
+    def test_publish_not_committed(self):
+        """
+        If the broker doesn't commit a batch, an error should be raised and
+        the points should be kept in the buffer.
+        """
+        channel = FakeChannel(commit=False)
+        publisher = GraphitePublisher(channel, batch_size=5)
+        publisher.publish('foo.bar', 1, 1317)
+
+        self.assertRaises(PublishError, publisher.flush)
+        self.assertEqual(len(publisher.buffer), 1)
+        self.assertEqual(publisher.get_throughput()['points'], 0)
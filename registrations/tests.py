@@ -1,5 +1,6 @@
 from base64 import b64decode
 import json
+import threading
 import uuid
 from datetime import timedelta, datetime
 try:
@@ -23,6 +24,7 @@ from django.contrib.auth.models import User, Group
 from django.test import TestCase, override_settings
 from django.db.models.signals import post_save
 from django.conf import settings
+from django.utils import timezone
 from django.core.cache import cache
 from django.core.management import call_command
 from django.core.management.base import CommandError
@@ -30,7 +32,10 @@ from rest_framework import status
 from rest_framework.test import APIClient
 from rest_framework.authtoken.models import Token
 from rest_hooks.models import model_saved, Hook
-from requests.exceptions import ConnectTimeout
+from celery.exceptions import Retry
+from demands import HTTPServiceError
+from requests.exceptions import ConnectTimeout, HTTPError
+from requests.packages.urllib3.exceptions import ConnectTimeoutError
 from requests_testadapter import TestAdapter, TestSession
 from openpyxl.writer.excel import save_virtual_workbook
 
@@ -38,14 +43,18 @@ from hellomama_registration import utils
 from registrations import tasks
 from .models import (
     Source, Registration, SubscriptionRequest, registration_post_save,
-    fire_created_metric, fire_unique_operator_metric, fire_message_type_metric,
-    fire_source_metric, fire_receiver_type_metric, fire_language_metric,
-    fire_state_metric, fire_role_metric, ThirdPartyRegistrationError)
+    fire_registration_metrics, ThirdPartyRegistrationError, MetricCounter,
+    get_or_incr_counter, MetricsBackfill, MetricsBackfillShard, Operator,
+    FirstSeenOperator, MetricBuffer, buffer_metrics, pop_buffered_metrics,
+    DailyRollup, mark_registration_counted, rebuild_rollups, sum_rollups)
 from .tasks import (
     validate_registration,
     is_valid_date, is_valid_uuid, is_valid_lang, is_valid_msg_type,
     is_valid_msg_receiver, is_valid_loss_reason, is_valid_state, is_valid_role,
-    repopulate_metrics, send_public_registration_notifications)
+    repopulate_metrics, repopulate_metrics_shard, refresh_operators,
+    send_public_registration_notifications)
+from .metrics import OptoutSnapshot, UnknownMetricError
+from .validation import BatchValidator
 
 
 def override_get_today():
@@ -199,21 +208,7 @@ class AuthenticatedAPITestCase(APITestCase):
             " helpers cleaned up properly in earlier tests.")
         post_save.disconnect(receiver=registration_post_save,
                              sender=Registration)
-        post_save.disconnect(receiver=fire_created_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_source_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_unique_operator_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_message_type_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_receiver_type_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_language_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_state_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_role_metric,
+        post_save.disconnect(receiver=fire_registration_metrics,
                              sender=Registration)
         post_save.disconnect(receiver=model_saved,
                              dispatch_uid='instance-saved-hook')
@@ -229,17 +224,7 @@ class AuthenticatedAPITestCase(APITestCase):
             " helpers removed them properly in earlier tests.")
         post_save.connect(receiver=registration_post_save,
                           sender=Registration)
-        post_save.connect(receiver=fire_created_metric,
-                          sender=Registration)
-        post_save.connect(receiver=fire_source_metric,
-                          sender=Registration)
-        post_save.connect(receiver=fire_unique_operator_metric,
-                          sender=Registration)
-        post_save.connect(receiver=fire_language_metric,
-                          sender=Registration)
-        post_save.connect(receiver=fire_state_metric,
-                          sender=Registration)
-        post_save.connect(receiver=fire_role_metric,
+        post_save.connect(receiver=fire_registration_metrics,
                           sender=Registration)
         post_save.connect(receiver=model_saved,
                           dispatch_uid='instance-saved-hook')
@@ -903,6 +888,188 @@ class TestRegistrationAPI(AuthenticatedAPITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.data["results"]), 2)
 
+    def test_data_fields_synced_on_save(self):
+        """
+        The indexed copies of the registration data should be kept in sync
+        with the data when the registration is saved.
+        """
+        registration = self.make_registration_adminuser()
+        registration.refresh_from_db()
+        self.assertEqual(registration.operator_id,
+                         REG_DATA['hw_pre_mother']['operator_id'])
+        self.assertEqual(registration.receiver_id,
+                         REG_DATA['hw_pre_mother']['receiver_id'])
+        self.assertEqual(registration.msg_type, "text")
+        self.assertEqual(registration.msg_receiver, "mother_only")
+        self.assertEqual(registration.language, "eng_NG")
+
+        registration.data = dict(registration.data, language="ibo_NG")
+        del registration.data["operator_id"]
+        registration.save(update_fields=["data"])
+
+        registration.refresh_from_db()
+        self.assertEqual(registration.language, "ibo_NG")
+        self.assertEqual(registration.operator_id, None)
+        self.assertEqual(
+            Registration.objects.filter(language="ibo_NG").count(), 1)
+
+
+class TestRegistrationBulkAPI(AuthenticatedAPITestCase):
+
+    @mock.patch('django.db.transaction.on_commit', side_effect=lambda f: f())
+    @mock.patch('registrations.tasks.validate_registrations.apply_async')
+    def test_create_registrations_bulk(self, mock_validate, mock_on_commit):
+        # Setup
+        self.make_source_adminuser()
+        post_data = [{
+            "stage": "prebirth",
+            "mother_id": "mother00-9d89-4aa6-99ff-13c225365b5d",
+            "data": REG_DATA["hw_pre_mother"]
+        }, {
+            "stage": "postbirth",
+            "mother_id": "mother00-9d89-4aa6-99ff-13c225365b5d",
+            "data": REG_DATA["hw_post"]
+        }]
+        # Execute
+        response = self.adminclient.post('/api/v1/registration/bulk/',
+                                         json.dumps(post_data),
+                                         content_type='application/json')
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        [result1, result2] = response.data["results"]
+        self.assertEqual(result1["index"], 0)
+        self.assertEqual(result1["created"], True)
+        self.assertEqual(result2["index"], 1)
+        self.assertEqual(result2["created"], True)
+
+        self.assertEqual(Registration.objects.count(), 2)
+        d = Registration.objects.get(id=result1["id"])
+        self.assertEqual(d.source.name, 'test_ussd_source_adminuser')
+        self.assertEqual(d.stage, 'prebirth')
+        self.assertEqual(d.validated, False)
+        self.assertEqual(d.data, REG_DATA["hw_pre_mother"])
+        self.assertEqual(d.created_by, self.adminuser)
+        self.assertEqual(d.updated_by, self.adminuser)
+
+        mock_validate.assert_called_once_with(kwargs={
+            "registration_ids": [result1["id"], result2["id"]]})
+
+    @override_settings(REGISTRATION_VALIDATION_CHUNK_SIZE=2)
+    @mock.patch('django.db.transaction.on_commit', side_effect=lambda f: f())
+    @mock.patch('registrations.tasks.validate_registrations.apply_async')
+    def test_create_registrations_bulk_chunks(
+            self, mock_validate, mock_on_commit):
+        # Setup
+        self.make_source_adminuser()
+        post_data = [{
+            "stage": "prebirth",
+            "mother_id": "mother00-9d89-4aa6-99ff-13c225365b5d",
+            "data": REG_DATA["hw_pre_mother"]
+        }] * 5
+        # Execute
+        response = self.adminclient.post('/api/v1/registration/bulk/',
+                                         json.dumps(post_data),
+                                         content_type='application/json')
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Registration.objects.count(), 5)
+        self.assertEqual(
+            [len(c[1]["kwargs"]["registration_ids"])
+             for c in mock_validate.call_args_list],
+            [2, 2, 1])
+
+    @mock.patch('registrations.tasks.validate_registrations.apply_async')
+    def test_create_registrations_bulk_partial_failure(self, mock_validate):
+        # Setup
+        self.make_source_adminuser()
+        post_data = [{
+            "stage": "prebirth",
+            "mother_id": "mother00-9d89-4aa6-99ff-13c225365b5d",
+            "data": REG_DATA["hw_pre_mother"]
+        }, {
+            "stage": "unknown",
+            "mother_id": "mother00-9d89-4aa6-99ff-13c225365b5d",
+            "data": REG_DATA["hw_pre_mother"]
+        }, "not a registration"]
+        # Execute
+        response = self.adminclient.post('/api/v1/registration/bulk/',
+                                         json.dumps(post_data),
+                                         content_type='application/json')
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        [result1, result2, result3] = response.data["results"]
+        self.assertEqual(result1["created"], True)
+        self.assertEqual(result2["created"], False)
+        self.assertEqual(list(result2["errors"].keys()), ["stage"])
+        self.assertEqual(result3["created"], False)
+        self.assertEqual(Registration.objects.count(), 1)
+
+    def test_create_registrations_bulk_not_a_list(self):
+        # Setup
+        self.make_source_adminuser()
+        post_data = {
+            "stage": "prebirth",
+            "mother_id": "mother00-9d89-4aa6-99ff-13c225365b5d",
+            "data": REG_DATA["hw_pre_mother"]
+        }
+        # Execute
+        response = self.adminclient.post('/api/v1/registration/bulk/',
+                                         json.dumps(post_data),
+                                         content_type='application/json')
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Registration.objects.count(), 0)
+
+    @mock.patch.object(
+        tasks.ValidateRegistrations, 'retry', side_effect=Retry())
+    @mock.patch('registrations.tasks.validate_registration.complete')
+    def test_validate_registrations_task(self, mock_complete, mock_retry):
+        # Setup
+        def complete(registration, valid):
+            if not valid:
+                raise Exception("Boom")
+        mock_complete.side_effect = complete
+        registration1 = Registration.objects.create(
+            stage="prebirth", mother_id="mother00-9d89-4aa6-99ff-13c225365b5d",
+            data=REG_DATA["hw_pre_mother"].copy(),
+            source=self.make_source_adminuser())
+        registration2 = Registration.objects.create(
+            stage="prebirth", mother_id="mother00-9d89-4aa6-99ff-13c225365b5d",
+            data=REG_DATA["missing_field"].copy(),
+            source=self.make_source_adminuser())
+        # Execute
+        self.assertRaises(
+            Retry, tasks.validate_registrations.run,
+            [str(registration1.id), str(registration2.id)])
+        # Check
+        [(_, retry_kwargs)] = mock_retry.call_args_list
+        self.assertEqual(retry_kwargs["kwargs"], {
+            "registration_ids": [str(registration2.id)],
+            "as_of_creation": False,
+        })
+        self.assertEqual(str(retry_kwargs["exc"]), "Boom")
+        self.assertEqual(
+            sorted((str(c[0][0].id), c[0][1])
+                   for c in mock_complete.call_args_list),
+            sorted([(str(registration1.id), True),
+                    (str(registration2.id), False)]))
+
+    @mock.patch('registrations.tasks.validate_registration.complete')
+    @mock.patch('registrations.tasks.BatchValidator')
+    def test_validate_registrations_task_as_of_creation(
+            self, mock_validator, mock_complete):
+        """
+        Revalidated registrations should be validated as of the day that
+        they were created.
+        """
+        mock_validator.return_value.validate.return_value = []
+
+        result = tasks.validate_registrations.apply_async(kwargs={
+            "registration_ids": [], "as_of_creation": True})
+
+        mock_validator.assert_called_once_with(as_of_creation=True)
+        self.assertEqual(result.get(), "Validated 0 registrations")
+
 
 class TestFieldValidation(AuthenticatedAPITestCase):
 
@@ -999,6 +1166,102 @@ class TestFieldValidation(AuthenticatedAPITestCase):
 
 class TestRegistrationValidation(AuthenticatedAPITestCase):
 
+    @mock.patch('registrations.tasks.validate_registration.apply_async')
+    def test_validation_queued_on_commit(self, mock_validate):
+        """
+        The validation task should only be queued once the registration has
+        been committed.
+        """
+        post_save.connect(registration_post_save, sender=Registration)
+        callbacks = []
+
+        with mock.patch('django.db.transaction.on_commit',
+                        side_effect=callbacks.append):
+            registration = self.make_registration_adminuser()
+
+        mock_validate.assert_not_called()
+        [callback] = callbacks
+        callback()
+        mock_validate.assert_called_once_with(kwargs={
+            "registration_id": str(registration.id)})
+        post_save.disconnect(registration_post_save, sender=Registration)
+
+    @mock.patch('hellomama_registration.utils.post_message')
+    @mock.patch('registrations.tasks.validate_registration'
+                '.plan_subscriptionrequests')
+    @mock.patch('registrations.tasks.validate_registration'
+                '.stop_public_subscriptions')
+    def test_welcome_messages_sent_on_commit(
+            self, mock_stop, mock_plan, mock_post_message):
+        """
+        The welcome messages should only be sent once the registration and
+        its subscription requests have been committed.
+        """
+        registration = self.make_registration_adminuser()
+        payload = {"to_identity": str(registration.id), "content": "Hi",
+                   "metadata": {}}
+        mock_plan.return_value = ([], [payload])
+        callbacks = []
+
+        with mock.patch('django.db.transaction.on_commit',
+                        side_effect=callbacks.append):
+            validate_registration.complete(registration, True)
+
+        mock_post_message.assert_not_called()
+        [callback] = callbacks
+        callback()
+        mock_post_message.assert_called_once_with(payload)
+
+    def test_batch_validator(self):
+        """
+        The batch validator should return a verdict with the derived fields
+        for each registration, and only calculate each date once.
+        """
+        source = self.make_source_adminuser()
+        registrations = [
+            Registration.objects.create(
+                stage=stage, source=source,
+                mother_id="mother00-9d89-4aa6-99ff-13c225365b5d",
+                data=REG_DATA[data].copy())
+            for stage, data in [
+                ("prebirth", "hw_pre_mother"),
+                ("prebirth", "missing_field"),
+                ("prebirth", "hw_pre_mother"),
+            ]]
+
+        with mock.patch.object(
+                utils, 'calc_pregnancy_week_lmp',
+                wraps=utils.calc_pregnancy_week_lmp) as mock_calc:
+            verdicts = BatchValidator().validate(registrations)
+
+        self.assertEqual(
+            [v.registration for v in verdicts], registrations)
+        self.assertEqual([v.valid for v in verdicts], [True, False, True])
+        self.assertEqual(verdicts[0].derived,
+                         {"reg_type": "hw_pre", "preg_week": 28})
+        self.assertEqual(verdicts[1].invalid_fields,
+                         "Invalid combination of fields")
+        self.assertEqual(mock_calc.call_count, 1)
+
+        verdicts[0].apply()
+        self.assertEqual(registrations[0].validated, True)
+        self.assertEqual(registrations[0].data["preg_week"], 28)
+
+    def test_validate_does_not_save(self):
+        """
+        Validation should only update the registration in memory, the task
+        saves it once.
+        """
+        registration = self.make_registration_adminuser()
+
+        with mock.patch.object(Registration, 'save') as mock_save:
+            v = validate_registration.validate(registration)
+
+        self.assertEqual(v, False)
+        self.assertEqual(
+            registration.data["invalid_fields"], "Invalid UUID mother_id")
+        mock_save.assert_not_called()
+
     def test_validate_hw_prebirth(self):
         # Setup
         registration_data = {
@@ -2362,6 +2625,36 @@ class TestSubscriptionRequest(AuthenticatedAPITestCase):
         self.assertEqual(d_friend.schedule, 6)
 
 
+@override_settings(
+    CACHES=dict(settings.CACHES, **{
+        'identities': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'test-identities',
+        },
+        'http': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'test-http',
+        },
+    }),
+    MESSAGESET_CATALOGUE_TTL=300,
+    CIRCUIT_BREAKER_FAILURE_THRESHOLD=5,
+    REQUEST_MEMO=True)
+class TestSubscriptionRequestAllLayers(TestSubscriptionRequest):
+    """
+    Runs the subscription request tests with the identity cache, the HTTP
+    cache, the messageset catalogue, the circuit breakers and the request
+    memo all enabled, as they are in production.
+    """
+
+    def setUp(self):
+        super(TestSubscriptionRequestAllLayers, self).setUp()
+        utils.get_identity_cache().clear()
+        utils.get_http_cache().clear()
+        utils.messageset_catalogue.clear()
+        for breaker in utils.circuit_breakers.values():
+            breaker.reset()
+
+
 class TestMetricsAPI(AuthenticatedAPITestCase):
 
     def test_metrics_read(self):
@@ -2479,11 +2772,14 @@ class TestMetricsAPI(AuthenticatedAPITestCase):
                       json={"foo": "bar"},
                       status=200, content_type='application/json')
         # Execute
-        response = self.adminclient.post(
-            '/api/metrics/', content_type='application/json')
+        with mock.patch(
+                'registrations.views.scheduled_metrics') as scheduled_metrics:
+            response = self.adminclient.post(
+                '/api/metrics/', content_type='application/json')
         # Check
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertEqual(response.data["scheduled_metrics_initiated"], True)
+        scheduled_metrics.apply_async.assert_called_once_with()
 
 
 class TestUserCreation(AuthenticatedAPITestCase):
@@ -2562,427 +2858,1517 @@ class TestHealthcheckAPI(AuthenticatedAPITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data["up"], True)
         self.assertEqual(response.data["result"]["database"], "Accessible")
+        self.assertEqual(response.data["result"]["identity_cache"],
+                         {"hits": 0, "misses": 0})
+        self.assertEqual(
+            set(response.data["result"]["circuit_breakers"].values()),
+            {"closed"})
+        self.assertIn("deduplicated", response.data["result"]["request_memo"])
 
 
-class TestMetrics(AuthenticatedAPITestCase):
+@override_settings(CACHES=dict(settings.CACHES, identities={
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'test-identities',
+}))
+class TestIdentityCache(TestCase):
 
-    def add_metrics_callback(self):
+    def setUp(self):
+        utils.get_identity_cache().clear()
+
+    def add_identity_callback(self, identity_id, status=200):
+        body = {"id": identity_id, "details": {"state": "Abuja"}}
+        if status == 404:
+            body = {"detail": "Not found."}
         responses.add(
-            responses.POST, "http://metrics-url/metrics/",
-            json={}, status=200, content_type='application/json')
+            responses.GET,
+            'http://localhost:8001/api/v1/identities/%s/' % identity_id,
+            json=body, status=status, content_type='application/json')
 
     @responses.activate
-    @override_settings(METRICS_AUTH=('metricuser', 'metricpass'))
-    def test_direct_fire(self):
+    def test_get_identity_cached(self):
         """
-        When calling the `fire_metric` task, it should make a POST request
-        to the metrics API, with the correct details.
+        Identities should only be fetched from the identity store once, and
+        the hits and misses should be counted.
         """
-        # Setup
-        self.add_metrics_callback()
-        # Execute
-        result = tasks.fire_metric.apply_async(kwargs={
-            "metric_name": 'foo.last',
-            "metric_value": 1,
-        })
-        # Check
-        [request] = responses.calls
-        self._check_request(
-            request.request, 'POST',
-            data={"foo.last": 1.0}
-        )
-        _, auth = request.request.headers['Authorization'].split()
-        user, password = b64decode(auth).decode().split(':')
-        self.assertEqual(user, 'metricuser')
-        self.assertEqual(password, 'metricpass')
-        self.assertEqual(result.get(),
-                         "Fired metric <foo.last> with value <1.0>")
+        self.add_identity_callback('identity-id')
+
+        identity1 = utils.get_identity('identity-id')
+        identity2 = utils.get_identity('identity-id')
+
+        self.assertEqual(identity1, identity2)
+        self.assertEqual(identity1['details'], {"state": "Abuja"})
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(utils.get_identity_cache_stats(),
+                         {"hits": 1, "misses": 1})
 
     @responses.activate
-    def test_created_metric(self):
+    def test_get_identity_not_found_not_cached(self):
         """
-        Ensure that when a new registration is created, all of the relevant
-        metrics are fired.
+        Identities that don't exist shouldn't be cached, so that they can be
+        found once they are created.
         """
-        # Setup
-        self.add_metrics_callback()
-        # reconnect metric post_save hook
-        post_save.connect(fire_created_metric, sender=Registration)
+        self.add_identity_callback('identity-id', status=404)
 
-        # Execute
-        self.make_registration_adminuser()
-        self.make_registration_adminuser()
+        self.assertEqual(utils.get_identity('identity-id'), None)
+        self.assertEqual(utils.get_identity('identity-id'), None)
 
-        # Check
-        [request1, request2, request3, request4] = responses.calls
-        self._check_request(
-            request1.request, 'POST',
-            data={"registrations.created.sum": 1.0}
-        )
-        self._check_request(
-            request2.request, 'POST',
-            data={"registrations.created.total.last": 1}
-        )
-        self._check_request(
-            request3.request, 'POST',
-            data={"registrations.created.sum": 1.0}
-        )
-        self._check_request(
-            request4.request, 'POST',
-            data={"registrations.created.total.last": 2}
-        )
-        # remove post_save hooks to prevent teardown errors
-        post_save.disconnect(fire_created_metric, sender=Registration)
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(utils.get_identity_cache_stats(),
+                         {"hits": 0, "misses": 2})
 
     @responses.activate
-    def test_source_metric(self):
-        # Setup
-        self.add_metrics_callback()
-        # reconnect metric post_save hook
-        post_save.connect(fire_source_metric, sender=Registration)
+    def test_patch_identity_invalidates(self):
+        """
+        Patching an identity should remove it from the cache.
+        """
+        self.add_identity_callback('identity-id')
+        responses.add(
+            responses.PATCH,
+            'http://localhost:8001/api/v1/identities/identity-id/',
+            json={"id": "identity-id"}, status=200,
+            content_type='application/json')
 
-        # Execute
-        self.make_registration_adminuser()
+        utils.get_identity('identity-id')
+        utils.patch_identity('identity-id', {"details": {}})
+        utils.get_identity('identity-id')
 
-        # Check
-        [request] = responses.calls
-        self._check_request(
-            request.request, 'POST',
-            data={"registrations.source.testadminuser.sum": 1.0}
-        )
-        # remove post_save hooks to prevent teardown errors
-        post_save.disconnect(fire_source_metric, sender=Registration)
+        self.assertEqual(
+            [call.request.method for call in responses.calls],
+            ['GET', 'PATCH', 'GET'])
 
-    @responses.activate
-    def test_unique_operator_metric_single(self):
-        # Setup
-        self.add_metrics_callback()
-        # reconnect operator metric post_save hook
-        post_save.connect(fire_unique_operator_metric, sender=Registration)
 
-        # Execute
-        self.make_registration_adminuser()
+class TestFanOut(TestCase):
 
-        # Check
-        [request] = responses.calls
-        self._check_request(
-            request.request, 'POST',
-            data={"registrations.unique_operators.sum": 1.0}
-        )
+    def setUp(self):
+        utils.get_identity_cache().clear()
 
-        # Teardown
-        # remove post_save hooks to prevent teardown errors
-        post_save.disconnect(fire_unique_operator_metric, sender=Registration)
+    def test_fan_out(self):
+        """
+        The results should be in the same order as the items, with the
+        exception for items that raised.
+        """
+        def double(item):
+            if item is None:
+                raise ValueError("No item")
+            return item * 2
 
-    @responses.activate
-    def test_unique_operator_metric_multiple(self):
-        # Setup
-        # deactivate Testsession for this test
-        self.session = None
-        # reconnect operator metric post_save hook
-        post_save.connect(fire_unique_operator_metric, sender=Registration)
-        # prep for a different operator
-        new_user_data = {
-            "stage": "prebirth",
-            "data": REG_DATA['hw_post'],
-            "source": self.make_source_adminuser()
-        }
+        results = utils.fan_out(double, [1, 2, None, 4], concurrency=3)
 
-        # add metric post response
-        responses.add(responses.POST,
-                      "http://metrics-url/metrics/",
-                      json={"foo": "bar"},
-                      status=200, content_type='application/json')
+        self.assertEqual(results[:2] + results[3:], [2, 4, 8])
+        self.assertIsInstance(results[2], ValueError)
+        self.assertEqual(utils.fan_out(double, []), [])
 
-        # Execute
-        self.make_registration_adminuser()
-        self.make_registration_adminuser()
-        self.make_registration_adminuser()
-        self.make_registration_adminuser(data=new_user_data)
+    def test_fan_out_defers_to_caller(self):
+        """
+        Calls that the pool threads defer should be made on the calling
+        thread, once the pool has finished.
+        """
+        threads = []
 
-        # Check
-        self.assertEqual(len(responses.calls), 2)
-        # remove post_save hooks to prevent teardown errors
-        post_save.disconnect(fire_unique_operator_metric, sender=Registration)
+        def record(item):
+            utils.defer_to_caller(
+                lambda: threads.append(threading.current_thread()))
+            return item
+
+        self.assertEqual(
+            utils.fan_out(record, [1, 2], concurrency=2), [1, 2])
+        self.assertEqual(threads, [threading.current_thread()] * 2)
 
     @responses.activate
-    def test_message_type_metric(self):
+    def test_get_identities(self):
         """
-        When creating a registration, two metrics should be fired for the
-        message type that the registration is created for, one of type sum, and
-        one of type last.
+        Each distinct identity should be fetched once, and returned in the
+        order of the ids, with None for missing identities and the exception
+        for identities that couldn't be fetched.
         """
-        self.add_metrics_callback()
-        post_save.connect(fire_message_type_metric, sender=Registration)
-
-        self.make_registration_adminuser()
+        for identity_id, code in (('id1', 200), ('id2', 200),
+                                  ('missing', 404), ('broken', 500)):
+            responses.add(
+                responses.GET,
+                'http://localhost:8001/api/v1/identities/%s/' % identity_id,
+                json=({"id": identity_id} if code == 200 else
+                      {"detail": "Not found."}),
+                status=code,
+                content_type='application/json')
+
+        identities = utils.get_identities(
+            ['id1', 'id2', 'id1', 'missing', 'broken'])
+
+        self.assertEqual(identities[:4], [
+            {"id": "id1"}, {"id": "id2"}, {"id": "id1"}, None])
+        self.assertIsInstance(identities[4], Exception)
+        self.assertEqual(len(responses.calls), 4)
 
-        [request_sum, request_last] = responses.calls
-        self._check_request(
-            request_sum.request, 'POST',
-            data={"registrations.msg_type.text.sum": 1.0}
-        )
-        self._check_request(
-            request_last.request, 'POST',
-            data={"registrations.msg_type.text.total.last": 1.0}
-        )
+    @responses.activate
+    def test_get_addresses(self):
+        """
+        The default addresses should be returned in the order of the ids.
+        """
+        for identity_id, address in (('id1', '+2341'), ('id2', '+2342')):
+            responses.add(
+                responses.GET,
+                'http://localhost:8001/api/v1/identities/%s/addresses/msisdn'
+                '?default=True' % identity_id,
+                json={"results": [{"address": address}]}, status=200,
+                content_type='application/json', match_querystring=True)
 
-        post_save.disconnect(fire_message_type_metric, sender=Registration)
+        self.assertEqual(
+            utils.get_addresses(['id2', 'id1']), ['+2342', '+2341'])
 
     @responses.activate
-    def test_receiver_type_metric(self):
+    def test_patch_subscriptions(self):
         """
-        When creating a registration, two metrics should be fired for the
-        receiver type that the registration is created for. One of type sum
-        with a value of 1, and one of type last with the current total.
+        All the subscriptions should be patched, and the results returned in
+        the same order.
         """
-        self.add_metrics_callback()
-        post_save.connect(fire_receiver_type_metric, sender=Registration)
+        for subscription_id in ('sub1', 'sub2'):
+            responses.add(
+                responses.PATCH,
+                'http://localhost:8005/api/v1/subscriptions/%s/' % (
+                    subscription_id),
+                json={"id": subscription_id, "active": False}, status=200,
+                content_type='application/json')
+
+        results = utils.patch_subscriptions([
+            ({"id": "sub1"}, {"active": False}),
+            ({"id": "sub2"}, {"active": False}),
+        ])
+
+        self.assertEqual(results, [
+            {"id": "sub1", "active": False}, {"id": "sub2", "active": False}])
+        self.assertEqual(
+            sorted(call.request.url for call in responses.calls), [
+                'http://localhost:8005/api/v1/subscriptions/sub1/',
+                'http://localhost:8005/api/v1/subscriptions/sub2/'])
+        self.assertEqual(
+            [json.loads(call.request.body) for call in responses.calls],
+            [{"active": False}, {"active": False}])
 
-        self.make_registration_adminuser()
 
-        [request_sum, request_total] = responses.calls
-        self._check_request(
-            request_sum.request, 'POST',
-            data={"registrations.receiver_type.mother_only.sum": 1.0}
-        )
-        self._check_request(
-            request_total.request, 'POST',
-            data={"registrations.receiver_type.mother_only.total.last": 1.0}
-        )
+class TestIterPages(TestCase):
 
-        post_save.disconnect(fire_receiver_type_metric, sender=Registration)
+    def add_page(self, query, results, next_query=None, status=200):
+        url = 'http://localhost:8001/api/v1/optouts/search/'
+        responses.add(
+            responses.GET, url + query,
+            json={
+                "next": url + next_query if next_query else None,
+                "results": results,
+            },
+            status=status, content_type='application/json',
+            match_querystring=True)
 
     @responses.activate
-    def test_receiver_type_metric_multiple(self):
+    def test_search_optouts_pages(self):
         """
-        When creating a registration, two metrics should be fired for the
-        receiver type that the registration is created for. One of type sum
-        with a value of 1, and one of type last with the current total.
+        The results of all the pages should be returned in order.
         """
-        self.add_metrics_callback()
-        post_save.connect(fire_receiver_type_metric, sender=Registration)
+        self.add_page('?reason=other', [{"id": 1}, {"id": 2}], '?cursor=2')
+        self.add_page('?cursor=2', [{"id": 3}], '?cursor=3')
+        self.add_page('?cursor=3', [{"id": 4}])
 
-        cache.clear()
-        self.make_registration_adminuser()
-        self.make_registration_adminuser()
+        optouts = utils.search_optouts({"reason": "other"})
 
-        [r_sum1, r_total1, r_sum2, r_total2] = responses.calls
-        self._check_request(
-            r_sum1.request, 'POST',
-            data={"registrations.receiver_type.mother_only.sum": 1.0}
-        )
+        self.assertEqual([o["id"] for o in optouts], [1, 2, 3, 4])
+        self.assertEqual(len(responses.calls), 3)
+
+    @responses.activate
+    def test_search_optouts_stop_early(self):
+        """
+        A caller that stops within the first page shouldn't cause the next
+        page to be fetched, and pages after the second one should be
+        prefetched on the shared pool.
+        """
+        self.add_page('', [{"id": 1}, {"id": 2}], '?cursor=2')
+        self.add_page('?cursor=2', [{"id": 3}], '?cursor=3')
+        self.add_page('?cursor=3', [{"id": 4}])
+
+        optouts = utils.search_optouts()
+        self.assertEqual(next(optouts), {"id": 1})
+        self.assertEqual(next(optouts), {"id": 2})
+        self.assertEqual(len(responses.calls), 1)
+
+        with mock.patch(
+                'hellomama_registration.utils.get_prefetch_pool',
+                wraps=utils.get_prefetch_pool) as mock_pool:
+            self.assertEqual(list(optouts), [{"id": 3}, {"id": 4}])
+        mock_pool.assert_called_once_with()
+        self.assertIs(utils.get_prefetch_pool(), utils.get_prefetch_pool())
+
+    @responses.activate
+    def test_search_optouts_page_error(self):
+        """
+        If a page that was fetched in the background fails, the error should
+        be raised to the caller after the earlier results.
+        """
+        self.add_page('', [{"id": 1}], '?cursor=2')
+        self.add_page('?cursor=2', [], status=500)
+
+        optouts = utils.search_optouts()
+
+        self.assertEqual(next(optouts), {"id": 1})
+        self.assertRaises(HTTPError, next, optouts)
+
+    @responses.activate
+    @override_settings(IDENTITY_STORE_SEARCH_PAGE_SIZE=500)
+    def test_search_identities_page_size(self):
+        """
+        The page size should be requested from the identity store.
+        """
+        responses.add(
+            responses.GET,
+            'http://localhost:8001/api/v1/identities/search/'
+            '?details__personnel_code=1234&page_size=500',
+            json={"next": None, "results": [{"id": "id1"}]},
+            status=200, content_type='application/json',
+            match_querystring=True)
+
+        identities = utils.search_identities(
+            "details__personnel_code", "1234")
+
+        self.assertEqual(list(identities), [{"id": "id1"}])
+
+
+@override_settings(MESSAGESET_CATALOGUE_TTL=300)
+class TestMessagesetCatalogue(TestCase):
+
+    def setUp(self):
+        utils.messageset_catalogue.clear()
+
+    def add_catalogue_callbacks(self):
+        responses.add(
+            responses.GET,
+            'http://localhost:8005/api/v1/messageset/',
+            json={
+                "next": None,
+                "previous": None,
+                "results": [{
+                    "id": 1,
+                    "short_name": 'prebirth.mother.text.10_42',
+                    "default_schedule": 1
+                }, {
+                    "id": 3,
+                    "short_name": 'prebirth.household.audio.10_42.fri.9_11',
+                    "default_schedule": 3
+                }]
+            },
+            status=200, content_type='application/json',
+            match_querystring=True
+        )
+        responses.add(
+            responses.GET,
+            'http://localhost:8005/api/v1/schedule/1/',
+            json={"id": 1, "day_of_week": "1,3,5"},
+            status=200, content_type='application/json',
+        )
+        responses.add(
+            responses.GET,
+            'http://localhost:8005/api/v1/schedule/3/',
+            json={"id": 3, "day_of_week": "5"},
+            status=200, content_type='application/json',
+        )
+
+    @responses.activate
+    def test_schedule_sequence_from_catalogue(self):
+        """
+        Once the catalogue is loaded, planning subscriptions shouldn't make
+        any more requests to Stage Based Messaging.
+        """
+        self.add_catalogue_callbacks()
+
+        result1 = utils.get_messageset_schedule_sequence(
+            'prebirth.mother.text.10_42', 28)
+        self.assertEqual(len(responses.calls), 3)
+
+        result2 = utils.get_messageset_schedule_sequence(
+            'prebirth.household.audio.10_42.fri.9_11', 28)
+        self.assertEqual(utils.get_messageset(1)["short_name"],
+                         'prebirth.mother.text.10_42')
+        self.assertEqual(utils.get_schedule(3)["day_of_week"], "5")
+
+        self.assertEqual(result1, (1, 1, 54))
+        self.assertEqual(result2, (3, 3, 18))
+        self.assertEqual(len(responses.calls), 3)
+        self.assertEqual(utils.messageset_catalogue.version, 1)
+
+    @responses.activate
+    def test_catalogue_refreshed_when_stale(self):
+        """
+        The catalogue should be reloaded once it is older than the TTL, and
+        the version should only change if the catalogue changed.
+        """
+        self.add_catalogue_callbacks()
+        utils.get_messageset(1)
+        self.assertEqual(len(responses.calls), 3)
+
+        utils.messageset_catalogue.loaded_at -= 301
+        utils.get_messageset(1)
+
+        self.assertEqual(len(responses.calls), 6)
+        self.assertEqual(utils.messageset_catalogue.version, 1)
+
+    @responses.activate
+    def test_stale_catalogue_served_during_refresh(self):
+        """
+        While another thread is reloading the catalogue, the stale catalogue
+        should be used instead of reloading it again.
+        """
+        self.add_catalogue_callbacks()
+        utils.get_messageset(1)
+        utils.messageset_catalogue.loaded_at -= 301
+
+        with utils.messageset_catalogue.refresh_lock:
+            messageset = utils.get_messageset(1)
+
+        self.assertEqual(messageset["short_name"],
+                         'prebirth.mother.text.10_42')
+        self.assertEqual(len(responses.calls), 3)
+
+    @responses.activate
+    def test_catalogue_refresh_backs_off(self):
+        """
+        If the catalogue can't be reloaded, the stale catalogue should be
+        used, and reloading it should only be tried again after the retry
+        interval.
+        """
+        self.add_catalogue_callbacks()
+        utils.get_messageset(1)
+        utils.messageset_catalogue.loaded_at -= 301
+        responses.reset()
+        responses.add(
+            responses.GET, 'http://localhost:8005/api/v1/messageset/',
+            json={"detail": "Server error"}, status=500,
+            content_type='application/json', match_querystring=True)
+
+        for i in range(2):
+            self.assertEqual(utils.get_messageset(1)["short_name"],
+                             'prebirth.mother.text.10_42')
+        self.assertEqual(len(responses.calls), 1)
+
+        utils.messageset_catalogue.failed_at -= 31
+        utils.get_messageset(1)
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_messageset_missing_from_catalogue(self):
+        """
+        Messagesets that were created since the catalogue was loaded should
+        be fetched and added to the catalogue.
+        """
+        self.add_catalogue_callbacks()
+        responses.add(
+            responses.GET,
+            'http://localhost:8005/api/v1/messageset/4/',
+            json={
+                "id": 4,
+                "short_name": 'public.mother.text.0_4',
+                "default_schedule": 1
+            },
+            status=200, content_type='application/json',
+        )
+
+        utils.get_messageset(4)
+        utils.get_messageset(4)
+
+        self.assertEqual(len(responses.calls), 4)
+        self.assertEqual(
+            utils.get_messageset_by_shortname('public.mother.text.0_4')["id"],
+            4)
+        self.assertEqual(len(responses.calls), 4)
+
+
+@override_settings(CACHES=dict(settings.CACHES, http={
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'test-http',
+}))
+class TestHTTPCache(TestCase):
+
+    def setUp(self):
+        utils.get_http_cache().clear()
+
+    def add_messageset_callback(self, statuses):
+        """ Responds to the requests for messageset 1 with the given statuses
+        in turn, 200 responses carrying validators.
+        """
+        statuses = iter(statuses)
+
+        def callback(request):
+            code = next(statuses)
+            if code != 200:
+                return (code, {}, '')
+            return (200, {
+                'ETag': '"v1"',
+                'Last-Modified': 'Mon, 12 Oct 2026 10:00:00 GMT',
+            }, json.dumps({"id": 1, "short_name": "prebirth.mother.text"}))
+
+        responses.add_callback(
+            responses.GET,
+            'http://localhost:8005/api/v1/messageset/1/',
+            callback=callback, content_type='application/json')
+
+    @responses.activate
+    def test_revalidated_with_validators(self):
+        """
+        Cached responses should be revalidated with their ETag and
+        Last-Modified, and a 304 should return the cached body.
+        """
+        self.add_messageset_callback([200, 304])
+
+        first = utils.get_messageset(1)
+        second = utils.get_messageset(1)
+
+        self.assertEqual(first, second)
+        self.assertEqual(second["short_name"], "prebirth.mother.text")
+        self.assertEqual(len(responses.calls), 2)
+        self.assertNotIn('If-None-Match', responses.calls[0].request.headers)
+        headers = responses.calls[1].request.headers
+        self.assertEqual(headers['If-None-Match'], '"v1"')
+        self.assertEqual(headers['If-Modified-Since'],
+                         'Mon, 12 Oct 2026 10:00:00 GMT')
+
+    @responses.activate
+    def test_cached_body_when_revalidation_fails(self):
+        """
+        If revalidating fails with a server error, the cached response should
+        be returned.
+        """
+        self.add_messageset_callback([200, 503])
+
+        utils.get_messageset(1)
+        messageset = utils.get_messageset(1)
+
+        self.assertEqual(messageset["short_name"], "prebirth.mother.text")
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    @override_settings(HTTP_CACHE_ENDPOINTS={'messageset': 60})
+    def test_not_revalidated_within_max_age(self):
+        """
+        Cached responses shouldn't be revalidated within the max age of their
+        endpoint.
+        """
+        self.add_messageset_callback([200])
+
+        utils.get_messageset(1)
+        messageset = utils.get_messageset(1)
+
+        self.assertEqual(messageset["short_name"], "prebirth.mother.text")
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    @override_settings(HTTP_CACHE_ENDPOINTS={'schedule': 60})
+    def test_endpoint_not_cached(self):
+        """
+        Endpoints that aren't configured shouldn't be cached.
+        """
+        self.add_messageset_callback([200, 200])
+
+        utils.get_messageset(1)
+        utils.get_messageset(1)
+
+        self.assertEqual(len(responses.calls), 2)
+        self.assertNotIn('If-None-Match', responses.calls[1].request.headers)
+
+
+@override_settings(CIRCUIT_BREAKER_FAILURE_THRESHOLD=2,
+                   CIRCUIT_BREAKER_RESET_TIMEOUT=30)
+class TestCircuitBreaker(TestCase):
+
+    def setUp(self):
+        self.breaker = utils.get_circuit_breaker('identity_store')
+        self.breaker.reset()
+        self.addCleanup(self.breaker.reset)
+
+    def add_identity_callback(self, statuses):
+        statuses = iter(statuses)
+        responses.add_callback(
+            responses.GET,
+            'http://localhost:8001/api/v1/identities/identity-uuid/',
+            callback=lambda request: (
+                next(statuses), {}, json.dumps({"id": "identity-uuid"})),
+            content_type='application/json')
+
+    @responses.activate
+    @mock.patch('registrations.tasks.queue_metrics')
+    def test_breaker_opens_after_failures(self, mock_queue):
+        """
+        After the threshold of consecutive failures, requests to the service
+        should fail immediately, and the breaker state should be reported.
+        """
+        self.add_identity_callback([503, 503])
+
+        for i in range(2):
+            with self.assertRaises(HTTPServiceError):
+                utils.identity_store_client.get_identity('identity-uuid')
+        self.assertEqual(self.breaker.state, 'open')
+
+        with self.assertRaises(utils.CircuitOpenError):
+            utils.identity_store_client.get_identity('identity-uuid')
+
+        self.assertEqual(len(responses.calls), 2)
+        mock_queue.assert_called_once_with(
+            {'downstream.identity_store.circuit_open.last': 1})
+        self.assertEqual(utils.get_circuit_breaker_states()['identity_store'],
+                         'open')
+
+    @responses.activate
+    @mock.patch('registrations.tasks.queue_metrics')
+    def test_breaker_closed_by_trial_request(self, mock_queue):
+        """
+        Once the reset timeout has passed, a successful trial request should
+        close the breaker.
+        """
+        self.add_identity_callback([503, 503, 200])
+        for i in range(2):
+            with self.assertRaises(HTTPServiceError):
+                utils.identity_store_client.get_identity('identity-uuid')
+
+        self.breaker.opened_at -= 31
+        self.assertEqual(self.breaker.state, 'half_open')
+        identity = utils.identity_store_client.get_identity('identity-uuid')
+
+        self.assertEqual(identity, {"id": "identity-uuid"})
+        self.assertEqual(self.breaker.state, 'closed')
+        mock_queue.assert_called_with(
+            {'downstream.identity_store.circuit_open.last': 0})
+
+    @mock.patch('hellomama_registration.utils.random.uniform')
+    def test_jittered_retry(self, mock_uniform):
+        """
+        The backoff should be jittered, and the retries should be counted on
+        the breaker.
+        """
+        mock_uniform.return_value = 0.25
+        retry = utils.JitteredRetry(
+            total=3, backoff_factor=1, breaker=self.breaker)
+        for i in range(2):
+            retry = retry.increment(
+                method='GET', url='/identities/',
+                error=ConnectTimeoutError())
+
+        self.assertEqual(retry.get_backoff_time(), 0.25)
+        mock_uniform.assert_called_once_with(0, 2)
+        self.assertEqual(self.breaker.retries, 2)
+
+
+@override_settings(REQUEST_MEMO=True)
+class TestRequestMemo(TestCase):
+
+    def add_identity_callbacks(self):
+        responses.add(
+            responses.GET,
+            'http://localhost:8001/api/v1/identities/identity-uuid/',
+            json={"id": "identity-uuid", "details": {"state": "Abuja"}},
+            status=200, content_type='application/json')
+        responses.add(
+            responses.PATCH,
+            'http://localhost:8001/api/v1/identities/identity-uuid/',
+            json={"id": "identity-uuid", "details": {"state": "Kano"}},
+            status=200, content_type='application/json')
+
+    @responses.activate
+    def test_get_deduplicated_within_unit_of_work(self):
+        """
+        Identical GETs within a unit of work should only be made once, and
+        the deduplicated requests should be counted.
+        """
+        self.add_identity_callbacks()
+        deduplicated = utils.get_memo_stats()["deduplicated"]
+
+        utils.begin_memo()
+        self.addCleanup(utils.end_memo)
+        first = utils.get_identity('identity-uuid')
+        second = utils.get_identity('identity-uuid')
+
+        self.assertEqual(first, second)
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(utils.get_memo_stats()["deduplicated"],
+                         deduplicated + 1)
+
+    @responses.activate
+    def test_memo_cleared_at_end_of_unit_of_work(self):
+        """
+        Responses shouldn't be memoised across units of work, or outside of
+        one.
+        """
+        self.add_identity_callbacks()
+
+        utils.begin_memo()
+        utils.get_identity('identity-uuid')
+        utils.end_memo()
+        utils.begin_memo()
+        utils.get_identity('identity-uuid')
+        utils.end_memo()
+        utils.get_identity('identity-uuid')
+        utils.get_identity('identity-uuid')
+
+        self.assertEqual(len(responses.calls), 4)
+
+    @responses.activate
+    @override_settings(REQUEST_MEMO_MAX_SIZE=1)
+    def test_memo_max_size(self):
+        """
+        Only the most recently used responses should be kept, up to
+        REQUEST_MEMO_MAX_SIZE.
+        """
+        self.add_identity_callbacks()
+        responses.add(
+            responses.GET,
+            'http://localhost:8001/api/v1/identities/other-uuid/',
+            json={"id": "other-uuid", "details": {}},
+            status=200, content_type='application/json')
+
+        utils.begin_memo()
+        self.addCleanup(utils.end_memo)
+        utils.get_identity('identity-uuid')
+        utils.get_identity('identity-uuid')
+        utils.get_identity('other-uuid')
+        utils.get_identity('identity-uuid')
+
+        self.assertEqual(len(responses.calls), 3)
+        self.assertEqual(len(utils.get_memo()), 1)
+
+    @responses.activate
+    def test_memo_cleared_by_write(self):
+        """
+        A write to a downstream service should discard the memoised
+        responses.
+        """
+        self.add_identity_callbacks()
+
+        utils.begin_memo()
+        self.addCleanup(utils.end_memo)
+        utils.get_identity('identity-uuid')
+        utils.patch_identity('identity-uuid', {"details": {"state": "Kano"}})
+        utils.get_identity('identity-uuid')
+
+        self.assertEqual(len(responses.calls), 3)
+
+
+class TestMetrics(AuthenticatedAPITestCase):
+
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        # The metrics are only calculated once the registration is committed
+        patcher = mock.patch(
+            'django.db.transaction.on_commit', side_effect=lambda f: f())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def add_metrics_callback(self):
+        responses.add(
+            responses.POST, "http://metrics-url/metrics/",
+            json={}, status=200, content_type='application/json')
+
+    def add_identity_callback(self, identity_id, details={}):
+        responses.add(
+            responses.GET,
+            'http://localhost:8001/api/v1/identities/%s/' % identity_id,
+            json={"id": identity_id, "details": details},
+            status=200, content_type='application/json')
+
+    def get_fired_metrics(self):
+        return [
+            json.loads(call.request.body) for call in responses.calls
+            if call.request.url == "http://metrics-url/metrics/"]
+
+    @responses.activate
+    @override_settings(METRICS_AUTH=('metricuser', 'metricpass'))
+    def test_direct_fire(self):
+        """
+        When calling the `fire_metric` task, it should make a POST request
+        to the metrics API, with the correct details.
+        """
+        # Setup
+        self.add_metrics_callback()
+        # Execute
+        result = tasks.fire_metric.apply_async(kwargs={
+            "metric_name": 'foo.last',
+            "metric_value": 1,
+        })
+        # Check
+        [request] = responses.calls
         self._check_request(
-            r_total1.request, 'POST',
-            data={"registrations.receiver_type.mother_only.total.last": 1.0}
+            request.request, 'POST',
+            data={"foo.last": 1.0}
         )
+        _, auth = request.request.headers['Authorization'].split()
+        user, password = b64decode(auth).decode().split(':')
+        self.assertEqual(user, 'metricuser')
+        self.assertEqual(password, 'metricpass')
+        self.assertEqual(result.get(),
+                         "Fired metric <foo.last> with value <1.0>")
+
+    @responses.activate
+    def test_direct_fire_metrics(self):
+        """
+        When calling the `fire_metrics` task, it should make a single POST
+        request to the metrics API containing all of the metrics.
+        """
+        # Setup
+        self.add_metrics_callback()
+        # Execute
+        result = tasks.fire_metrics.apply_async(kwargs={
+            "metrics": {"foo.sum": 1, "bar.last": "2"},
+        })
+        # Check
+        [request] = responses.calls
         self._check_request(
-            r_sum2.request, 'POST',
-            data={"registrations.receiver_type.mother_only.sum": 1.0}
+            request.request, 'POST',
+            data={"foo.sum": 1.0, "bar.last": 2.0}
         )
+        self.assertEqual(result.get(), "Fired 2 metrics")
+
+    @responses.activate
+    def test_queue_metrics(self):
+        """
+        Without METRICS_AGGREGATE, all of the metrics should be fired in a
+        single request.
+        """
+        self.add_metrics_callback()
+
+        tasks.queue_metrics({"foo.sum": 1, "bar.last": 2})
+
+        [request] = responses.calls
         self._check_request(
-            r_total2.request, 'POST',
-            data={"registrations.receiver_type.mother_only.total.last": 2.0}
+            request.request, 'POST',
+            data={"foo.sum": 1.0, "bar.last": 2.0}
         )
 
-        post_save.disconnect(fire_receiver_type_metric, sender=Registration)
+    def test_buffer_metrics(self):
+        """
+        Buffered sums should be added together, and only the latest value of
+        totals should be kept.
+        """
+        buffer_metrics({"foo.sum": 1, "foo.total.last": 5})
+        buffer_metrics({"foo.sum": 1, "foo.total.last": 6, "bar.sum": 2})
+        buffer_metrics({"foo.total.last": 3}, replace_last=False)
+
+        self.assertEqual(pop_buffered_metrics(), {
+            "foo.sum": 2.0, "foo.total.last": 6.0, "bar.sum": 2.0})
+        self.assertEqual(pop_buffered_metrics(), {})
+
+    @responses.activate
+    def test_flush_metrics(self):
+        """
+        All the buffered metrics should be fired in a single request, and
+        nothing should be fired if the buffer is empty.
+        """
+        self.add_metrics_callback()
+        buffer_metrics({"foo.sum": 1, "foo.total.last": 5})
+        buffer_metrics({"foo.sum": 1, "foo.total.last": 6})
+
+        self.assertEqual(tasks.flush_metrics.run(), "Fired 2 metrics")
+        self.assertEqual(tasks.flush_metrics.run(), "Fired 0 metrics")
+
+        self.assertEqual(
+            self.get_fired_metrics(),
+            [{"foo.sum": 2.0, "foo.total.last": 6.0}])
+        self.assertFalse(MetricBuffer.objects.exists())
+
+    @responses.activate
+    def test_flush_metrics_error(self):
+        """
+        If the metrics can't be fired, they should be kept for the next
+        flush, without replacing newer totals.
+        """
+        buffer_metrics({"foo.sum": 1, "foo.total.last": 5})
+
+        def fire_metrics(**metrics):
+            buffer_metrics({"foo.sum": 1, "foo.total.last": 6})
+            raise ConnectTimeout()
+
+        with mock.patch('registrations.tasks.get_metric_client') as client:
+            client.return_value.fire_metrics.side_effect = fire_metrics
+            self.assertRaises(ConnectTimeout, tasks.flush_metrics.run)
+
+        self.assertEqual(pop_buffered_metrics(), {
+            "foo.sum": 2.0, "foo.total.last": 6.0})
+
+    @responses.activate
+    @override_settings(METRICS_AGGREGATE=True)
+    def test_registration_metrics_aggregated(self):
+        """
+        With METRICS_AGGREGATE, the metrics for registrations and changes
+        should be added to the buffer instead of being fired.
+        """
+        self.add_metrics_callback()
+        self.add_identity_callback(REG_DATA['hw_pre_mother']['operator_id'])
+        post_save.connect(fire_registration_metrics, sender=Registration)
+
+        cache.clear()
+        self.make_registration_adminuser()
+        self.make_registration_adminuser()
+        tasks.queue_metric('registrations.change.language.sum', 1.0)
+
+        self.assertEqual(self.get_fired_metrics(), [])
+        metrics = pop_buffered_metrics()
+        self.assertEqual(metrics["registrations.created.sum"], 2.0)
+        self.assertEqual(metrics["registrations.created.total.last"], 2.0)
+        self.assertEqual(metrics["registrations.change.language.sum"], 1.0)
+
+        post_save.disconnect(fire_registration_metrics, sender=Registration)
+
+    def mock_scheduled_metric_searches(self, subscriptions=True):
+        if subscriptions:
+            self.mock_subscription_search('active=True&messageset=1', [
+                {"id": "sub1", "messageset": 1},
+                {"id": "sub2", "messageset": 1},
+            ])
+        else:
+            responses.add(
+                responses.GET,
+                'http://localhost:8005/api/v1/subscriptions/'
+                '?active=True&messageset=1',
+                json={"detail": "Server error"}, status=500,
+                content_type='application/json', match_querystring=True)
+        self.mock_subscription_search('active=True&messageset=2', [])
+        responses.add(
+            responses.GET, 'http://localhost:8005/api/v1/messageset/',
+            json={"next": None, "previous": None, "results": [
+                {"id": 1, "short_name": "prebirth.mother.text.10_42"},
+                {"id": 2, "short_name": "postbirth.mother.text.0_12"},
+            ]},
+            status=200, content_type='application/json',
+            match_querystring=True)
+        responses.add(
+            responses.GET, 'http://localhost:8001/api/v1/optouts/search/',
+            json={"next": None, "previous": None, "results": [
+                {"identity": "id1", "reason": "miscarriage"},
+                {"identity": "id2", "reason": "miscarriage"},
+                {"identity": "id3", "reason": "unknown"},
+            ]},
+            status=200, content_type='application/json',
+            match_querystring=True)
+
+    @responses.activate
+    def test_scheduled_metrics(self):
+        """
+        The scheduled metrics should be calculated with a search per
+        messageset and a query or search per group, and fired in a single
+        request. The totals that are already counted should be used, and
+        not be changed.
+        """
+        self.add_metrics_callback()
+        self.mock_scheduled_metric_searches()
+        Operator.objects.create(
+            operator_id=REG_DATA['hw_pre_mother']['operator_id'],
+            facility_name='Garki Hospital', refreshed_at=timezone.now())
+        self.make_registration_adminuser()
+        self.make_registration_adminuser()
+        MetricCounter.objects.create(
+            name='optout.reason.miscarriage.total.last', value=7)
+
+        result = tasks.scheduled_metrics.run()
+
+        self.assertEqual(result, "Fired 8 scheduled metrics, 0 errors")
+        self.assertEqual(self.get_fired_metrics(), [{
+            "subscriptions.messageset.prebirth_mother_text_10_42.active.last":
+                2.0,
+            "subscriptions.messageset.postbirth_mother_text_0_12.active.last":
+                0.0,
+            "registrations.facility.garki_hospital.total.last": 2.0,
+            "optout.reason.miscarriage.total.last": 7.0,
+            "optout.reason.stillborn.total.last": 0.0,
+            "optout.reason.baby_death.total.last": 0.0,
+            "optout.reason.not_useful.total.last": 0.0,
+            "optout.reason.other.total.last": 1.0,
+        }])
+        self.assertEqual(MetricCounter.objects.get(
+            name='optout.reason.miscarriage.total.last').value, 7)
+
+    @responses.activate
+    @override_settings(METRICS_SCHEDULED_TASKS=['optouts_per_reason'])
+    def test_scheduled_metrics_counted_optouts(self):
+        """
+        If all the optout reasons have been counted, the optouts shouldn't be
+        searched for.
+        """
+        self.add_metrics_callback()
+        for i, reason in enumerate(settings.OPTOUT_REASONS):
+            MetricCounter.objects.create(
+                name='optout.reason.%s.total.last' % reason, value=i)
+
+        result = tasks.scheduled_metrics.run()
+
+        self.assertEqual(result, "Fired 5 scheduled metrics, 0 errors")
+        self.assertEqual(self.get_fired_metrics(), [dict(
+            ('optout.reason.%s.total.last' % reason, float(i))
+            for i, reason in enumerate(settings.OPTOUT_REASONS))])
+
+    @responses.activate
+    @override_settings(METRICS_SCHEDULED_TASKS=[
+        'active_subscriptions', 'optouts_per_reason'])
+    def test_scheduled_metrics_error(self):
+        """
+        If a group of metrics can't be calculated, the other groups should
+        still be fired.
+        """
+        self.add_metrics_callback()
+        # A subscription search fails with a server error
+        self.mock_scheduled_metric_searches(subscriptions=False)
+
+        result = tasks.scheduled_metrics.run()
+
+        self.assertEqual(result, "Fired 5 scheduled metrics, 1 errors")
+        self.assertEqual(self.get_fired_metrics(), [{
+            "optout.reason.miscarriage.total.last": 2.0,
+            "optout.reason.stillborn.total.last": 0.0,
+            "optout.reason.baby_death.total.last": 0.0,
+            "optout.reason.not_useful.total.last": 0.0,
+            "optout.reason.other.total.last": 1.0,
+        }])
+
+    def get_rollups(self):
+        return sorted(
+            (r.day.isoformat(), r.dimension, r.value, r.count)
+            for r in DailyRollup.objects.all())
 
     @responses.activate
-    def test_message_type_metric_multiple(self):
+    def test_registration_rollups(self):
         """
-        When creating a registration, two metrics should be fired for the
-        message type that the registration is created for, one of type sum, and
-        one of type last. The sum metric should always be one, the last metric
-        should increment for each registration of that type.
+        Newly created registrations should be added to the daily rollups,
+        with the state and role of their operator.
         """
         self.add_metrics_callback()
-        post_save.connect(fire_message_type_metric, sender=Registration)
+        self.add_identity_callback(
+            REG_DATA['hw_pre_mother']['operator_id'],
+            {"state": "Abuja", "role": "Midwife"})
+        post_save.connect(fire_registration_metrics, sender=Registration)
 
         cache.clear()
-        self.make_registration_adminuser()
-        self.make_registration_adminuser()
+        source = self.make_source_adminuser()
+        for _ in range(2):
+            registration = self.make_registration_adminuser({
+                "stage": "prebirth",
+                "data": REG_DATA['hw_pre_mother'],
+                "source": source,
+            })
 
-        [r_sum1, r_last1, r_sum2, r_last2] = responses.calls
-        self._check_request(
-            r_sum1.request, 'POST',
-            data={"registrations.msg_type.text.sum": 1.0}
-        )
-        self._check_request(
-            r_last1.request, 'POST',
-            data={"registrations.msg_type.text.total.last": 1.0}
-        )
-        self._check_request(
-            r_sum2.request, 'POST',
-            data={"registrations.msg_type.text.sum": 1.0}
-        )
-        self._check_request(
-            r_last2.request, 'POST',
-            data={"registrations.msg_type.text.total.last": 2.0}
-        )
+        day = registration.created_at.date().isoformat()
+        source = str(source.id)
+        self.assertEqual(self.get_rollups(), [
+            (day, 'created', '', 2),
+            (day, 'language', 'eng_NG', 2),
+            (day, 'msg_receiver', 'mother_only', 2),
+            (day, 'msg_type', 'text', 2),
+            (day, 'role', 'midwife', 2),
+            (day, 'source', source, 2),
+            (day, 'state', 'abuja', 2),
+        ])
+        post_save.disconnect(fire_registration_metrics, sender=Registration)
+
+    def test_rebuild_rollups(self):
+        """
+        Rebuilding should replace the rollups of the days in the range with
+        the counts of the registrations created on those days, and leave the
+        other days alone.
+        """
+        Operator.objects.create(
+            operator_id=REG_DATA['hw_pre_mother']['operator_id'],
+            state='abuja', refreshed_at=timezone.now())
+        source = self.make_source_adminuser()
+        for day in (1, 2, 2, 4):
+            registration = self.make_registration_adminuser({
+                "stage": "prebirth",
+                "data": REG_DATA['hw_pre_mother'],
+                "source": source,
+            })
+            registration.created_at = datetime(
+                2016, 1, day, 23, 59, tzinfo=timezone.utc)
+            registration.save()
+            mark_registration_counted(registration.id)
+        # Not counted yet, so it is left for its metrics task to add
+        registration = self.make_registration_adminuser({
+            "stage": "prebirth",
+            "data": REG_DATA['hw_pre_mother'],
+            "source": source,
+        })
+        registration.created_at = datetime(
+            2016, 1, 2, 12, 0, tzinfo=timezone.utc)
+        registration.save()
+        source = str(source.id)
+        DailyRollup.objects.create(
+            day=datetime(2016, 1, 2).date(), dimension='created', count=10)
+        DailyRollup.objects.create(
+            day=datetime(2016, 1, 4).date(), dimension='created', count=10)
+
+        created = rebuild_rollups(
+            datetime(2016, 1, 1).date(), datetime(2016, 1, 3).date())
+
+        self.assertEqual(created, 12)
+        self.assertEqual(
+            [r for r in self.get_rollups() if r[0] == '2016-01-02'], [
+                ('2016-01-02', 'created', '', 2),
+                ('2016-01-02', 'language', 'eng_NG', 2),
+                ('2016-01-02', 'msg_receiver', 'mother_only', 2),
+                ('2016-01-02', 'msg_type', 'text', 2),
+                ('2016-01-02', 'source', source, 2),
+                ('2016-01-02', 'state', 'abuja', 2),
+            ])
+        self.assertEqual(sum_rollups('created'), {'': 13})
+        self.assertEqual(
+            sum_rollups('created', end_day=datetime(2016, 1, 3).date()),
+            {'': 3})
+        self.assertEqual(
+            sum_rollups('state', start_day=datetime(2016, 1, 2).date()),
+            {'abuja': 2})
 
-        post_save.disconnect(fire_message_type_metric, sender=Registration)
+    @responses.activate
+    def test_rebuild_rollups_before_metrics_task(self):
+        """
+        A registration that is rebuilt before its metrics task has run
+        should only be counted once, by the task.
+        """
+        self.add_metrics_callback()
+        self.add_identity_callback(REG_DATA['hw_pre_mother']['operator_id'])
+        registration = self.make_registration_adminuser({
+            "stage": "prebirth",
+            "data": REG_DATA['hw_pre_mother'],
+            "source": self.make_source_adminuser(),
+        })
+        day = registration.created_at.date()
+
+        rebuild_rollups(day, day)
+        self.assertEqual(sum_rollups('created'), {})
+        tasks.calculate_registration_metrics.run(str(registration.id))
+        self.assertEqual(sum_rollups('created'), {'': 1})
+        rebuild_rollups(day, day)
+        self.assertEqual(sum_rollups('created'), {'': 1})
+
+    def test_rebuild_daily_rollups_task(self):
+        """
+        By default, the task should rebuild the last
+        DAILY_ROLLUP_REBUILD_DAYS days.
+        """
+        today = timezone.now().date()
+        with mock.patch('registrations.tasks.rebuild_rollups') as rebuild:
+            rebuild.return_value = 3
+            result = tasks.rebuild_daily_rollups.run()
+
+        start = today - timedelta(days=settings.DAILY_ROLLUP_REBUILD_DAYS - 1)
+        rebuild.assert_called_once_with(start, today)
+        self.assertEqual(
+            result, "Rebuilt 3 rollups from %s to %s" % (start, today))
+
+    def test_rebuild_daily_rollups_task_backfill(self):
+        """
+        With backfill, the task should rebuild from the day of the first
+        registration or change.
+        """
+        today = timezone.now().date()
+        with mock.patch('registrations.tasks.rebuild_rollups') as rebuild:
+            self.assertEqual(
+                tasks.rebuild_daily_rollups.run(backfill=True),
+                "No registrations or changes to rebuild rollups for")
+
+            registration = self.make_registration_adminuser({
+                "stage": "prebirth",
+                "data": REG_DATA['hw_pre_mother'],
+                "source": self.make_source_adminuser(),
+            })
+            registration.created_at = datetime(
+                2016, 1, 2, 23, 59, tzinfo=timezone.utc)
+            registration.save()
+            rebuild.return_value = 3
+            tasks.rebuild_daily_rollups.run(backfill=True)
+
+        rebuild.assert_called_once_with(datetime(2016, 1, 2).date(), today)
 
     @responses.activate
-    def test_language_metric(self):
+    def test_registration_metrics(self):
         """
-        When creating a registration, two metrics should be fired for the
-        receiver type that the registration is created for. One of type sum
-        with a value of 1, and one of type last with the current total.
+        When a new registration is created, all of the relevant metrics should
+        be fired in a single request to the metrics API.
         """
+        # Setup
         self.add_metrics_callback()
-        post_save.connect(fire_language_metric, sender=Registration)
+        self.add_identity_callback(REG_DATA['hw_pre_mother']['operator_id'])
+        post_save.connect(fire_registration_metrics, sender=Registration)
 
+        # Execute
         cache.clear()
         self.make_registration_adminuser()
         self.make_registration_adminuser()
 
-        [r_sum1, r_total1, r_sum2, r_total2] = responses.calls
-        self._check_request(
-            r_sum1.request, 'POST',
-            data={"registrations.language.eng_NG.sum": 1.0}
-        )
-        self._check_request(
-            r_total1.request, 'POST',
-            data={"registrations.language.eng_NG.total.last": 1.0}
-        )
-        self._check_request(
-            r_sum2.request, 'POST',
-            data={"registrations.language.eng_NG.sum": 1.0}
-        )
-        self._check_request(
-            r_total2.request, 'POST',
-            data={"registrations.language.eng_NG.total.last": 2.0}
-        )
+        # Check
+        [metrics1, metrics2] = self.get_fired_metrics()
+        self.assertEqual(metrics1, {
+            "registrations.created.sum": 1.0,
+            "registrations.created.total.last": 1.0,
+            "registrations.source.testadminuser.sum": 1.0,
+            "registrations.unique_operators.sum": 1.0,
+            "registrations.msg_type.text.sum": 1.0,
+            "registrations.msg_type.text.total.last": 1.0,
+            "registrations.receiver_type.mother_only.sum": 1.0,
+            "registrations.receiver_type.mother_only.total.last": 1.0,
+            "registrations.language.eng_NG.sum": 1.0,
+            "registrations.language.eng_NG.total.last": 1.0,
+        })
+        self.assertEqual(metrics2, {
+            "registrations.created.sum": 1.0,
+            "registrations.created.total.last": 2.0,
+            "registrations.source.testadminuser.sum": 1.0,
+            "registrations.msg_type.text.sum": 1.0,
+            "registrations.msg_type.text.total.last": 2.0,
+            "registrations.receiver_type.mother_only.sum": 1.0,
+            "registrations.receiver_type.mother_only.total.last": 2.0,
+            "registrations.language.eng_NG.sum": 1.0,
+            "registrations.language.eng_NG.total.last": 2.0,
+        })
+        # remove post_save hooks to prevent teardown errors
+        post_save.disconnect(fire_registration_metrics, sender=Registration)
 
-        post_save.disconnect(fire_language_metric, sender=Registration)
+    def test_get_or_incr_counter(self):
+        """
+        Counters should be seeded from the given function once, and then be
+        incremented.
+        """
+        seed = mock.Mock(return_value=5)
 
-    def identity_callback(self, request):
-        headers = {'Content-Type': "application/json"}
-        resp = {
-            "id": "test_id",
-            "version": 1,
-            "details": {"state": "Abuja", "role": "Midwife"},
-            "communicate_through": None,
-            "operator": None,
-            "created_at": "2016-09-14T17:18:41.629909Z",
-            "created_by": 1,
-            "updated_at": "2016-09-14T17:18:41.629942Z",
-            "updated_by": 1
-        }
-        return (200, headers, json.dumps(resp))
-
-    def identity_search_callback(self, request):
-        headers = {'Content-Type': "application/json"}
-        resp = {
-            "next": None,
-            "previous": None,
-            "results": [{
-                "id": "nurse000-6a07-4377-a4f6-c0485ccba234",
-                "version": 1,
-                "details": {"state": "Abuja", "role": "Midwife"},
-                "communicate_through": None,
-                "operator": None,
-                "created_at": "2016-09-14T17:18:41.629909Z",
-                "created_by": 1,
-                "updated_at": "2016-09-14T17:18:41.629942Z",
-                "updated_by": 1
-            }, ]
-        }
-        return (200, headers, json.dumps(resp))
+        self.assertEqual(get_or_incr_counter('foo.total.last', seed), 5)
+        self.assertEqual(get_or_incr_counter('foo.total.last', seed), 6)
+        self.assertEqual(get_or_incr_counter('foo.total.last', seed), 7)
+
+        seed.assert_called_once_with()
+        self.assertEqual(
+            MetricCounter.objects.get(name='foo.total.last').value, 7)
+
+    @responses.activate
+    def test_registration_metrics_calculated_in_task(self):
+        """
+        Creating a registration should only queue the metrics task, without
+        making any requests to the identity store.
+        """
+        post_save.connect(fire_registration_metrics, sender=Registration)
+
+        with mock.patch(
+                'registrations.tasks.calculate_registration_metrics'
+                '.apply_async') as mock_task:
+            registration = self.make_registration_adminuser()
+
+        mock_task.assert_called_once_with(kwargs={
+            "registration_id": str(registration.id),
+        })
+        self.assertEqual(len(responses.calls), 0)
+        post_save.disconnect(fire_registration_metrics, sender=Registration)
 
     @responses.activate
-    def test_state_metric(self):
+    def test_registration_metrics_counted_once(self):
         """
-        When creating a registration, two metrics should be fired for the
-        state that the user is registered in. One of type sum with a value of
-        1, and one of type last with the current total.
+        Rerunning the metrics task for a registration shouldn't increment its
+        counters again.
         """
         self.add_metrics_callback()
-        post_save.connect(fire_state_metric, sender=Registration)
+        registration = self.make_registration_adminuser(data={
+            "stage": "prebirth",
+            "data": {},
+            "source": self.make_source_adminuser()
+        })
 
-        operator_id = REG_DATA['hw_pre_mother']['operator_id']
+        tasks.calculate_registration_metrics.run(str(registration.id))
+        result = tasks.calculate_registration_metrics.run(
+            str(registration.id))
 
-        url = 'http://localhost:8001/api/v1/identities/' + operator_id + "/"
-        responses.add_callback(
-            responses.GET, url, callback=self.identity_callback,
-            content_type="application/json")
+        self.assertEqual(
+            result,
+            "Metrics for registration %s were already counted" % (
+                registration.id,))
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(MetricCounter.objects.get(
+            name='registrations.created.total.last').value, 1)
 
-        url = 'http://localhost:8001/api/v1/identities/search/?' \
-              'details__state=Abuja'
-        responses.add_callback(
-            responses.GET, url, callback=self.identity_search_callback,
-            match_querystring=True, content_type="application/json")
+    @responses.activate
+    def test_registration_metrics_without_data(self):
+        """
+        Registrations without data should still fire the created and source
+        metrics, without trying to look up an operator.
+        """
+        # Setup
+        self.add_metrics_callback()
+        post_save.connect(fire_registration_metrics, sender=Registration)
 
+        # Execute
         cache.clear()
-        self.make_registration_adminuser()
-        self.make_registration_adminuser()
+        self.make_registration_adminuser(data={
+            "stage": "prebirth",
+            "data": {},
+            "source": self.make_source_adminuser()
+        })
 
-        [_, r_sum1, _, r_total1, _, r_sum2, _, r_total2] = responses.calls
-        self._check_request(
-            r_sum1.request, 'POST',
-            data={"registrations.state.abuja.sum": 1.0}
-        )
-        self._check_request(
-            r_total1.request, 'POST',
-            data={"registrations.state.abuja.total.last": 1.0}
-        )
-        self._check_request(
-            r_sum2.request, 'POST',
-            data={"registrations.state.abuja.sum": 1.0}
-        )
+        # Check
+        [request] = responses.calls
         self._check_request(
-            r_total2.request, 'POST',
-            data={"registrations.state.abuja.total.last": 2.0}
+            request.request, 'POST',
+            data={
+                "registrations.created.sum": 1.0,
+                "registrations.created.total.last": 1.0,
+                "registrations.source.testadminuser.sum": 1.0,
+            }
         )
+        post_save.disconnect(fire_registration_metrics, sender=Registration)
+
+    @responses.activate
+    def test_unique_operator_metric_multiple(self):
+        # Setup
+        self.add_metrics_callback()
+        self.add_identity_callback(REG_DATA['hw_pre_mother']['operator_id'])
+        self.add_identity_callback(REG_DATA['hw_post']['operator_id'])
+        post_save.connect(fire_registration_metrics, sender=Registration)
+        # prep for a different operator
+        new_user_data = {
+            "stage": "prebirth",
+            "data": REG_DATA['hw_post'],
+            "source": self.make_source_adminuser()
+        }
+
+        # Execute
+        self.make_registration_adminuser()
+        self.make_registration_adminuser()
+        self.make_registration_adminuser()
+        self.make_registration_adminuser(data=new_user_data)
 
-        post_save.disconnect(fire_state_metric, sender=Registration)
+        # Check
+        self.assertEqual(
+            ["registrations.unique_operators.sum" in metrics
+             for metrics in self.get_fired_metrics()],
+            [True, False, False, True])
+        # remove post_save hooks to prevent teardown errors
+        post_save.disconnect(fire_registration_metrics, sender=Registration)
 
     @responses.activate
-    def test_role_metric(self):
+    def test_registration_metrics_invalid_values(self):
         """
-        When creating a registration, two metrics should be fired for the
-        role that the user is registered as. One of type sum with a value of
-        1, and one of type last with the current total.
+        Values that aren't configured for a dimension shouldn't fire metrics
+        for that dimension.
         """
+        # Setup
         self.add_metrics_callback()
-        post_save.connect(fire_role_metric, sender=Registration)
+        self.add_identity_callback(
+            REG_DATA['hw_pre_mother']['operator_id'],
+            {"state": "Unknown State", "role": "Unknown Role"})
+        post_save.connect(fire_registration_metrics, sender=Registration)
+        data = REG_DATA['hw_pre_mother'].copy()
+        data.update({
+            "msg_type": "telepathy",
+            "msg_receiver": "neighbour_only",
+            "language": "xho_ZA",
+        })
 
-        operator_id = REG_DATA['hw_pre_mother']['operator_id']
+        # Execute
+        cache.clear()
+        self.make_registration_adminuser(data={
+            "stage": "prebirth",
+            "data": data,
+            "source": self.make_source_adminuser()
+        })
 
-        url = 'http://localhost:8001/api/v1/identities/' + operator_id + "/"
-        responses.add_callback(
-            responses.GET, url, callback=self.identity_callback,
-            content_type="application/json")
+        # Check
+        [metrics] = self.get_fired_metrics()
+        self.assertEqual(sorted(metrics.keys()), [
+            "registrations.created.sum",
+            "registrations.created.total.last",
+            "registrations.source.testadminuser.sum",
+            "registrations.unique_operators.sum",
+        ])
+        post_save.disconnect(fire_registration_metrics, sender=Registration)
 
-        url = 'http://localhost:8001/api/v1/identities/search/?' \
-              'details__role=Midwife'
-        responses.add_callback(
-            responses.GET, url, callback=self.identity_search_callback,
-            match_querystring=True, content_type="application/json")
+    @responses.activate
+    def test_state_and_role_metrics(self):
+        """
+        When creating a registration, metrics should be fired for the state
+        and the role of the operator. One of type sum with a value of 1, and
+        one of type last with the current total.
+        """
+        self.add_metrics_callback()
+        operator_id = REG_DATA['hw_pre_mother']['operator_id']
+        self.add_identity_callback(
+            operator_id, {"state": "Abuja", "role": "Midwife"})
+        post_save.connect(fire_registration_metrics, sender=Registration)
 
         cache.clear()
         self.make_registration_adminuser()
         self.make_registration_adminuser()
 
-        [_, r_sum1, _, r_total1, _, r_sum2, _, r_total2] = responses.calls
-        self._check_request(
-            r_sum1.request, 'POST',
-            data={"registrations.role.midwife.sum": 1.0}
-        )
-        self._check_request(
-            r_total1.request, 'POST',
-            data={"registrations.role.midwife.total.last": 1.0}
-        )
-        self._check_request(
-            r_sum2.request, 'POST',
-            data={"registrations.role.midwife.sum": 1.0}
-        )
-        self._check_request(
-            r_total2.request, 'POST',
-            data={"registrations.role.midwife.total.last": 2.0}
-        )
+        [metrics1, metrics2] = self.get_fired_metrics()
+        self.assertEqual(metrics1["registrations.state.abuja.sum"], 1.0)
+        self.assertEqual(
+            metrics1["registrations.state.abuja.total.last"], 1.0)
+        self.assertEqual(metrics1["registrations.role.midwife.sum"], 1.0)
+        self.assertEqual(
+            metrics1["registrations.role.midwife.total.last"], 1.0)
+        self.assertEqual(metrics2["registrations.state.abuja.sum"], 1.0)
+        self.assertEqual(
+            metrics2["registrations.state.abuja.total.last"], 2.0)
+        self.assertEqual(metrics2["registrations.role.midwife.sum"], 1.0)
+        self.assertEqual(
+            metrics2["registrations.role.midwife.total.last"], 2.0)
+
+        # The operator is only looked up once per registration
+        identity_lookups = [
+            call for call in responses.calls
+            if call.request.url.endswith(operator_id + "/")]
+        self.assertEqual(len(identity_lookups), 2)
+
+        # The operator is kept in the Operator table
+        operator = Operator.objects.get(operator_id=operator_id)
+        self.assertEqual(operator.state, "abuja")
+        self.assertEqual(operator.role, "midwife")
+
+        post_save.disconnect(fire_registration_metrics, sender=Registration)
+
+    def test_first_seen_operator_recorded_on_create(self):
+        """
+        The operator's first registration should only be recorded when a
+        registration is created, or when its operator changes.
+        """
+        registration = self.make_registration_adminuser()
+        self.assertTrue(FirstSeenOperator.objects.filter(
+            registration_id=registration.id).exists())
+
+        with mock.patch.object(
+                Registration, 'record_first_seen_operator') as mock_record:
+            registration.validated = True
+            registration.save(update_fields=['validated'])
+            registration.save()
+            mock_record.assert_not_called()
+
+            registration.data = dict(
+                registration.data, operator_id='other-operator')
+            registration.save(update_fields=['data'])
+            mock_record.assert_called_once_with()
+
+    @responses.activate
+    def test_refresh_operators(self):
+        """
+        Operators that aren't in the Operator table yet, and operators that
+        were refreshed too long ago, should be refreshed from the identity
+        store.
+        """
+        now = timezone.now()
+        for operator_id in ['new-operator', 'missing-operator']:
+            FirstSeenOperator.objects.create(
+                operator_id=operator_id, registration_id=uuid.uuid4(),
+                first_registration_at=now)
+        Operator.objects.create(
+            operator_id='stale-operator', state='abuja',
+            refreshed_at=now - timedelta(days=2))
+        Operator.objects.create(
+            operator_id='fresh-operator', state='abuja', refreshed_at=now)
+
+        self.add_identity_callback('new-operator', {
+            "state": "Cross River", "role": "CHEW",
+            "facility_name": "Facility", "personnel_code": "1234"})
+        self.add_identity_callback('stale-operator', {"state": "Ebonyi"})
+        responses.add(
+            responses.GET,
+            'http://localhost:8001/api/v1/identities/missing-operator/',
+            json={"detail": "Not found."},
+            status=404, content_type='application/json')
+
+        result = refresh_operators.run(max_age=60 * 60)
+
+        self.assertEqual(result, "Refreshed 2 operators, 1 errors")
+        operator = Operator.objects.get(operator_id='new-operator')
+        self.assertEqual(operator.state, "cross_river")
+        self.assertEqual(operator.role, "chew")
+        self.assertEqual(operator.facility_name, "Facility")
+        self.assertEqual(operator.personnel_code, "1234")
+        operator = Operator.objects.get(operator_id='stale-operator')
+        self.assertEqual(operator.state, "ebonyi")
+        self.assertEqual(operator.role, None)
+        self.assertFalse(
+            Operator.objects.filter(operator_id='missing-operator').exists())
+        self.assertEqual(
+            len([c for c in responses.calls if 'fresh' in c.request.url]), 0)
+
+    @responses.activate
+    def test_refresh_operators_server_error(self):
+        """
+        An operator that can't be fetched should be counted as an error,
+        without stopping the other operators from being refreshed.
+        """
+        now = timezone.now()
+        for operator_id in ['new-operator', 'broken-operator']:
+            FirstSeenOperator.objects.create(
+                operator_id=operator_id, registration_id=uuid.uuid4(),
+                first_registration_at=now)
+        self.add_identity_callback('new-operator', {"state": "Abuja"})
+        responses.add(
+            responses.GET,
+            'http://localhost:8001/api/v1/identities/broken-operator/',
+            json={"detail": "Server error"},
+            status=500, content_type='application/json')
+
+        result = refresh_operators.run(max_age=60 * 60)
+
+        self.assertEqual(result, "Refreshed 1 operators, 1 errors")
+        self.assertEqual(
+            Operator.objects.get(operator_id='new-operator').state, 'abuja')
+
+    @responses.activate
+    def test_refresh_operators_limit(self):
+        """
+        At most `limit` operators should be refreshed, the new operators
+        first and then the least recently refreshed.
+        """
+        now = timezone.now()
+        FirstSeenOperator.objects.create(
+            operator_id='new-operator', registration_id=uuid.uuid4(),
+            first_registration_at=now)
+        for days, operator_id in [(3, 'stalest-operator'),
+                                  (2, 'stale-operator')]:
+            Operator.objects.create(
+                operator_id=operator_id, state='abuja',
+                refreshed_at=now - timedelta(days=days))
+        for operator_id in ['new-operator', 'stalest-operator']:
+            self.add_identity_callback(operator_id, {"state": "Abuja"})
+
+        result = refresh_operators.run(max_age=60 * 60, limit=2)
+
+        self.assertEqual(result, "Refreshed 2 operators, 0 errors")
+        self.assertEqual(
+            len([c for c in responses.calls if 'stale-' in c.request.url]),
+            0)
+
+    @responses.activate
+    def test_refresh_operators_reseeds_counters(self):
+        """
+        When an operator's state changes, the counters and rollups of the
+        old and new state should be recalculated.
+        """
+        operator_id = REG_DATA['hw_pre_mother']['operator_id']
+        registration = self.make_registration_adminuser({
+            "stage": "prebirth",
+            "data": REG_DATA['hw_pre_mother'],
+            "source": self.make_source_adminuser(),
+        })
+        Operator.objects.create(
+            operator_id=operator_id, state='abuja',
+            refreshed_at=timezone.now() - timedelta(days=2))
+        day = registration.created_at.date()
+        DailyRollup.objects.create(
+            day=day, dimension=DailyRollup.STATE, value='abuja', count=1)
+        DailyRollup.objects.create(
+            day=day, dimension=DailyRollup.CREATED, count=7)
+        MetricCounter.objects.create(
+            name='registrations.state.abuja.total.last', value=5)
+        MetricCounter.objects.create(
+            name='registrations.state.ebonyi.total.last', value=5)
+        self.add_identity_callback(operator_id, {"state": "Ebonyi"})
+
+        mark_registration_counted(registration.id)
+        refresh_operators.run(max_age=60 * 60)
 
-        post_save.disconnect(fire_role_metric, sender=Registration)
+        self.assertEqual(
+            MetricCounter.objects.get(
+                name='registrations.state.abuja.total.last').value, 0)
+        self.assertEqual(
+            MetricCounter.objects.get(
+                name='registrations.state.ebonyi.total.last').value, 1)
+        self.assertEqual(sum_rollups(DailyRollup.STATE), {'ebonyi': 1})
+        # Only the state and role rollups are rebuilt
+        self.assertEqual(sum_rollups(DailyRollup.CREATED), {'': 7})
 
 
 class TestSubscriptionRequestWebhook(AuthenticatedAPITestCase):
@@ -3069,21 +4455,7 @@ class ManagementTaskTestCase(TestCase):
             " helpers cleaned up properly in earlier tests.")
         post_save.disconnect(receiver=registration_post_save,
                              sender=Registration)
-        post_save.disconnect(receiver=fire_created_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_source_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_unique_operator_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_message_type_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_receiver_type_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_language_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_state_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_role_metric,
+        post_save.disconnect(receiver=fire_registration_metrics,
                              sender=Registration)
         post_save.disconnect(receiver=model_saved,
                              dispatch_uid='instance-saved-hook')
@@ -3193,17 +4565,7 @@ class ManagementTaskTestCase(TestCase):
             " helpers removed them properly in earlier tests.")
         post_save.connect(receiver=registration_post_save,
                           sender=Registration)
-        post_save.connect(receiver=fire_created_metric,
-                          sender=Registration)
-        post_save.connect(receiver=fire_source_metric,
-                          sender=Registration)
-        post_save.connect(receiver=fire_unique_operator_metric,
-                          sender=Registration)
-        post_save.connect(receiver=fire_language_metric,
-                          sender=Registration)
-        post_save.connect(receiver=fire_state_metric,
-                          sender=Registration)
-        post_save.connect(receiver=fire_role_metric,
+        post_save.connect(receiver=fire_registration_metrics,
                           sender=Registration)
         post_save.connect(receiver=model_saved,
                           dispatch_uid='instance-saved-hook')
@@ -3762,31 +5124,35 @@ class FixRegistrationSubscriptionsTest(ManagementTaskTestCase):
 
 
 class TestRepopulateMetricsTask(TestCase):
+    @mock.patch('registrations.tasks.OptoutSnapshot.load')
     @mock.patch('registrations.tasks.pika')
     @mock.patch('registrations.tasks.RepopulateMetrics.generate_and_send')
-    def test_run_repopulate_metrics(self, mock_repopulate, mock_pika):
+    def test_run_repopulate_metrics(
+            self, mock_repopulate, mock_pika, mock_optouts):
         """
         The repopulate metrics task should create an amqp connection, and call
         generate_and_send with the appropriate parameters.
         """
+        mock_optouts.return_value = OptoutSnapshot([])
         repopulate_metrics.delay(
-            'amqp://test', 'prefix', ['metric.foo', 'metric.bar'], '30s:1m')
+            'amqp://test', 'prefix',
+            ['optout.reason.other.sum', 'optout.source.sms.sum'], '30s:1m')
         args = [args for args, _ in mock_repopulate.call_args_list]
 
         # Relative instead of absolute times
         start = min(args, key=lambda a: a[3])[3]
-        args = [[a, p, m, s-start, e-start] for a, p, m, s, e in args]
+        args = [[a.channel, p, m, s-start, e-start] for a, p, m, s, e in args]
 
         connection = mock_pika.BlockingConnection.return_value
         channel = connection.channel.return_value
         expected = [
-            [channel, 'prefix', 'metric.foo',
+            [channel, 'prefix', 'optout.reason.other.sum',
                 timedelta(seconds=0), timedelta(seconds=30)],
-            [channel, 'prefix', 'metric.foo',
+            [channel, 'prefix', 'optout.reason.other.sum',
                 timedelta(seconds=30), timedelta(seconds=60)],
-            [channel, 'prefix', 'metric.bar',
+            [channel, 'prefix', 'optout.source.sms.sum',
                 timedelta(seconds=0), timedelta(seconds=30)],
-            [channel, 'prefix', 'metric.bar',
+            [channel, 'prefix', 'optout.source.sms.sum',
                 timedelta(seconds=30), timedelta(seconds=60)],
         ]
 
@@ -3799,6 +5165,223 @@ class TestRepopulateMetricsTask(TestCase):
         [parameters], _ = mock_pika.BlockingConnection.call_args
         self.assertEqual(parameters, mock_pika.URLParameters.return_value)
 
+    @mock.patch('registrations.tasks.OptoutSnapshot.load')
+    @mock.patch('registrations.tasks.pika')
+    @mock.patch('registrations.tasks.send_metric')
+    @mock.patch('registrations.tasks.RepopulateMetrics.generate_and_send')
+    def test_run_repopulate_metrics_families(
+            self, mock_repopulate, mock_send_metric, mock_pika, mock_optouts):
+        """
+        Metrics that belong to a family should be generated for all the
+        buckets at once and sent directly, the rest should be generated per
+        bucket.
+        """
+        mock_optouts.return_value = OptoutSnapshot([])
+        repopulate_metrics.delay(
+            'amqp://test', 'prefix',
+            ['registrations.created.sum', 'optout.reason.other.sum'], '30s:1m')
+
+        channel = mock_pika.BlockingConnection.return_value.channel\
+            .return_value
+        sent = [args for args, _ in mock_send_metric.call_args_list]
+        self.assertEqual(len(sent), 2)
+        for publisher, prefix, name, value, timestamp in sent:
+            self.assertEqual(publisher.channel, channel)
+            self.assertEqual(prefix, 'prefix')
+            self.assertEqual(name, 'registrations.created.sum')
+            self.assertEqual(value, 0)
+        self.assertEqual(sent[1][4] - sent[0][4], timedelta(seconds=30))
+
+        names = [args[2] for args, _ in mock_repopulate.call_args_list]
+        self.assertEqual(names, ['optout.reason.other.sum'] * 2)
+
+    @mock.patch('registrations.tasks.RepopulateMetrics.dispatch_shards')
+    def test_run_repopulate_metrics_unknown_metric(self, mock_dispatch):
+        """
+        Unknown metric names should fail before the backfill is started.
+        """
+        self.assertRaises(
+            UnknownMetricError, repopulate_metrics.run,
+            'amqp://test', 'prefix',
+            ['registrations.created.sum', 'registrations.created.summ'],
+            '30s:1m')
+        self.assertFalse(MetricsBackfill.objects.exists())
+        mock_dispatch.assert_not_called()
+
+    def create_backfill(self, graphite_retentions, shard_size):
+        backfill = MetricsBackfill.objects.create(
+            amqp_url='amqp://test', prefix='prefix',
+            metric_names=['optout.reason.other.sum'],
+            graphite_retentions=graphite_retentions,
+            now=datetime(2016, 10, 26, 12, 0, 0, tzinfo=timezone.utc))
+        backfill.create_shards(shard_size)
+        return backfill
+
+    def test_create_shards(self):
+        """
+        The shards should cover all the buckets of all the retentions, with
+        at most shard_size buckets each.
+        """
+        backfill = self.create_backfill('30s:2m,1m:4m', 3)
+        shards = backfill.shards.order_by('start')
+
+        self.assertEqual(
+            [(s.retention, s.buckets_total) for s in shards],
+            [('1m:4m', 2), ('30s:2m', 3), ('30s:2m', 1)])
+        self.assertEqual(shards[0].start, datetime(
+            2016, 10, 26, 11, 56, 0, tzinfo=timezone.utc))
+        self.assertEqual(shards[1].start, datetime(
+            2016, 10, 26, 11, 58, 0, tzinfo=timezone.utc))
+        self.assertEqual(shards[2].start, datetime(
+            2016, 10, 26, 11, 59, 30, tzinfo=timezone.utc))
+        self.assertEqual(shards[2].finish, datetime(
+            2016, 10, 26, 12, 0, 0, tzinfo=timezone.utc))
+
+    @mock.patch('registrations.tasks.OptoutSnapshot.load')
+    @mock.patch('registrations.tasks.pika')
+    @mock.patch('registrations.tasks.RepopulateMetrics.generate_and_send')
+    def test_run_repopulate_metrics_sharded(
+            self, mock_repopulate, mock_pika, mock_optouts):
+        """
+        Every shard should be run, and checkpointed as complete.
+        """
+        mock_optouts.return_value = OptoutSnapshot([])
+        with self.settings(REPOPULATE_METRICS_SHARD_SIZE=1):
+            backfill_id = repopulate_metrics.delay(
+                'amqp://test', 'prefix', ['optout.reason.other.sum'],
+                '30s:1m').get()
+
+        backfill = MetricsBackfill.objects.get(id=backfill_id)
+        self.assertEqual(
+            [s.status for s in backfill.shards.all()],
+            [MetricsBackfillShard.COMPLETE] * 2)
+        self.assertEqual(mock_repopulate.call_count, 2)
+        progress = backfill.get_progress()
+        self.assertEqual(progress['percentage'], 100)
+        self.assertEqual(progress['eta'], None)
+
+    @mock.patch.object(tasks.RepopulateMetricsShard, 'max_retries', 0)
+    @mock.patch('registrations.tasks.OptoutSnapshot.load')
+    @mock.patch('registrations.tasks.pika')
+    @mock.patch('registrations.tasks.RepopulateMetrics.generate_and_send')
+    def test_repopulate_metrics_shard_resumes(
+            self, mock_repopulate, mock_pika, mock_optouts):
+        """
+        A failed shard should keep the checkpoint of the buckets that were
+        sent, and resume from there when it is retried.
+        """
+        backfill = self.create_backfill('30s:2m', 4)
+        [shard] = backfill.shards.all()
+        mock_repopulate.side_effect = [None, Exception('Connection lost')]
+
+        self.assertRaises(
+            Exception, repopulate_metrics_shard, shard_id=shard.id)
+        shard.refresh_from_db()
+        self.assertEqual(shard.status, MetricsBackfillShard.FAILED)
+        self.assertEqual(shard.buckets_done, 1)
+        self.assertIn('Connection lost', shard.error)
+        self.assertEqual(backfill.get_progress()['failed'], 1)
+
+        mock_repopulate.reset_mock()
+        mock_repopulate.side_effect = None
+        repopulate_metrics.dispatch_shards([shard])
+
+        shard.refresh_from_db()
+        self.assertEqual(shard.status, MetricsBackfillShard.COMPLETE)
+        self.assertEqual(shard.buckets_done, 4)
+        self.assertEqual(shard.attempts, 2)
+        starts = [args[3] for args, _ in mock_repopulate.call_args_list]
+        self.assertEqual(starts, [
+            datetime(2016, 10, 26, 11, 58, 30),
+            datetime(2016, 10, 26, 11, 59, 0),
+            datetime(2016, 10, 26, 11, 59, 30),
+        ])
+
+    @mock.patch('registrations.tasks.OptoutSnapshot.load')
+    @mock.patch('registrations.tasks.pika')
+    @mock.patch('registrations.tasks.RepopulateMetrics.generate_and_send')
+    def test_repopulate_metrics_optout_snapshot(
+            self, mock_repopulate, mock_pika, mock_optouts):
+        """
+        The optouts should be fetched once for the backfill, and stored for
+        all the shards to use.
+        """
+        mock_optouts.return_value = OptoutSnapshot([{
+            'created_at': '2016-10-26T11:59:45Z', 'identity': 'mother01',
+            'reason': 'other', 'request_source': 'sms'}])
+        with self.settings(REPOPULATE_METRICS_SHARD_SIZE=1):
+            backfill_id = repopulate_metrics.delay(
+                'amqp://test', 'prefix', ['optout.reason.other.sum'],
+                '30s:1m').get()
+
+        self.assertEqual(mock_optouts.call_count, 1)
+        backfill = MetricsBackfill.objects.get(id=backfill_id)
+        self.assertEqual(
+            backfill.optout_snapshot['optouts'][0]['identity'], 'mother01')
+        self.assertEqual(mock_repopulate.call_count, 2)
+        for _, kwargs in mock_repopulate.call_args_list:
+            self.assertEqual(
+                kwargs['generator'].optouts.identities, ['mother01'])
+
+    @mock.patch.object(
+        tasks.RepopulateMetricsShard, 'retry', side_effect=Retry())
+    @mock.patch('registrations.tasks.pika')
+    @mock.patch('registrations.tasks.RepopulateMetrics.generate_and_send')
+    def test_repopulate_metrics_shard_retrying(
+            self, mock_repopulate, mock_pika, mock_retry):
+        """
+        A shard that is still being retried automatically shouldn't be
+        failed, so that it can't also be retried manually.
+        """
+        backfill = self.create_backfill('30s:2m', 4)
+        [shard] = backfill.shards.all()
+        mock_repopulate.side_effect = Exception('Connection lost')
+
+        self.assertRaises(
+            Retry, repopulate_metrics_shard, shard_id=shard.id)
+        shard.refresh_from_db()
+        self.assertEqual(shard.status, MetricsBackfillShard.PENDING)
+        self.assertIn('Connection lost', shard.error)
+        self.assertEqual(backfill.get_progress()['failed'], 0)
+
+    @override_settings(REPOPULATE_METRICS_SHARD_TIMEOUT=600)
+    def test_backfill_retryable_shards(self):
+        """
+        Failed shards, and running shards that haven't been updated within
+        the timeout, should be retryable.
+        """
+        backfill = self.create_backfill('30s:2m', 1)
+        failed, running, stalled, pending = backfill.shards.order_by('start')
+        failed.set_status(MetricsBackfillShard.FAILED)
+        running.set_status(MetricsBackfillShard.RUNNING)
+        stalled.set_status(MetricsBackfillShard.RUNNING)
+        MetricsBackfillShard.objects.filter(id=stalled.id).update(
+            updated_at=timezone.now() - timedelta(minutes=11))
+
+        self.assertEqual(
+            sorted(s.id for s in backfill.get_retryable_shards()),
+            sorted([failed.id, stalled.id]))
+        progress = backfill.get_progress()
+        self.assertEqual(progress['failed'], 1)
+        self.assertEqual(progress['stalled'], 1)
+
+    def test_backfill_progress_eta(self):
+        """
+        The time remaining should be estimated from the rate that buckets
+        have been completed at.
+        """
+        backfill = self.create_backfill('30s:2m', 2)
+        started_at = datetime(2016, 10, 26, 13, 0, 0, tzinfo=timezone.utc)
+        backfill.shards.update(started_at=started_at)
+        shard = backfill.shards.order_by('start').first()
+        shard.set_status(MetricsBackfillShard.COMPLETE, buckets_done=2)
+
+        progress = backfill.get_progress(
+            now=started_at + timedelta(minutes=10))
+        self.assertEqual(progress['complete'], 1)
+        self.assertEqual(progress['percentage'], 50)
+        self.assertEqual(progress['eta'], timedelta(minutes=10))
+
     @mock.patch('registrations.tasks.MetricGenerator.generate_metric')
     @mock.patch('registrations.tasks.send_metric')
     def test_generate_and_send(
@@ -13,6 +13,8 @@ router.register(r'registrations', views.RegistrationGetViewSet)
 # Wire up our API using automatic URL routing.
 # Additionally, we include login URLs for the browseable API.
 urlpatterns = [
+    url(r'^api/v1/registration/bulk/$',
+        views.RegistrationBulkPost.as_view()),
     url(r'^api/v1/registration/(?P<id>.+)/',
         views.RegistrationPostPatch.as_view()),
     url(r'^api/v1/registration/', views.RegistrationPostPatch.as_view()),
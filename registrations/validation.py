@@ -0,0 +1,238 @@
+from collections import namedtuple
+from datetime import datetime
+
+from django.conf import settings
+
+from hellomama_registration import utils
+
+
+def is_valid_date(date):
+    try:
+        datetime.strptime(date, "%Y%m%d")
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+def is_valid_uuid(id):
+    return len(id) == 36 and id[14] == '4' and id[19] in ['a', 'b', '8', '9']
+
+
+def is_valid_lang(lang):
+    return lang in settings.LANGUAGES
+
+
+def is_valid_msg_type(msg_type):
+    return msg_type in settings.MSG_TYPES
+
+
+def is_valid_msg_receiver(msg_receiver):
+    return msg_receiver in settings.RECEIVER_TYPES
+
+
+def is_valid_loss_reason(loss_reason):
+    return loss_reason in ['miscarriage', 'stillborn', 'baby_died']
+
+
+def is_valid_state(state):
+    return state in settings.STATES
+
+
+def is_valid_role(role):
+    return role in settings.ROLES
+
+
+class Verdict(namedtuple(
+        'Verdict', ['registration', 'valid', 'invalid_fields', 'derived'])):
+    """ The result of validating a single registration.
+
+    `invalid_fields` is either a list of the fields that failed, or a string
+    describing why the registration failed. `derived` holds the fields that
+    are added to the registration data when it is valid.
+    """
+
+    def apply(self):
+        """ Sets the result on the registration, without saving it.
+        """
+        registration = self.registration
+        if registration.data is None:
+            registration.data = {}
+        if self.valid:
+            registration.data.update(self.derived)
+            registration.data.pop("invalid_fields", None)
+        else:
+            registration.data["invalid_fields"] = self.invalid_fields
+        registration.validated = self.valid
+
+
+class BatchValidator(object):
+    """ Validates many registrations in a single pass.
+
+    The rules for each stage are compiled once per validator, and dates are
+    only parsed once for each distinct value, so a validator should be reused
+    for a whole batch.
+
+    Pregnancy weeks and baby ages are calculated relative to today, or to
+    when each registration was created if `as_of_creation` is set.
+    """
+
+    FIELDS_GENERAL = ("receiver_id", "operator_id", "language", "msg_type")
+    HW_AUTHORITIES = ("hw_limited", "hw_full")
+
+    # (stage, allowed source authorities, required fields, reg_type).
+    # An authority of None allows any source.
+    STAGE_RULES = (
+        ("prebirth", HW_AUTHORITIES,
+         FIELDS_GENERAL + ("last_period_date", "msg_receiver"), "hw_pre"),
+        ("postbirth", HW_AUTHORITIES,
+         FIELDS_GENERAL + ("baby_dob", "msg_receiver"), "hw_post"),
+        ("loss", ("patient", "advisor"),
+         FIELDS_GENERAL + ("loss_reason",), "pbl_loss"),
+        ("public", None, FIELDS_GENERAL, "public"),
+    )
+
+    def __init__(self, today=None, as_of_creation=False):
+        self.today = today or utils.get_today()
+        self.as_of_creation = as_of_creation
+        self.preg_weeks = {}
+        self.baby_ages = {}
+
+        languages = frozenset(settings.LANGUAGES)
+        msg_types = frozenset(settings.MSG_TYPES)
+        receiver_types = frozenset(settings.RECEIVER_TYPES)
+        loss_reasons = frozenset(['miscarriage', 'stillborn', 'baby_died'])
+
+        self.field_checks = {
+            "receiver_id": self.check_uuid,
+            "operator_id": self.check_uuid,
+            "language": self.check_choice(languages),
+            "msg_type": self.check_choice(msg_types),
+            "msg_receiver": self.check_choice(receiver_types),
+            "loss_reason": self.check_choice(loss_reasons),
+            "last_period_date": self.check_last_period_date,
+            "baby_dob": self.check_baby_dob,
+        }
+        self.rules = dict(
+            (stage, (authorities and frozenset(authorities),
+                     frozenset(fields), fields, reg_type))
+            for stage, authorities, fields, reg_type in self.STAGE_RULES)
+
+    def check_uuid(self, field, value, today):
+        if not is_valid_uuid(value):
+            return field
+
+    def check_choice(self, choices):
+        def check(field, value, today):
+            if value not in choices:
+                return field
+        return check
+
+    def get_today(self, registration):
+        if self.as_of_creation and registration.created_at is not None:
+            created_at = registration.created_at.replace(tzinfo=None)
+            return datetime(
+                created_at.year, created_at.month, created_at.day)
+        return self.today
+
+    def get_preg_week(self, last_period_date, today):
+        """ Returns the pregnancy week for the date, or None if the date is
+        invalid.
+        """
+        key = (last_period_date, today)
+        if key not in self.preg_weeks:
+            week = None
+            if is_valid_date(last_period_date):
+                week = utils.calc_pregnancy_week_lmp(today, last_period_date)
+            self.preg_weeks[key] = week
+        return self.preg_weeks[key]
+
+    def get_baby_age(self, baby_dob, today):
+        """ Returns the baby's age in weeks for the date, or None if the date
+        is invalid.
+        """
+        key = (baby_dob, today)
+        if key not in self.baby_ages:
+            age = None
+            if is_valid_date(baby_dob):
+                age = utils.calc_baby_age(today, baby_dob)
+            self.baby_ages[key] = age
+        return self.baby_ages[key]
+
+    def check_last_period_date(self, field, value, today):
+        preg_weeks = self.get_preg_week(value, today)
+        if preg_weeks is None:
+            return field
+        if not (settings.PREBIRTH_MIN_WEEKS <= preg_weeks <=
+                settings.PREBIRTH_MAX_WEEKS):
+            return "last_period_date out of range"
+
+    def check_baby_dob(self, field, value, today):
+        baby_age = self.get_baby_age(value, today)
+        if baby_age is None:
+            return field
+        if not (settings.POSTBIRTH_MIN_WEEKS <= baby_age <=
+                settings.POSTBIRTH_MAX_WEEKS):
+            return "baby_dob out of range"
+
+    def check_fields(self, fields, data, today=None):
+        """ Returns the failures for the given fields of the data
+        """
+        today = today or self.today
+        failures = []
+        for field in fields:
+            check = self.field_checks.get(field)
+            if check is None:
+                continue
+            failure = check(field, data[field], today)
+            if failure is not None:
+                failures.append(failure)
+        return failures
+
+    def validate_one(self, registration):
+        data = registration.data or {}
+
+        def invalid(reason):
+            return Verdict(registration, False, reason, {})
+
+        if not is_valid_uuid(registration.mother_id):
+            return invalid("Invalid UUID mother_id")
+
+        msg_receiver = data.get("msg_receiver")
+        receiver_id = data.get("receiver_id")
+        if (msg_receiver in ["father_only", "friend_only", "family_only"] and
+                registration.mother_id == receiver_id):
+            return invalid("mother requires own id")
+        elif (msg_receiver == "mother_only" and
+                registration.mother_id != receiver_id):
+            return invalid("mother_id should be the same as receiver_id")
+
+        rule = self.rules.get(registration.stage)
+        if rule is None:
+            return invalid("Invalid combination of fields")
+        authorities, required, fields, reg_type = rule
+        if ((authorities is not None and
+                registration.source.authority not in authorities) or
+                not required.issubset(data)):
+            return invalid("Invalid combination of fields")
+
+        today = self.get_today(registration)
+        invalid_fields = self.check_fields(fields, data, today)
+        if invalid_fields:
+            return invalid(invalid_fields)
+
+        derived = {"reg_type": reg_type}
+        if reg_type == "hw_pre":
+            derived["preg_week"] = self.get_preg_week(
+                data["last_period_date"], today)
+        elif reg_type == "hw_post":
+            derived["baby_age"] = self.get_baby_age(data["baby_dob"], today)
+        return Verdict(registration, True, None, derived)
+
+    def validate(self, registrations):
+        """ Validates the registrations, which can be a list or a queryset.
+
+        :returns: list of Verdicts, in the same order as the registrations
+        """
+        if hasattr(registrations, 'select_related'):
+            registrations = registrations.select_related('source')
+        return [self.validate_one(r) for r in registrations]
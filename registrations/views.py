@@ -4,7 +4,7 @@ from django.contrib.auth.models import User, Group
 from django.db.models import Q
 from django.conf import settings
 from django.db import connection
-from .models import Source, Registration
+from .models import Source, Registration, create_registrations
 from rest_hooks.models import Hook
 from rest_framework import viewsets, mixins, generics, status
 from rest_framework.exceptions import ValidationError
@@ -17,10 +17,9 @@ from .serializers import (UserSerializer, GroupSerializer,
                           SourceSerializer, RegistrationSerializer,
                           HookSerializer, CreateUserSerializer)
 from hellomama_registration import utils
-# Uncomment line below if scheduled metrics are added
-# from .tasks import scheduled_metrics
 from .tasks import (
-    pull_third_party_registrations, send_public_registration_notifications)
+    pull_third_party_registrations, scheduled_metrics,
+    send_public_registration_notifications)
 
 
 class CreatedAtCursorPagination(CursorPagination):
@@ -117,8 +116,7 @@ class MetricsView(APIView):
 
     def post(self, request, *args, **kwargs):
         status = 201
-        # Uncomment line below if scheduled metrics are added
-        # scheduled_metrics.apply_async()
+        scheduled_metrics.apply_async()
         resp = {"scheduled_metrics_initiated": True}
         return Response(resp, status=status)
 
@@ -147,6 +145,64 @@ class RegistrationPostPatch(mixins.CreateModelMixin, mixins.UpdateModelMixin,
         serializer.save(updated_by=self.request.user)
 
 
+class RegistrationBulkPost(generics.GenericAPIView):
+    """ Bulk Registration Interaction
+        POST - creates a list of registrations and returns a result for each
+    """
+    permission_classes = (IsAuthenticated,)
+    queryset = Registration.objects.all()
+    serializer_class = RegistrationSerializer
+
+    def post(self, request, *args, **kwargs):
+        if not isinstance(request.data, list):
+            raise ValidationError('Expected a list of registrations')
+        if len(request.data) > settings.REGISTRATION_BULK_MAX_SIZE:
+            raise ValidationError(
+                'A maximum of %s registrations can be created at once' % (
+                    settings.REGISTRATION_BULK_MAX_SIZE))
+
+        # load the users sources - posting users should only have one source
+        source = Source.objects.get(user=self.request.user)
+
+        results = []
+        registrations = []
+        for index, item in enumerate(request.data):
+            if not isinstance(item, dict):
+                results.append({
+                    "index": index, "created": False,
+                    "errors": {"non_field_errors": [
+                        "Expected a registration object"]}})
+                continue
+
+            item = dict(item, source=source.id)
+            serializer = self.get_serializer(data=item)
+            if serializer.is_valid():
+                registration = Registration(
+                    created_by=self.request.user,
+                    updated_by=self.request.user,
+                    **serializer.validated_data)
+                registrations.append(registration)
+                results.append({
+                    "index": index, "created": True,
+                    "id": str(registration.id)})
+            else:
+                results.append({
+                    "index": index, "created": False,
+                    "errors": serializer.errors})
+
+        if registrations:
+            create_registrations(registrations)
+
+        if len(registrations) == len(results):
+            response_status = status.HTTP_201_CREATED
+        elif registrations:
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_400_BAD_REQUEST
+
+        return Response({"results": results}, status=response_status)
+
+
 class RegistrationFilter(filters.FilterSet):
     """Filter for registrations created, using ISO 8601 formatted dates"""
     created_before = django_filters.IsoDateTimeFilter(name="created_at",
@@ -184,7 +240,10 @@ class HealthcheckView(APIView):
         resp = {
             "up": True,
             "result": {
-                "database": "Accessible"
+                "database": "Accessible",
+                "identity_cache": utils.get_identity_cache_stats(),
+                "circuit_breakers": utils.get_circuit_breaker_states(),
+                "request_memo": utils.get_memo_stats(),
             }
         }
         return Response(resp, status=status)
@@ -295,7 +354,7 @@ class MissedCallNotification(APIView):
         if data.get('identity', None) is not None and data['identity'] != "":
             registrations = Registration.objects.filter(
                 Q(mother_id=data['identity']) |
-                Q(data__receiver_id=data['identity'])).order_by('-created_at')
+                Q(receiver_id=data['identity'])).order_by('-created_at')
             if len(registrations) > 0:
                 registration = registrations[0]
             else:
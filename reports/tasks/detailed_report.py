@@ -4,6 +4,7 @@ import os
 from django.conf import settings
 from django.utils.dateparse import parse_datetime
 from functools import partial
+from itertools import islice
 from six import string_types
 from datetime import timedelta
 
@@ -11,6 +12,8 @@ from seed_services_client import (IdentityStoreApiClient,
                                   StageBasedMessagingApiClient,
                                   MessageSenderApiClient)
 
+from hellomama_registration import utils
+
 from .base import BaseTask
 from .send_email import SendEmail
 from registrations.models import Registration
@@ -27,6 +30,10 @@ class GenerateReport(BaseTask):
     """ Generate an XLS spreadsheet report on registrations, write it to
     disk and email it to specified recipients
     """
+    # The amount of rows whose identities are fetched concurrently
+    prefetch_size = 100
+    identities = {}
+    addresses = {}
 
     def run(self, start_date, end_date, task_status_id, email_recipients=[],
             email_sender=settings.DEFAULT_FROM_EMAIL,
@@ -43,21 +50,25 @@ class GenerateReport(BaseTask):
 
         end_date = end_date + timedelta(days=1, microseconds=-1)
 
-        self.identity_cache = {}
         self.messageset_cache = {}
-        self.address_cache = {}
 
-        self.identity_store_client = IdentityStoreApiClient(
-            settings.IDENTITY_STORE_TOKEN,
-            settings.IDENTITY_STORE_URL,
+        self.identity_store_client = utils.build_client(
+            IdentityStoreApiClient,
+            'identity_store',
+            auth_token=settings.IDENTITY_STORE_TOKEN,
+            api_url=settings.IDENTITY_STORE_URL,
         )
-        self.stage_based_messaging_client = StageBasedMessagingApiClient(
-            settings.STAGE_BASED_MESSAGING_TOKEN,
-            settings.STAGE_BASED_MESSAGING_URL,
+        self.stage_based_messaging_client = utils.build_client(
+            StageBasedMessagingApiClient,
+            'stage_based_messaging',
+            auth_token=settings.STAGE_BASED_MESSAGING_TOKEN,
+            api_url=settings.STAGE_BASED_MESSAGING_URL,
         )
-        self.message_sender_client = MessageSenderApiClient(
-            settings.MESSAGE_SENDER_TOKEN,
-            settings.MESSAGE_SENDER_URL,
+        self.message_sender_client = utils.build_client(
+            MessageSenderApiClient,
+            'message_sender',
+            auth_token=settings.MESSAGE_SENDER_TOKEN,
+            api_url=settings.MESSAGE_SENDER_URL,
         )
 
         workbook = self.workbook_class()
@@ -100,21 +111,40 @@ class GenerateReport(BaseTask):
                 'recipients': email_recipients,
                 'task_status_id': task_status_id})
 
-    def get_identity(self, identity):
-        if identity in self.identity_cache:
-            return self.identity_cache[identity]
+    def prefetch_identities(self, items, get_ids):
+        """
+        Yields the items, after concurrently fetching the identities that
+        `get_ids` returns for each chunk of `prefetch_size` items, so that
+        `get_identity` doesn't make a request for each of them.
+        """
+        items = iter(items)
+        while True:
+            chunk = list(islice(items, self.prefetch_size))
+            if not chunk:
+                break
+            ids = [i for item in chunk for i in get_ids(item)]
+            identities = utils.get_identities(
+                ids, client=self.identity_store_client)
+            # Identities that couldn't be fetched are fetched again, and
+            # raise, in get_identity
+            self.identities = dict(
+                (i, identity) for i, identity in zip(ids, identities)
+                if not isinstance(identity, Exception))
+            for item in chunk:
+                yield item
+        self.identities = {}
 
-        identity_object = self.identity_store_client.get_identity(identity)
-        self.identity_cache[identity] = identity_object
-        return identity_object
+    def get_identity(self, identity):
+        if identity in self.identities:
+            return self.identities[identity]
+        return utils.get_identity(
+            identity, client=self.identity_store_client)
 
     def get_identity_address(self, identity):
-        if identity in self.address_cache:
-            return self.address_cache[identity]
-
-        address = self.identity_store_client.get_identity_address(identity)
-        self.address_cache[identity] = address
-        return address
+        if identity in self.addresses:
+            return self.addresses[identity]
+        return utils.get_identity_address(
+            identity, client=self.identity_store_client)
 
     def get_messageset(self, messageset):
         if messageset in self.messageset_cache:
@@ -164,6 +194,12 @@ class GenerateReport(BaseTask):
             created_at__lte=end_date.isoformat(),
             validated=True,
         )
+        registrations = self.prefetch_identities(
+            registrations, lambda registration: [
+                registration.data.get('operator_id'),
+                registration.data.get('receiver_id'),
+                registration.mother_id,
+            ])
 
         for idx, registration in enumerate(registrations):
             data = registration.data
@@ -222,7 +258,8 @@ class GenerateReport(BaseTask):
             operator_id = registration.data.get('operator_id')
             registrations_per_operator[operator_id] += 1
 
-        for operator_id, count in registrations_per_operator.items():
+        for operator_id, count in self.prefetch_identities(
+                registrations_per_operator.items(), lambda item: item[:1]):
             operator = self.get_identity(operator_id) or {}
             operator_details = operator.get('details', {})
             sheet.add_row({
@@ -247,6 +284,8 @@ class GenerateReport(BaseTask):
 
         subscriptions = self.stage_based_messaging_client.get_subscriptions({
             'created_before': end_date.isoformat()})['results']
+        subscriptions = self.prefetch_identities(
+            subscriptions, lambda subscription: [subscription['identity']])
 
         data = collections.defaultdict(partial(collections.defaultdict, int))
         for subscription in subscriptions:
@@ -289,19 +328,34 @@ class GenerateReport(BaseTask):
             'before': end_date.isoformat()
         })['results']
 
+        def needs_address(outbound):
+            return ('voice_speech_url' not in outbound.get('metadata', {}) and
+                    not outbound.get('to_addr', '') and
+                    outbound.get('to_identity', ''))
+
+        # Fetch the addresses of the outbounds that only have an identity
+        # concurrently. Addresses that couldn't be fetched are fetched again,
+        # and raise, in get_identity_address
+        ids = [o['to_identity'] for o in outbounds if needs_address(o)]
+        addresses = utils.get_addresses(
+            ids, client=self.identity_store_client)
+        self.addresses = dict(
+            (i, address) for i, address in zip(ids, addresses)
+            if not isinstance(address, Exception))
+
         data = collections.defaultdict(dict)
         count = collections.defaultdict(int)
         for outbound in outbounds:
             if 'voice_speech_url' not in outbound.get('metadata', {}):
 
-                if (not outbound.get('to_addr', '') and
-                        outbound.get('to_identity', '')):
+                if needs_address(outbound):
                     outbound['to_addr'] = self.get_identity_address(
                         outbound['to_identity'])
 
                 count[outbound['to_addr']] += 1
                 data[outbound['to_addr']][outbound['created_at']] = \
                     outbound['delivered']
+        self.addresses = {}
 
         if count != {}:
             max_col = max(count.values())
@@ -369,6 +423,12 @@ class GenerateReport(BaseTask):
         optouts = self.identity_store_client.get_optouts({
             'created_at__gte': start_date.isoformat(),
             'created_at__lte': end_date.isoformat()})['results']
+        # Only the identities of optouts without an address are looked up
+        optouts = self.prefetch_identities(
+            optouts, lambda optout: (
+                [optout['identity']]
+                if optout.get('address') is None and
+                optout.get('identity') is not None else []))
 
         for optout in optouts:
             msisdns = []
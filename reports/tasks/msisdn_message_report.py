@@ -1,5 +1,6 @@
 from datetime import datetime
 from django.conf import settings
+from hellomama_registration import utils
 from os.path import getsize
 from registrations.models import Registration
 from reports.models import ReportTaskStatus
@@ -66,12 +67,27 @@ class GenerateMSISDNMessageReport(BaseTask):
                 'recipients': email_recipients,
                 'task_status_id': task_status_id})
 
+    def fan_out(self, func, items):
+        """
+        Calls `func` for each of the items concurrently, and returns the
+        results in the same order, raising the first exception that was
+        raised.
+        """
+        results = utils.fan_out(func, items)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
     def retrieve_identity_info(self, is_client, msisdns):
         logger = self.get_logger()
 
+        responses = self.fan_out(
+            lambda msisdn: is_client.get_identity_by_address('msisdn', msisdn),
+            msisdns)
+
         data = {}
-        for msisdn in msisdns:
-            response = is_client.get_identity_by_address('msisdn', msisdn)
+        for msisdn, response in zip(msisdns, responses):
             results = list(response['results'])
 
             if len(results) < 1:
@@ -95,6 +111,7 @@ class GenerateMSISDNMessageReport(BaseTask):
     def retrieve_registration_info(self, is_client, data):
         logger = self.get_logger()
 
+        operators = {}
         for msisdn, datum in data.items():
             if datum.get('id', None) is None:
                 # Skip if we didn't find an identity
@@ -119,32 +136,41 @@ class GenerateMSISDNMessageReport(BaseTask):
             # Get facility info from the operator's identity
             operator_id = registration.data.get('operator_id', None)
             if operator_id is not None:
-                operator_identity = is_client.get_identity(operator_id)
-                datum['facility'] = operator_identity.get(
-                        'details', {}).get('facility_name', "")
+                operators[msisdn] = operator_id
             else:
                 logger.info(
                     'No operator_id on registration for {0}'.format(msisdn))
                 datum['facility'] = ""
 
+        # The operator identities are fetched concurrently, once each
+        msisdns = list(operators.keys())
+        identities = utils.get_identities(
+            [operators[msisdn] for msisdn in msisdns], client=is_client)
+        for msisdn, operator_identity in zip(msisdns, identities):
+            if isinstance(operator_identity, Exception):
+                raise operator_identity
+            data[msisdn]['facility'] = (operator_identity or {}).get(
+                    'details', {}).get('facility_name', "")
+
         return data
 
     def retrieve_messages(self, ms_client, data, start_date, end_date):
         logger = self.get_logger()
 
+        # Skip the msisdns that we didn't find an identity for
+        msisdns = [
+            msisdn for msisdn, datum in data.items()
+            if datum.get('id', None) is not None]
+        responses = self.fan_out(lambda msisdn: ms_client.get_outbounds({
+            "to_identity": data[msisdn]['id'],
+            "after": start_date.strftime("%Y-%m-%dT00:00:00"),
+            "before": end_date.strftime("%Y-%m-%dT00:00:00")
+        }), msisdns)
+
         longest_list = 0
-        for msisdn, datum in data.items():
+        for msisdn, response in zip(msisdns, responses):
+            datum = data[msisdn]
             message_list = []
-
-            if datum.get('id', None) is None:
-                # Skip if we didn't find an identity
-                continue
-
-            response = ms_client.get_outbounds({
-                "to_identity": datum['id'],
-                "after": start_date.strftime("%Y-%m-%dT00:00:00"),
-                "before": end_date.strftime("%Y-%m-%dT00:00:00")
-            })
             results = list(response['results'])
 
             if len(results) < 1:
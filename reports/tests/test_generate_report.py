@@ -20,10 +20,7 @@ from rest_hooks.models import model_saved
 from seed_services_client import IdentityStoreApiClient
 
 from registrations.models import (
-    Registration, Source, registration_post_save, fire_created_metric,
-    fire_unique_operator_metric, fire_message_type_metric, fire_source_metric,
-    fire_receiver_type_metric, fire_language_metric, fire_state_metric,
-    fire_role_metric)
+    Registration, Source, registration_post_save, fire_registration_metrics)
 from ..utils import ExportWorkbook, generate_random_filename
 from ..tasks.detailed_report import generate_report
 from ..models import ReportTaskStatus
@@ -55,21 +52,7 @@ class GenerateReportTest(TestCase):
             " helpers cleaned up properly in earlier tests.")
         post_save.disconnect(receiver=registration_post_save,
                              sender=Registration)
-        post_save.disconnect(receiver=fire_created_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_source_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_unique_operator_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_message_type_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_receiver_type_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_language_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_state_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_role_metric,
+        post_save.disconnect(receiver=fire_registration_metrics,
                              sender=Registration)
         post_save.disconnect(receiver=model_saved,
                              dispatch_uid='instance-saved-hook')
@@ -85,17 +68,7 @@ class GenerateReportTest(TestCase):
             " helpers removed them properly in earlier tests.")
         post_save.connect(receiver=registration_post_save,
                           sender=Registration)
-        post_save.connect(receiver=fire_created_metric,
-                          sender=Registration)
-        post_save.connect(receiver=fire_source_metric,
-                          sender=Registration)
-        post_save.connect(receiver=fire_unique_operator_metric,
-                          sender=Registration)
-        post_save.connect(receiver=fire_language_metric,
-                          sender=Registration)
-        post_save.connect(receiver=fire_state_metric,
-                          sender=Registration)
-        post_save.connect(receiver=fire_role_metric,
+        post_save.connect(receiver=fire_registration_metrics,
                           sender=Registration)
 
         post_save.connect(receiver=model_saved,
@@ -549,7 +522,6 @@ class GenerateReportTest(TestCase):
         self.add_identity_callback(
             'mother_id', linked_id=None, address='mother-addr')
 
-        generate_report.identity_cache = {}
         generate_report.identity_store_client = IdentityStoreApiClient(
             settings.IDENTITY_STORE_TOKEN,
             settings.IDENTITY_STORE_URL,
@@ -12,10 +12,7 @@ from rest_hooks.models import model_saved
 from seed_services_client import IdentityStoreApiClient, MessageSenderApiClient
 
 from registrations.models import (
-    Registration, Source, registration_post_save, fire_created_metric,
-    fire_unique_operator_metric, fire_message_type_metric, fire_source_metric,
-    fire_receiver_type_metric, fire_language_metric, fire_state_metric,
-    fire_role_metric)
+    Registration, Source, registration_post_save, fire_registration_metrics)
 from reports.models import ReportTaskStatus
 from reports.tasks.msisdn_message_report import generate_msisdn_message_report
 from reports.utils import ExportWorkbook, generate_random_filename
@@ -52,21 +49,7 @@ class GenerateReportTest(TestCase):
             " helpers cleaned up properly in earlier tests.")
         post_save.disconnect(receiver=registration_post_save,
                              sender=Registration)
-        post_save.disconnect(receiver=fire_created_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_source_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_unique_operator_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_message_type_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_receiver_type_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_language_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_state_metric,
-                             sender=Registration)
-        post_save.disconnect(receiver=fire_role_metric,
+        post_save.disconnect(receiver=fire_registration_metrics,
                              sender=Registration)
         post_save.disconnect(receiver=model_saved,
                              dispatch_uid='instance-saved-hook')
@@ -82,17 +65,7 @@ class GenerateReportTest(TestCase):
             " helpers removed them properly in earlier tests.")
         post_save.connect(receiver=registration_post_save,
                           sender=Registration)
-        post_save.connect(receiver=fire_created_metric,
-                          sender=Registration)
-        post_save.connect(receiver=fire_source_metric,
-                          sender=Registration)
-        post_save.connect(receiver=fire_unique_operator_metric,
-                          sender=Registration)
-        post_save.connect(receiver=fire_language_metric,
-                          sender=Registration)
-        post_save.connect(receiver=fire_state_metric,
-                          sender=Registration)
-        post_save.connect(receiver=fire_role_metric,
+        post_save.connect(receiver=fire_registration_metrics,
                           sender=Registration)
 
         post_save.connect(receiver=model_saved,